@@ -0,0 +1,94 @@
+import argparse
+import json
+import random
+import time
+
+import orjson
+
+from benchmarks import payloads
+from models.rapidpro import RapidProCallback
+from models.webhook import WebhookMessage
+
+
+def measure(fn, items, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for item in items:
+            fn(item)
+    return rounds * len(items) / (time.perf_counter() - start)
+
+
+def ingest_cases(count: int, messages_per_change: int):
+    webhooks = [
+        json.dumps(
+            payloads.webhook("100000000000000", messages_per_change=messages_per_change)
+        ).encode()
+        for _ in range(count)
+    ]
+    callbacks = [
+        json.dumps(
+            payloads.rapidpro_callback(
+                random.choice(payloads.CALLBACK_KINDS), "260210000000"
+            )
+        ).encode()
+        for _ in range(count)
+    ]
+    return {
+        "webhook parse": (
+            webhooks,
+            lambda body: WebhookMessage.model_validate(json.loads(body)),
+            WebhookMessage.model_validate_json,
+        ),
+        "callback parse": (
+            callbacks,
+            lambda body: RapidProCallback.model_validate(json.loads(body)),
+            RapidProCallback.model_validate_json,
+        ),
+    }
+
+
+def encode_cases(count: int):
+    from message_handler import build_interactive_list_payload, build_text_payload
+    from models.whatsapp import Section
+    import yaml
+
+    menu = yaml.safe_load(payloads.CALLBACK_TEXTS["interactive"])
+    sections = [Section.model_validate(section) for section in menu["sections"]]
+    sends = [
+        build_interactive_list_payload(
+            "260970000000", "Main menu", "Pick one", "", "Options", sections
+        )
+        for _ in range(count // 2)
+    ] + [build_text_payload("260970000000", text) for text in payloads.TEXTS]
+    return {
+        "graph send encode": (
+            sends,
+            lambda payload: json.dumps(payload).encode(),
+            orjson.dumps,
+        )
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare the stdlib JSON path with pydantic-core/orjson"
+    )
+    parser.add_argument("--payloads", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--messages-per-change", type=int, default=3)
+    args = parser.parse_args(argv)
+    random.seed(0)
+
+    cases = ingest_cases(args.payloads, args.messages_per_change)
+    cases.update(encode_cases(args.payloads))
+    print(f"{'case':<20}{'old ops/s':>14}{'new ops/s':>14}{'speedup':>10}")
+    for name, (items, old, new) in cases.items():
+        old_rate = measure(old, items, args.rounds)
+        new_rate = measure(new, items, args.rounds)
+        print(
+            f"{name:<20}{old_rate:>14,.0f}{new_rate:>14,.0f}{new_rate / old_rate:>9.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
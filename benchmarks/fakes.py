@@ -0,0 +1,257 @@
+import argparse
+import asyncio
+import random
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+
+class Counters:
+    def __init__(self):
+        self.received = 0
+        self.failed = 0
+
+
+def graph_app(latency: float = 0.0, error_rate: float = 0.0) -> FastAPI:
+    # Stand-in for graph.facebook.com covering the endpoints the service calls
+    app = FastAPI()
+    app.state.counters = Counters()
+
+    async def respond(payload: dict):
+        if latency:
+            await asyncio.sleep(latency)
+        if random.random() < error_rate:
+            app.state.counters.failed += 1
+            return JSONResponse(
+                {
+                    "error": {
+                        "code": 130429,
+                        "message": "Rate limit hit",
+                        "type": "OAuthException",
+                        "fbtrace_id": uuid.uuid4().hex,
+                    }
+                },
+                status_code=429,
+            )
+        app.state.counters.received += 1
+        return payload
+
+    @app.post("/{version}/{business_number}/messages")
+    async def messages(version: str, business_number: str, request: Request):
+        body = await request.json()
+        return await respond(
+            {
+                "messaging_product": "whatsapp",
+                "contacts": [{"input": body.get("to"), "wa_id": body.get("to")}],
+                "messages": [{"id": f"wamid.{uuid.uuid4().hex}"}],
+            }
+        )
+
+    @app.post("/{version}/{business_number}/media")
+    async def upload_media(version: str, business_number: str):
+        return await respond({"id": uuid.uuid4().hex})
+
+    @app.get("/{version}/{media_id}/")
+    async def media_url(version: str, media_id: str, request: Request):
+        return await respond(
+            {
+                "url": f"{request.base_url}media/{media_id}",
+                "mime_type": "image/jpeg",
+                "id": media_id,
+            }
+        )
+
+    return app
+
+
+def rapidpro_app(latency: float = 0.0, error_rate: float = 0.0) -> FastAPI:
+    # Stand-in for the RapidPro channel /receive endpoint
+    app = FastAPI()
+    app.state.counters = Counters()
+
+    @app.api_route("/{channel_id}/receive", methods=["GET", "POST"])
+    async def receive(channel_id: str):
+        if latency:
+            await asyncio.sleep(latency)
+        if random.random() < error_rate:
+            app.state.counters.failed += 1
+            return PlainTextResponse("error", status_code=503)
+        app.state.counters.received += 1
+        return PlainTextResponse("SMS Accepted")
+
+    return app
+
+
+class FakeUrlChecker:
+    # In-process stand-in for a remote URL reputation service. URLs containing
+    # any of the markers are malicious; everything else is benign.
+    def __init__(self, markers=("malware", "phish"), latency: float = 0.0):
+        self.markers = markers
+        self.latency = latency
+        self.calls = 0
+        self.checked = 0
+
+    async def __call__(self, urls):
+        self.calls += 1
+        self.checked += len(urls)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return {
+            url: (
+                "malicious"
+                if any(marker in url for marker in self.markers)
+                else "benign"
+            )
+            for url in urls
+        }
+
+
+class FakeRedis:
+    # Redis protocol stand-in implementing just the commands the shared state
+    # backend uses, so the redis backend can be exercised without a server
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def _get(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return self.data.get(key)
+
+    def execute(self, command, args):
+        if command == b"PEXPIRE":
+            if self._get(args[0]) is None:
+                return 0
+            self.expires[args[0]] = time.monotonic() + int(args[1]) / 1000
+            return 1
+        if command == b"PING":
+            return b"+PONG"
+        if command in (b"CLIENT", b"SELECT"):
+            return b"+OK"
+        if command == b"GET":
+            return self._get(args[0])
+        if command == b"MGET":
+            return [self._get(key) for key in args]
+        if command == b"SET":
+            key, value, options = args[0], args[1], [a.upper() for a in args[2:]]
+            if b"NX" in options and self._get(key) is not None:
+                return None
+            self.data[key] = value
+            self.expires.pop(key, None)
+            if b"PX" in options:
+                ttl = int(args[2 + options.index(b"PX") + 1]) / 1000
+                self.expires[key] = time.monotonic() + ttl
+            return b"+OK"
+        if command in (b"INCR", b"INCRBY"):
+            value = int(self._get(args[0]) or 0) + int(args[1] if args[1:] else 1)
+            self.data[args[0]] = str(value).encode()
+            return value
+        if command == b"PTTL":
+            if self._get(args[0]) is None:
+                return -2
+            expires = self.expires.get(args[0])
+            return -1 if expires is None else int((expires - time.monotonic()) * 1000)
+        if command == b"DEL":
+            return sum(self.data.pop(key, None) is not None for key in args)
+        return b"-ERR unknown command"
+
+    @staticmethod
+    def encode(reply) -> bytes:
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, int):
+            return b":%d\r\n" % reply
+        if isinstance(reply, list):
+            return b"*%d\r\n" % len(reply) + b"".join(map(FakeRedis.encode, reply))
+        if reply[:1] in (b"+", b"-"):
+            return reply + b"\r\n"
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+
+    async def handle(self, reader, writer):
+        queued = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                parts = []
+                for _ in range(int(line[1:])):
+                    size = int((await reader.readline())[1:])
+                    parts.append((await reader.readexactly(size + 2))[:-2])
+                command, args = parts[0].upper(), parts[1:]
+                # Commands run one at a time anyway, so a transaction only
+                # has to queue its commands and answer them together
+                if command == b"MULTI":
+                    queued = []
+                    reply = b"+OK"
+                elif command == b"EXEC":
+                    reply = [self.execute(*queued_command) for queued_command in queued]
+                    queued = None
+                elif queued is not None:
+                    queued.append((command, args))
+                    reply = b"+QUEUED"
+                else:
+                    reply = self.execute(command, args)
+                writer.write(self.encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve_redis(port: int = 0) -> asyncio.AbstractServer:
+    return await asyncio.start_server(FakeRedis().handle, "127.0.0.1", port)
+
+
+async def serve(app: FastAPI, port: int = 0) -> uvicorn.Server:
+    config = uvicorn.Config(
+        app, host="127.0.0.1", port=port, log_level="warning", lifespan="off"
+    )
+    server = uvicorn.Server(config)
+    app.state.task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server
+
+
+def server_url(server: uvicorn.Server) -> str:
+    host, port = server.servers[0].sockets[0].getsockname()[:2]
+    return f"http://{host}:{port}"
+
+
+async def main(args):
+    graph = await serve(graph_app(args.latency, args.error_rate), args.graph_port)
+    rapidpro = await serve(
+        rapidpro_app(args.latency, args.error_rate), args.rapidpro_port
+    )
+    print(f"GRAPH_API_URL={server_url(graph)}", flush=True)
+    print(f"RAPID_PRO_URL={server_url(rapidpro)}", flush=True)
+    tasks = [graph.config.app.state.task, rapidpro.config.app.state.task]
+    if args.redis_port is not None:
+        redis = await serve_redis(args.redis_port)
+        host, port = redis.sockets[0].getsockname()[:2]
+        print(f"SHARED_STATE_URL=redis://{host}:{port}/0", flush=True)
+        tasks.append(redis.serve_forever())
+    await asyncio.gather(*tasks)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run local Graph API and RapidPro stand-ins"
+    )
+    parser.add_argument("--graph-port", type=int, default=9001)
+    parser.add_argument("--rapidpro-port", type=int, default=9002)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--redis-port",
+        type=int,
+        help="Also run the Redis protocol stand-in on this port (0 for any)",
+    )
+    asyncio.run(main(parser.parse_args()))
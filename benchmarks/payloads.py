@@ -0,0 +1,188 @@
+import itertools
+import random
+import time
+
+MESSAGE_KINDS = ("text", "interactive", "location", "order", "status")
+CALLBACK_KINDS = ("text", "interactive", "template", "image", "catalog", "location")
+
+_ids = itertools.count()
+
+
+def _next_id(prefix: str) -> str:
+    return f"{prefix}.{next(_ids):012d}"
+
+
+def _contact(wa_id: str) -> dict:
+    return {"wa_id": wa_id, "profile": {"name": f"Contact {wa_id[-4:]}"}}
+
+
+def message(kind: str, wa_id: str) -> dict:
+    message = {
+        "from": wa_id,
+        "id": _next_id("wamid"),
+        "timestamp": str(int(time.time())),
+        "type": kind,
+    }
+    if kind == "text":
+        message["text"] = {"body": random.choice(TEXTS)}
+    elif kind == "interactive":
+        message["interactive"] = {
+            "type": "list_reply",
+            "list_reply": {"id": f"option_{random.randint(1, 5)}", "title": "Option"},
+        }
+    elif kind == "location":
+        message["location"] = {
+            "latitude": -15.4 + random.random(),
+            "longitude": 28.3 + random.random(),
+            "name": "Lusaka",
+        }
+    elif kind == "order":
+        message["order"] = {
+            "catalog_id": "1845677735916982",
+            "text": "",
+            "product_items": [
+                {
+                    "product_retailer_id": "3ry85up32o",
+                    "quantity": random.randint(1, 3),
+                    "item_price": 120.0,
+                    "currency": "ZMW",
+                }
+            ],
+        }
+    return message
+
+
+def status(recipient_id: str) -> dict:
+    state = random.choice(("sent", "delivered", "read", "failed"))
+    status = {
+        "id": _next_id("wamid"),
+        "status": state,
+        "timestamp": str(int(time.time())),
+        "recipient_id": recipient_id,
+    }
+    if state == "failed":
+        # Failed statuses carry no conversation or pricing, only errors
+        status["errors"] = [
+            {
+                "code": 131047,
+                "title": "Re-engagement message",
+                "message": "Re-engagement message",
+                "error_data": {
+                    "details": "Message failed to send because more than 24 hours "
+                    "have passed since the customer last replied to this number."
+                },
+                "href": "https://developers.facebook.com/docs/whatsapp/cloud-api/support/error-codes/",
+            }
+        ]
+        return status
+    status["conversation"] = {
+        "id": _next_id("conv"),
+        "expiration_timestamp": str(int(time.time()) + 86400),
+        "origin": {"type": "service"},
+    }
+    status["pricing"] = {
+        "pricing_model": "CBP",
+        "billable": True,
+        "category": "service",
+    }
+    return status
+
+
+def webhook(
+    phone_number_id: str,
+    kinds=MESSAGE_KINDS,
+    messages_per_change: int = 1,
+    changes: int = 1,
+) -> dict:
+    change_list = []
+    for _ in range(changes):
+        wa_id = f"26097{random.randint(0, 9999999):07d}"
+        value = {
+            "messaging_product": "whatsapp",
+            "metadata": {
+                "display_phone_number": "260970000000",
+                "phone_number_id": phone_number_id,
+            },
+        }
+        picked = [random.choice(kinds) for _ in range(messages_per_change)]
+        messages = [message(kind, wa_id) for kind in picked if kind != "status"]
+        statuses = [status(wa_id) for kind in picked if kind == "status"]
+        if messages:
+            value["contacts"] = [_contact(wa_id)]
+            value["messages"] = messages
+        if statuses:
+            value["statuses"] = statuses
+        change_list.append({"field": "messages", "value": value})
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{"id": _next_id("waba"), "changes": change_list}],
+    }
+
+
+def callback_text(kind: str) -> str:
+    return CALLBACK_TEXTS[kind]
+
+
+def rapidpro_callback(kind: str, business_phone: str) -> dict:
+    to = f"26097{random.randint(0, 9999999):07d}"
+    return {
+        "id": _next_id("rp"),
+        "to": f"+{to}",
+        "to_no_plus": to,
+        "from": f"+{business_phone}",
+        "from_no_plus": business_phone,
+        "channel": "c07fae3b-38ff-4e61-bc74-29b38d13f056",
+        "text": callback_text(kind),
+    }
+
+
+TEXTS = (
+    "Hi",
+    "I would like to place an order",
+    "What are your opening hours?",
+    "Please call me back on 0977000000",
+    "Is https://example.com/offer safe?",
+)
+
+CALLBACK_TEXTS = {
+    "text": "Thank you, an agent will be with you shortly.",
+    "interactive": """type: interactive
+header: Main menu
+body: Please pick an option
+footer: Reply with a number
+button: Options
+sections:
+  - title: Services
+    rows:
+      - id: option_1
+        title: Loans
+        description: Apply for a loan
+      - id: option_2
+        title: Savings
+        description: Open a savings account
+      - id: option_3
+        title: Support
+        description: Talk to an agent
+""",
+    "template": """type: template
+header: Our products
+sections:
+  - title: Seeds
+    product_items:
+      - product_retailer_id: 3ry85up32o
+      - product_retailer_id: 9xk21ab11z
+""",
+    "image": """type: image
+caption: Your receipt
+media_id: "1234567890"
+""",
+    "catalog": """type: catalog
+body: Browse our catalog
+footer: Prices in ZMW
+catalog: "1845677735916982"
+product: 3ry85up32o
+""",
+    "location": """type: location
+body: Please share your location
+""",
+}
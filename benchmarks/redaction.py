@@ -0,0 +1,68 @@
+import argparse
+import random
+import statistics
+import sys
+import time
+
+from benchmarks import payloads
+from redaction import Redactor
+
+SENSITIVE_TEXTS = (
+    "My card is 4111 1111 1111 1111, please charge it",
+    "Email me at mwila.banda@example.co.zm",
+    "My NRC is 123456/78/1",
+    "Call +260 977 000000 after 5pm",
+)
+LONG_TEXT = (
+    "I would like to order 12 bags of fertilizer for my farm in Mkushi, "
+    "delivery to plot 4423 before the rains. "
+) * 20
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure the per-message overhead of inbound PII redaction"
+    )
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument(
+        "--budget-us",
+        type=float,
+        default=1000,
+        help="fail if p99 per-message overhead exceeds this many microseconds",
+    )
+    args = parser.parse_args(argv)
+    random.seed(0)
+
+    redactor = Redactor({"card", "phone", "email", "national_id"})
+    texts = [
+        random.choice(payloads.TEXTS + SENSITIVE_TEXTS + (LONG_TEXT,))
+        for _ in range(args.messages)
+    ]
+
+    samples = []
+    for text in texts:
+        start = time.perf_counter()
+        redactor.redact(text)
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    p99 = samples[int(len(samples) * 0.99) - 1]
+
+    start = time.perf_counter()
+    for i in range(0, len(texts), args.batch_size):
+        redactor.redact_many(texts[i : i + args.batch_size])
+    batch_us = (time.perf_counter() - start) * 1e6 / len(texts)
+
+    print(f"messages:        {len(texts)}")
+    print(f"single mean:     {statistics.fmean(samples):.1f}us")
+    print(f"single p50:      {samples[len(samples) // 2]:.1f}us")
+    print(f"single p99:      {p99:.1f}us")
+    print(f"single max:      {samples[-1]:.1f}us")
+    print(f"batch per msg:   {batch_us:.1f}us (batches of {args.batch_size})")
+    if p99 > args.budget_us:
+        print(f"p99 exceeds the {args.budget_us:.0f}us budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks import fakes, payloads
+
+
+def summarize(latencies, errors: int, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    cuts = (
+        statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    )
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(cuts[49] * 1000, 3),
+        "p95_ms": round(cuts[94] * 1000, 3),
+        "p99_ms": round(cuts[98] * 1000, 3),
+    }
+
+
+async def drive(client: httpx.AsyncClient, path: str, bodies, concurrency: int) -> dict:
+    latencies = []
+    errors = 0
+    pending = iter(bodies)
+
+    async def worker():
+        nonlocal errors
+        for body in pending:
+            start = time.perf_counter()
+            response = await client.post(
+                path, content=body, headers={"content-type": "application/json"}
+            )
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+def build_bodies(args, businesses):
+    webhook_kinds = args.message_kinds.split(",")
+    callback_kinds = args.callback_kinds.split(",")
+    webhooks = [
+        json.dumps(
+            payloads.webhook(
+                random.choice(businesses)["business_id"],
+                webhook_kinds,
+                messages_per_change=args.messages_per_change,
+                changes=args.changes,
+            )
+        ).encode()
+        for _ in range(args.requests)
+    ]
+    callbacks = [
+        json.dumps(
+            payloads.rapidpro_callback(
+                random.choice(callback_kinds),
+                random.choice(businesses)["phone_number"],
+            )
+        ).encode()
+        for _ in range(args.requests)
+    ]
+    return webhooks, callbacks
+
+
+def make_businesses(count: int):
+    return [
+        {
+            "Id": f"businesses/bench_{i}",
+            "name": f"Bench {i}",
+            "owner_id": "bench",
+            "business_id": f"10000000000{i:04d}",
+            "phone_number": f"26021{i:07d}",
+            "rapid_pro_channel": f"channel-{i}",
+            "subscription_plan": random.choice(("free", "standard", "premium")),
+        }
+        for i in range(count)
+    ]
+
+
+async def wait_for(predicate, timeout: float) -> float:
+    start = time.perf_counter()
+    while not predicate():
+        if time.perf_counter() - start > timeout:
+            break
+        await asyncio.sleep(0.01)
+    return time.perf_counter() - start
+
+
+async def run_in_process(args) -> dict:
+    graph = await fakes.serve(fakes.graph_app(args.graph_latency, args.error_rate))
+    rapidpro = await fakes.serve(
+        fakes.rapidpro_app(args.rapidpro_latency, args.error_rate)
+    )
+    workdir = tempfile.mkdtemp(prefix="rook-bench-")
+    # Module level settings are read at import, so configure before importing
+    os.environ.update(
+        {
+            "GRAPH_API_URL": fakes.server_url(graph),
+            "RAPID_PRO_URL": fakes.server_url(rapidpro),
+            "OUTBOUND_DB_PATH": os.path.join(workdir, "outbound.sqlite3"),
+            "OUTBOUND_RATE_PER_SECOND": str(args.send_rate),
+            "OUTBOUND_BURST": str(args.send_rate),
+            "DEDUP_DB_PATH": os.path.join(workdir, "dedup.sqlite3"),
+            "RAPIDPRO_SPOOL_PATH": os.path.join(workdir, "rapidpro_spool.jsonl"),
+            "BUSINESS_CACHE_TTL": "86400",
+        }
+    )
+    import delivery
+    import main
+    import sessions
+    from business_cache import business_cache
+    from message_handler import outbound_queue
+    from models.business import Business
+    from routes import webhook
+
+    # The benchmark drives only the webhook and callback paths
+    main.INTEGRATIONS = {}
+    delivery._save_records = lambda records: None
+    sessions._load_session = lambda key: None
+    sessions._store_sessions = lambda records: None
+    if not args.access_log:
+        logging.getLogger("access").disabled = True
+    businesses = make_businesses(args.businesses)
+    for data in businesses:
+        business = Business.model_validate(data)
+        business_cache.put("business_id", business.business_id, business)
+
+    webhooks, callbacks = build_bodies(args, businesses)
+    results = {}
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench"
+        ) as client:
+            results["webhook"] = await drive(
+                client, "/whatsapp/webhook", webhooks, args.concurrency
+            )
+            drained = await wait_for(
+                lambda: webhook.webhook_workers.depth() == 0, args.drain_timeout
+            )
+            await webhook.webhook_workers.join()
+            results["webhook"]["drain_seconds"] = round(drained, 3)
+            results["webhook"][
+                "forwarded"
+            ] = rapidpro.config.app.state.counters.received
+
+            results["callback"] = await drive(
+                client, "/rapidpro/callback", callbacks, args.concurrency
+            )
+            drained = await wait_for(
+                lambda: outbound_queue.depth() == 0, args.drain_timeout
+            )
+            results["callback"]["drain_seconds"] = round(drained, 3)
+            results["callback"]["sent"] = graph.config.app.state.counters.received
+
+    graph.should_exit = True
+    rapidpro.should_exit = True
+    return results
+
+
+async def run_remote(args) -> dict:
+    businesses = [
+        {"business_id": business_id, "phone_number": phone_number}
+        for business_id, phone_number in (
+            pair.split(":") for pair in args.business.split(",")
+        )
+    ]
+    webhooks, callbacks = build_bodies(args, businesses)
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits) as client:
+        return {
+            "webhook": await drive(
+                client, "/whatsapp/webhook", webhooks, args.concurrency
+            ),
+            "callback": await drive(
+                client, "/rapidpro/callback", callbacks, args.concurrency
+            ),
+        }
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    regressions = []
+    for endpoint, current in results.items():
+        previous = baseline.get(endpoint)
+        if not previous:
+            continue
+        if current["throughput"] < previous["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{endpoint} throughput {current['throughput']} < {previous['throughput']}"
+            )
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if current[key] > previous[key] * (1 + tolerance):
+                regressions.append(f"{endpoint} {key} {current[key]} > {previous[key]}")
+    return regressions
+
+
+def print_table(results: dict):
+    columns = ("requests", "errors", "throughput", "p50_ms", "p95_ms", "p99_ms")
+    print(f"{'endpoint':<10}" + "".join(f"{column:>12}" for column in columns))
+    for endpoint, result in results.items():
+        print(
+            f"{endpoint:<10}" + "".join(f"{result[column]:>12}" for column in columns)
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure /whatsapp/webhook and /rapidpro/callback throughput and latency"
+    )
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--businesses", type=int, default=5)
+    parser.add_argument("--changes", type=int, default=1)
+    parser.add_argument("--messages-per-change", type=int, default=1)
+    parser.add_argument("--message-kinds", default=",".join(payloads.MESSAGE_KINDS))
+    parser.add_argument("--callback-kinds", default=",".join(payloads.CALLBACK_KINDS))
+    parser.add_argument("--graph-latency", type=float, default=0.05)
+    parser.add_argument("--rapidpro-latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--send-rate", type=float, default=80)
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument(
+        "--url",
+        help="Benchmark an already running server instead of the in-process app",
+    )
+    parser.add_argument(
+        "--business",
+        default="100000000000000:260210000000",
+        help="phone_number_id:phone_number pairs registered on the remote server",
+    )
+    parser.add_argument("--access-log", action="store_true")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Compare against a previous --json result")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(0)
+    results = asyncio.run(run_remote(args) if args.url else run_in_process(args))
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks import payloads
+from benchmarks.run import build_bodies, drive, make_businesses
+
+
+def start_fakes(args) -> subprocess.Popen:
+    command = [
+        sys.executable,
+        "-m",
+        "benchmarks.fakes",
+        "--graph-port",
+        "0",
+        "--rapidpro-port",
+        "0",
+        "--latency",
+        str(args.latency),
+    ]
+    if args.backend == "redis":
+        command += ["--redis-port", "0"]
+    return subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+
+
+def read_fake_urls(fakes: subprocess.Popen, count: int) -> dict:
+    env = {}
+    while len(env) < count:
+        line = fakes.stdout.readline()
+        if not line:
+            raise RuntimeError("Fake servers exited before printing their urls")
+        key, _, value = line.strip().partition("=")
+        env[key] = value
+    return env
+
+
+def seed_businesses(businesses, backend):
+    # Workers find the businesses in the shared cache tier, so the benchmark
+    # needs no RavenDB
+    from business_cache import BusinessCache
+    from models.business import Business
+    from shared_state import SharedCache
+
+    cache = BusinessCache()
+    cache.shared = SharedCache(backend, "business")
+    for data in businesses:
+        business = Business.model_validate(data)
+        cache.put("business_id", business.business_id, business, generation=0)
+
+
+def build_backend(env: dict):
+    from shared_state import RedisBackend, SqliteBackend
+
+    if env["SHARED_STATE_BACKEND"] == "redis":
+        return RedisBackend(env["SHARED_STATE_URL"], env["SHARED_STATE_PREFIX"])
+    return SqliteBackend(env["SHARED_STATE_PATH"])
+
+
+async def wait_healthy(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=url) as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get("/health")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not become healthy")
+
+
+async def run_workers(args, workers: int, fake_env: dict, businesses, bodies) -> dict:
+    workdir = tempfile.mkdtemp(prefix=f"rook-workers-{workers}-")
+    port = args.port
+    env = dict(
+        os.environ,
+        **fake_env,
+        WORKERS=str(workers),
+        PORT=str(port),
+        HOST="127.0.0.1",
+        RELOAD="false",
+        SHARED_STATE_BACKEND=args.backend,
+        SHARED_STATE_PATH=os.path.join(workdir, "shared_state.sqlite3"),
+        SHARED_STATE_PREFIX=f"bench{workers}:",
+        OUTBOUND_DB_PATH=os.path.join(workdir, "outbound.sqlite3"),
+        OUTBOUND_RATE_PER_SECOND=str(args.send_rate),
+        SHEET_SPILL_PATH=os.path.join(workdir, "sheet_spill.jsonl"),
+        RAPIDPRO_SPOOL_PATH=os.path.join(workdir, "rapidpro_spool.jsonl"),
+        MEDIA_CACHE_DIR=os.path.join(workdir, "media"),
+        PROMETHEUS_MULTIPROC_DIR=os.path.join(workdir, "metrics"),
+        BUSINESS_CACHE_TTL="86400",
+        # Delivery records would go to RavenDB; keep them in memory here
+        STATUS_FLUSH_INTERVAL="86400",
+        STATUS_FLUSH_SIZE="100000000",
+        ACCESS_LOG_FILE=os.path.join(workdir, "access.log"),
+    )
+    seed_businesses(businesses, build_backend(env))
+
+    server = subprocess.Popen(
+        [sys.executable, "main.py"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        await wait_healthy(url)
+        webhooks, callbacks = bodies
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=url, limits=limits) as client:
+            return {
+                "webhook": await drive(
+                    client, "/whatsapp/webhook", webhooks, args.concurrency
+                ),
+                "callback": await drive(
+                    client, "/rapidpro/callback", callbacks, args.concurrency
+                ),
+            }
+    finally:
+        server.send_signal(signal.SIGINT)
+        try:
+            server.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+async def main(args):
+    counts = [int(count) for count in args.workers.split(",")]
+    businesses = make_businesses(args.businesses)
+    bodies = build_bodies(args, businesses)
+    fakes = start_fakes(args)
+    try:
+        fake_env = read_fake_urls(fakes, 3 if args.backend == "redis" else 2)
+        results = {}
+        for workers in counts:
+            results[workers] = await run_workers(
+                args, workers, fake_env, businesses, bodies
+            )
+    finally:
+        fakes.terminate()
+        fakes.wait()
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure throughput as the number of worker processes grows"
+    )
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--backend", choices=("sqlite", "redis"), default="sqlite")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--businesses", type=int, default=5)
+    parser.add_argument("--changes", type=int, default=1)
+    parser.add_argument("--messages-per-change", type=int, default=1)
+    parser.add_argument("--message-kinds", default=",".join(payloads.MESSAGE_KINDS))
+    parser.add_argument("--callback-kinds", default=",".join(payloads.CALLBACK_KINDS))
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--send-rate", type=float, default=1000)
+    parser.add_argument("--json", help="Write the results to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(0)
+    results = asyncio.run(main(args))
+    print(
+        f"{'workers':<10}{'endpoint':<10}{'throughput':>12}{'p50_ms':>10}"
+        f"{'p99_ms':>10}{'errors':>8}"
+    )
+    for workers, endpoints in results.items():
+        for endpoint, result in endpoints.items():
+            print(
+                f"{workers:<10}{endpoint:<10}{result['throughput']:>12}"
+                f"{result['p50_ms']:>10}{result['p99_ms']:>10}{result['errors']:>8}"
+            )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+from typing import Optional, Tuple
+
+from cachetools import TTLCache
+from dotenv import load_dotenv
+
+from models.business import Business
+from shared_state import SharedCache, get_backend
+
+load_dotenv()
+
+
+BUSINESS_CACHE_SIZE = int(os.getenv("BUSINESS_CACHE_SIZE", "1024"))
+BUSINESS_CACHE_TTL = float(os.getenv("BUSINESS_CACHE_TTL", "300"))
+BUSINESS_NEGATIVE_CACHE_SIZE = int(os.getenv("BUSINESS_NEGATIVE_CACHE_SIZE", "4096"))
+BUSINESS_NEGATIVE_CACHE_TTL = float(os.getenv("BUSINESS_NEGATIVE_CACHE_TTL", "60"))
+# With a shared backend, how stale this worker's view of another worker's
+# invalidate() may get before a lookup goes back to the shared tier
+BUSINESS_CACHE_CHECK_INTERVAL = float(os.getenv("BUSINESS_CACHE_CHECK_INTERVAL", "1"))
+
+LOOKUP_FIELDS = ("business_id", "phone_number")
+
+
+class BusinessCache:
+    def __init__(
+        self,
+        maxsize: int = BUSINESS_CACHE_SIZE,
+        ttl: float = BUSINESS_CACHE_TTL,
+        negative_maxsize: int = BUSINESS_NEGATIVE_CACHE_SIZE,
+        negative_ttl: float = BUSINESS_NEGATIVE_CACHE_TTL,
+        check_interval: float = BUSINESS_CACHE_CHECK_INTERVAL,
+    ):
+        self.found = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.missing = TTLCache(maxsize=negative_maxsize, ttl=negative_ttl)
+        self.lock = threading.Lock()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.check_interval = check_interval
+        self.shared: Optional[SharedCache] = None
+        # Shared generation the local entries belong to, and when it was read
+        self.generation: Optional[int] = None
+        self.checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+
+    def get(self, field: str, value: str) -> Tuple[bool, Optional[Business]]:
+        key = (field, value)
+        with self.lock:
+            if (
+                self.shared is not None
+                and time.monotonic() - self.checked_at > self.check_interval
+            ):
+                # Due to check the shared generation, which the caller does
+                # off the event loop on a miss
+                self.misses += 1
+                return False, None
+            business = self.found.get(key)
+            if business is not None:
+                self.hits += 1
+                return True, business
+            if key in self.missing:
+                self.negative_hits += 1
+                return True, None
+            self.misses += 1
+            return False, None
+
+    def peek(self, field: str, value: str) -> Optional[Business]:
+        # For callers that only want a business if it's already cached;
+        # doesn't count towards the hit and miss stats
+        with self.lock:
+            return self.found.get((field, value))
+
+    def _shared(self) -> Optional[SharedCache]:
+        # Second tier shared between workers, when a shared backend is set
+        if self.shared is None:
+            backend = get_backend()
+            if backend is not None:
+                self.shared = SharedCache(backend, "business")
+        return self.shared
+
+    def get_shared(
+        self, field: str, value: str
+    ) -> Tuple[bool, Optional[Business], Optional[int]]:
+        # Blocking; called from the database thread before querying RavenDB.
+        # The generation is None when there is no shared tier to check.
+        shared = self._shared()
+        if shared is None:
+            return False, None, None
+        found, raw, generation = shared.get(f"{field}:{value}")
+        self._observe_generation(generation)
+        if not found:
+            return False, None, generation
+        business = Business.model_validate_json(raw) if raw is not None else None
+        self.put(field, value, business)
+        return True, business, generation
+
+    def _observe_generation(self, generation: int):
+        # Another worker invalidated the cache since our entries were read
+        with self.lock:
+            if generation != self.generation:
+                self.found.clear()
+                self.missing.clear()
+                self.generation = generation
+            self.checked_at = time.monotonic()
+
+    def put(
+        self,
+        field: str,
+        value: str,
+        business: Optional[Business],
+        generation: Optional[int] = None,
+    ):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                # Read before an invalidate this worker has since seen
+                pass
+            elif business is None:
+                self.missing[(field, value)] = True
+            else:
+                # Warm every lookup field so a hit on one serves the others too
+                for lookup_field in LOOKUP_FIELDS:
+                    self.found[(lookup_field, getattr(business, lookup_field))] = (
+                        business
+                    )
+                self.found[(field, value)] = business
+        shared = self._shared() if generation is not None else None
+        if shared is None:
+            return
+        if business is None:
+            shared.put(f"{field}:{value}", None, self.negative_ttl, generation)
+            return
+        raw = business.model_dump_json().encode()
+        keys = {f"{f}:{getattr(business, f)}" for f in LOOKUP_FIELDS}
+        keys.add(f"{field}:{value}")
+        for key in keys:
+            shared.put(key, raw, self.ttl, generation)
+
+    def invalidate(self):
+        with self.lock:
+            self.found.clear()
+            self.missing.clear()
+        shared = self._shared()
+        if shared is not None:
+            self._observe_generation(shared.invalidate())
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "negative_hits": self.negative_hits,
+                "size": len(self.found),
+                "negative_size": len(self.missing),
+            }
+
+
+business_cache = BusinessCache()
@@ -0,0 +1,87 @@
+import time
+
+import metrics
+import utils
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    # Opens after failure_threshold consecutive failures and refuses calls
+    # until reset_timeout has passed. Then one probe call is let through:
+    # success closes it, failure reopens it with the timeout doubled up to
+    # max_reset_timeout.
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+        max_reset_timeout: float = 300,
+    ):
+        self.name = name
+        self.failure_threshold = max(failure_threshold, 1)
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max(max_reset_timeout, reset_timeout)
+        self.timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened = 0
+        self.probing = False
+        metrics.CIRCUIT_STATE.labels(name).set(STATE_VALUES[CLOSED])
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            utils.logger.warning(f"Circuit {self.name} {self.state} -> {state}")
+            self.state = state
+            metrics.CIRCUIT_STATE.labels(self.name).set(STATE_VALUES[state])
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and self.retry_in() == 0:
+            self._set_state(HALF_OPEN)
+            self.probing = False
+        if self.state == HALF_OPEN and not self.probing:
+            # The caller owns the probe and must report its outcome, or
+            # release() it if the call never happened
+            self.probing = True
+            return True
+        return False
+
+    def retry_in(self) -> float:
+        if self.state != OPEN:
+            return 0.0
+        return max(self.opened_at + self.timeout - time.monotonic(), 0.0)
+
+    def release(self):
+        self.probing = False
+
+    def record_success(self):
+        self.failures = 0
+        self.probing = False
+        self.timeout = self.reset_timeout
+        self._set_state(CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN:
+            self.timeout = min(self.timeout * 2, self.max_reset_timeout)
+        elif self.failures < self.failure_threshold:
+            return
+        self.probing = False
+        self.opened_at = time.monotonic()
+        if self.state != OPEN:
+            self.opened += 1
+        self._set_state(OPEN)
+
+    def as_dict(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.opened,
+            "retry_in_seconds": round(self.retry_in(), 3),
+        }
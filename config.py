@@ -1,4 +1,5 @@
 import os
+import threading
 from ravendb import DocumentStore
 from dotenv import load_dotenv
 
@@ -8,9 +9,29 @@ load_dotenv()
 RAVENDB_URL = os.getenv("RAVENDB_URL", "localhost:8888")
 RAVENDB_DB = os.getenv("RAVENDB_DB")
 
-store = DocumentStore([RAVENDB_URL], RAVENDB_DB)
-store.initialize()
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_document_store() -> DocumentStore:
+    # Initialized on first use (or from the app lifespan) rather than at import
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                store = DocumentStore([RAVENDB_URL], RAVENDB_DB)
+                store.initialize()
+                _store = store
+    return _store
+
+
+def close_store():
+    global _store
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+            _store = None
 
 
 def get_store():
-    return store.open_session()
+    return get_document_store().open_session()
@@ -0,0 +1,94 @@
+import asyncio
+import os
+import threading
+from typing import Iterable, List, Optional
+
+from cachetools import TTLCache
+from dotenv import load_dotenv
+
+from shared_state import (
+    SHARED_STATE_BACKEND,
+    RedisBackend,
+    SqliteBackend,
+    get_backend,
+)
+import metrics
+
+load_dotenv()
+
+
+DEDUP_TTL = float(os.getenv("DEDUP_TTL", "86400"))
+DEDUP_WINDOW_SIZE = int(os.getenv("DEDUP_WINDOW_SIZE", "100000"))
+# "memory" keeps the window per process; "sqlite" (through DEDUP_DB_PATH) and
+# "redis" also share it between workers. Follows SHARED_STATE_BACKEND unless
+# set.
+DEDUP_BACKEND = os.getenv("DEDUP_BACKEND", SHARED_STATE_BACKEND)
+DEDUP_DB_PATH = os.getenv("DEDUP_DB_PATH", "dedup.sqlite3")
+
+
+class MemoryDedupStore:
+    def __init__(self, maxsize: int = DEDUP_WINDOW_SIZE, ttl: float = DEDUP_TTL):
+        self.seen = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+
+    def add_many(self, keys: List[str]) -> List[bool]:
+        added = []
+        with self.lock:
+            for key in keys:
+                if key in self.seen:
+                    added.append(False)
+                else:
+                    self.seen[key] = True
+                    added.append(True)
+        return added
+
+
+class Deduplicator:
+    def __init__(self, local: MemoryDedupStore, shared=None, ttl: float = DEDUP_TTL):
+        self.local = local
+        self.shared = shared
+        self.ttl = ttl
+        self.suppressed = 0
+
+    async def check(self, keys: Iterable[str]) -> List[bool]:
+        # One flag per key: True when new, False when it is a duplicate
+        keys = list(keys)
+        if not keys:
+            return []
+        new = self.local.add_many(keys)
+        if self.shared is not None:
+            positions = [i for i, added in enumerate(new) if added]
+            if positions:
+                shared = await asyncio.to_thread(
+                    self.shared.add_many, [keys[i] for i in positions], self.ttl
+                )
+                for i, added in zip(positions, shared):
+                    new[i] = added
+        duplicates = new.count(False)
+        self.suppressed += duplicates
+        if duplicates:
+            metrics.DUPLICATES_SUPPRESSED.inc(duplicates)
+        return new
+
+
+def message_key(message_id: str) -> str:
+    return f"message:{message_id}"
+
+
+def status_key(status_id: str, status: str) -> str:
+    # A status id is the outbound message id, repeated for sent/delivered/read
+    return f"status:{status_id}:{status}"
+
+
+def build_deduplicator(backend: Optional[str] = DEDUP_BACKEND) -> Deduplicator:
+    shared = None
+    if backend == SHARED_STATE_BACKEND:
+        shared = get_backend()
+    elif backend == "sqlite":
+        shared = SqliteBackend(DEDUP_DB_PATH)
+    elif backend == "redis":
+        shared = RedisBackend()
+    return Deduplicator(MemoryDedupStore(), shared)
+
+
+deduplicator = build_deduplicator()
@@ -0,0 +1,260 @@
+import os
+from typing import Dict, Iterable, List
+
+from cachetools import TTLCache
+from dotenv import load_dotenv
+from ravendb.exceptions.raven_exceptions import ConcurrencyException
+
+from config import get_store
+from models.delivery import DeliveryRecord
+from models.webhook import Status
+from repository import run_in_db_thread
+from write_behind import WriteBehind
+import metrics
+
+load_dotenv()
+
+
+STATUS_FLUSH_INTERVAL = float(os.getenv("STATUS_FLUSH_INTERVAL", "5"))
+STATUS_FLUSH_SIZE = int(os.getenv("STATUS_FLUSH_SIZE", "500"))
+STATUS_MAX_BACKOFF = float(os.getenv("STATUS_MAX_BACKOFF", "300"))
+# Times a record another worker is writing at the same moment is reloaded and
+# merged again before it waits for the next flush
+STATUS_CONFLICT_RETRIES = int(os.getenv("STATUS_CONFLICT_RETRIES", "3"))
+# Records waiting for a flush are capped so a RavenDB outage can't grow memory
+# without bound; the oldest are dropped past this.
+STATUS_MAX_PENDING = int(os.getenv("STATUS_MAX_PENDING", "100000"))
+# Sent times are remembered this long to measure delivered/read latency after
+# the sent event has already been flushed
+STATUS_LATENCY_WINDOW = float(os.getenv("STATUS_LATENCY_WINDOW", str(24 * 3600)))
+STATUS_LATENCY_CACHE_SIZE = int(os.getenv("STATUS_LATENCY_CACHE_SIZE", "200000"))
+
+# Meta doesn't guarantee ordering; a record keeps the furthest status reached
+STATUS_RANK = {"sent": 1, "delivered": 2, "read": 3, "failed": 4}
+TIMESTAMP_FIELDS = {
+    "sent": "sent_at",
+    "delivered": "delivered_at",
+    "read": "read_at",
+    "failed": "failed_at",
+}
+# Fields the newest event wins on when merging with the stored document
+LATEST_FIELDS = (
+    "error_code",
+    "error_title",
+    "conversation_id",
+    "conversation_origin",
+    "conversation_expires_at",
+    "pricing_model",
+    "pricing_category",
+    "billable",
+)
+
+
+def record_id(message_id: str) -> str:
+    return f"deliveries/{message_id}"
+
+
+def merge_into(target: DeliveryRecord, update: DeliveryRecord) -> DeliveryRecord:
+    # In place, so records the session already tracks can be updated directly
+    if STATUS_RANK.get(update.status, 0) >= STATUS_RANK.get(target.status, 0):
+        target.status = update.status
+    for field in TIMESTAMP_FIELDS.values():
+        ours, theirs = getattr(target, field), getattr(update, field)
+        if theirs is not None and (ours is None or theirs < ours):
+            setattr(target, field, theirs)
+    for field in LATEST_FIELDS:
+        value = getattr(update, field)
+        if value is not None:
+            setattr(target, field, value)
+    return target
+
+
+class BusinessDeliveryStats:
+    def __init__(self):
+        self.counts: Dict[str, int] = {}
+        self.latency_sum: Dict[str, float] = {}
+        self.latency_count: Dict[str, int] = {}
+
+    def as_dict(self) -> dict:
+        sent = self.counts.get("sent", 0)
+        return {
+            "counts": dict(self.counts),
+            "failure_rate": self.counts.get("failed", 0) / sent if sent else 0.0,
+            "mean_latency_seconds": {
+                stage: self.latency_sum[stage] / self.latency_count[stage]
+                for stage in self.latency_sum
+            },
+        }
+
+
+class DeliveryTracker(WriteBehind):
+    def __init__(
+        self,
+        flush_interval: float = STATUS_FLUSH_INTERVAL,
+        flush_size: int = STATUS_FLUSH_SIZE,
+        max_pending: int = STATUS_MAX_PENDING,
+    ):
+        super().__init__(
+            "delivery-tracker", flush_interval, flush_size, STATUS_MAX_BACKOFF
+        )
+        self.max_pending = max_pending
+        # record id -> events coalesced since the last flush
+        self.pending: Dict[str, DeliveryRecord] = {}
+        self.sent_at = TTLCache(
+            maxsize=STATUS_LATENCY_CACHE_SIZE, ttl=STATUS_LATENCY_WINDOW
+        )
+        self.conversations = TTLCache(
+            maxsize=STATUS_LATENCY_CACHE_SIZE, ttl=STATUS_LATENCY_WINDOW
+        )
+        self.stats: Dict[str, BusinessDeliveryStats] = {}
+        self.dropped = 0
+
+    def add(self, statuses: List[Status], business_id: str):
+        for status in statuses:
+            self._apply(status, business_id)
+        if len(self.pending) >= self.flush_size:
+            self.full.set()
+
+    def _apply(self, status: Status, business_id: str):
+        timestamp = int(status.timestamp)
+        update = DeliveryRecord(
+            Id=record_id(status.id),
+            message_id=status.id,
+            business_id=business_id,
+            recipient_id=status.recipient_id,
+            status=status.status,
+        )
+        field = TIMESTAMP_FIELDS.get(status.status)
+        if field is not None:
+            setattr(update, field, timestamp)
+        if status.errors:
+            error = status.errors[0]
+            update.error_code = error.code
+            update.error_title = error.title or error.message
+        if status.conversation:
+            update.conversation_id = status.conversation.id
+            update.conversation_origin = status.conversation.origin.type
+            if status.conversation.expiration_timestamp:
+                update.conversation_expires_at = int(
+                    status.conversation.expiration_timestamp
+                )
+        if status.pricing:
+            update.pricing_model = status.pricing.pricing_model
+            update.pricing_category = status.pricing.category
+            update.billable = status.pricing.billable
+        self._observe(update, timestamp)
+
+        existing = self.pending.get(update.Id)
+        if existing is not None:
+            merge_into(existing, update)
+            return
+        if len(self.pending) >= self.max_pending:
+            del self.pending[next(iter(self.pending))]
+            self.dropped += 1
+        self.pending[update.Id] = update
+
+    def _observe(self, update: DeliveryRecord, timestamp: int):
+        business_id = update.business_id
+        stats = self.stats.setdefault(business_id, BusinessDeliveryStats())
+        stats.counts[update.status] = stats.counts.get(update.status, 0) + 1
+        metrics.DELIVERY_STATUSES.labels(business_id, update.status).inc()
+
+        if update.status == "sent":
+            self.sent_at[update.message_id] = timestamp
+        elif update.status in ("delivered", "read"):
+            sent = self.sent_at.get(update.message_id)
+            if sent is not None:
+                latency = max(timestamp - sent, 0)
+                stats.latency_sum[update.status] = (
+                    stats.latency_sum.get(update.status, 0.0) + latency
+                )
+                stats.latency_count[update.status] = (
+                    stats.latency_count.get(update.status, 0) + 1
+                )
+                metrics.DELIVERY_LATENCY_SECONDS.labels(
+                    business_id, update.status
+                ).observe(latency)
+
+        # Pricing repeats on every status of a message; count each
+        # conversation once
+        if update.conversation_id and update.conversation_id not in self.conversations:
+            self.conversations[update.conversation_id] = True
+            metrics.CONVERSATIONS.labels(
+                business_id,
+                update.conversation_origin or "unknown",
+                str(bool(update.billable)).lower(),
+            ).inc()
+
+    def business_stats(self, business_id: str) -> dict:
+        stats = self.stats.get(business_id)
+        return (stats or BusinessDeliveryStats()).as_dict()
+
+    async def _write(self) -> int:
+        if not self.pending:
+            return 0
+        batch = self.pending
+        self.pending = {}
+        try:
+            conflicted = await run_in_db_thread(_store_records, list(batch.values()))
+        except Exception:
+            self._requeue(batch.values())
+            raise
+        # Another worker kept writing these; they go out with the next flush
+        self._requeue(conflicted)
+        return len(batch) - len(conflicted)
+
+    def _requeue(self, records: Iterable[DeliveryRecord]):
+        # Folded back in under anything that arrived meanwhile
+        for record in records:
+            newer = self.pending.get(record.Id)
+            self.pending[record.Id] = merge_into(record, newer) if newer else record
+
+
+def _load_many(session, ids: List[str]) -> Dict[str, DeliveryRecord]:
+    # The client returns the entity itself rather than a dict for one id
+    loaded = session.load(ids, DeliveryRecord)
+    if loaded is None:
+        return {}
+    if not isinstance(loaded, dict):
+        return {ids[0]: loaded}
+    return {key: value for key, value in loaded.items() if value is not None}
+
+
+def _save_records(records: List[DeliveryRecord]):
+    # One load and one batched save regardless of batch size
+    with get_store() as session:
+        # Another worker may flush the same message; merging into what was
+        # loaded only saves if nobody wrote it since
+        session.advanced.use_optimistic_concurrency = True
+        stored = _load_many(session, [record.Id for record in records])
+        for record in records:
+            existing = stored.get(record.Id)
+            if existing is not None:
+                merge_into(existing, record)
+            else:
+                session.store(record, record.Id)
+        session.save_changes()
+
+
+def _store_records(records: List[DeliveryRecord]) -> List[DeliveryRecord]:
+    # Returns the records that still conflicted after STATUS_CONFLICT_RETRIES
+    try:
+        _save_records(records)
+        return []
+    except ConcurrencyException:
+        pass
+    # Only the conflicting records are retried, each against a fresh load
+    conflicted = []
+    for record in records:
+        for _ in range(STATUS_CONFLICT_RETRIES):
+            try:
+                _save_records([record])
+                break
+            except ConcurrencyException:
+                continue
+        else:
+            conflicted.append(record)
+    return conflicted
+
+
+delivery_tracker = DeliveryTracker()
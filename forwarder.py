@@ -0,0 +1,243 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+import httpx
+import orjson
+from dotenv import load_dotenv
+
+from circuit_breaker import CircuitBreaker
+from outbound import TokenBucket, is_retryable
+from spool import SlotSpool, SpoolEntry
+import metrics
+import utils
+
+load_dotenv()
+
+
+RAPIDPRO_BREAKER_FAILURES = int(os.getenv("RAPIDPRO_BREAKER_FAILURES", "5"))
+RAPIDPRO_BREAKER_RESET = float(os.getenv("RAPIDPRO_BREAKER_RESET", "30"))
+RAPIDPRO_BREAKER_MAX_RESET = float(os.getenv("RAPIDPRO_BREAKER_MAX_RESET", "300"))
+RAPIDPRO_SPOOL_PATH = os.getenv("RAPIDPRO_SPOOL_PATH", "rapidpro_spool.jsonl")
+# Each worker process appends to its own spool file, like the sheet spill
+RAPIDPRO_SPOOL_SLOTS = int(os.getenv("RAPIDPRO_SPOOL_SLOTS", "64"))
+# Spooled messages are replayed at most this many per second once RapidPro
+# is reachable again, so a backlog doesn't knock it straight back over
+RAPIDPRO_DRAIN_RATE = float(os.getenv("RAPIDPRO_DRAIN_RATE", "10"))
+# A spooled message RapidPro keeps answering with an error for is moved to
+# the dead letter file after this many tries, so it can't hold up everything
+# spooled behind it
+RAPIDPRO_SPOOL_MAX_ATTEMPTS = int(os.getenv("RAPIDPRO_SPOOL_MAX_ATTEMPTS", "5"))
+# How often the replay position is saved; a crash replays at most this many
+# seconds' worth of already delivered messages
+RAPIDPRO_SPOOL_COMMIT_INTERVAL = float(os.getenv("RAPIDPRO_SPOOL_COMMIT_INTERVAL", "1"))
+
+# Answers that mean RapidPro itself is unavailable rather than failing on
+# the message that was sent
+UNAVAILABLE_STATUSES = {429, 502, 503, 504}
+
+# (text, sender, channel_id)
+Sender = Callable[[str, str, str], Awaitable]
+
+
+def message_failed(error: Exception) -> bool:
+    return (
+        isinstance(error, httpx.HTTPStatusError)
+        and error.response.status_code not in UNAVAILABLE_STATUSES
+    )
+
+
+class RapidProForwarder:
+    # Forwards inbound messages to the RapidPro channel /receive endpoint
+    # behind a circuit breaker. While the breaker is open, or a channel still
+    # has spooled messages ahead of it, messages are appended to a local
+    # spool and replayed in order once RapidPro answers again.
+    def __init__(
+        self,
+        sender: Sender,
+        spool_path: str = RAPIDPRO_SPOOL_PATH,
+        drain_rate: float = RAPIDPRO_DRAIN_RATE,
+        breaker: Optional[CircuitBreaker] = None,
+        max_attempts: int = RAPIDPRO_SPOOL_MAX_ATTEMPTS,
+        commit_interval: float = RAPIDPRO_SPOOL_COMMIT_INTERVAL,
+    ):
+        self.sender = sender
+        self.spool = SlotSpool(spool_path, RAPIDPRO_SPOOL_SLOTS)
+        self.dead_letter_path = f"{spool_path}.dead"
+        self.max_attempts = max(max_attempts, 1)
+        self.commit_interval = commit_interval
+        # Guards the spool file and pending
+        self.file_lock = asyncio.Lock()
+        # Offset past the last entry handled but not yet saved
+        self.uncommitted: Optional[int] = None
+        self.committed_at = 0.0
+        self.breaker = breaker or CircuitBreaker(
+            "rapidpro",
+            RAPIDPRO_BREAKER_FAILURES,
+            RAPIDPRO_BREAKER_RESET,
+            RAPIDPRO_BREAKER_MAX_RESET,
+        )
+        self.bucket = TokenBucket(drain_rate, 1)
+        # Spooled entries in file order, each with the file offset just past it
+        self.pending: Deque[SpoolEntry] = deque()
+        # Failed tries of the entry at the head of the spool
+        self.attempts = 0
+        # channel -> number of its messages still in the spool
+        self.channels: Dict[str, int] = {}
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.forwarded = 0
+        self.spooled = 0
+        self.drained = 0
+        self.dropped = 0
+
+    async def forward(self, text: str, sender: str, channel_id: str):
+        # A channel with a backlog keeps spooling so nothing overtakes it
+        if self.channels.get(channel_id) or not self.breaker.allow():
+            await self._spool(channel_id, sender, text)
+            return
+        try:
+            await self.sender(text, sender, channel_id)
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+        except Exception as e:
+            if not is_retryable(e):
+                # RapidPro answered, it just refused this message
+                self.breaker.record_success()
+                raise
+            self.breaker.record_failure()
+            utils.logger.warning(
+                f"RapidPro unavailable, spooling message for {channel_id}: {e!r}"
+            )
+            await self._spool(channel_id, sender, text)
+            return
+        self.breaker.record_success()
+        self.forwarded += 1
+
+    async def _spool(self, channel_id: str, sender: str, text: str):
+        entry = {"channel": channel_id, "sender": sender, "text": text}
+        # Counted before the write so the channel's next message queues
+        # behind this one
+        self.channels[channel_id] = self.channels.get(channel_id, 0) + 1
+        try:
+            async with self.file_lock:
+                ends = await asyncio.to_thread(self.spool.append, [entry])
+                self.pending.append((ends[0], entry))
+        except BaseException:
+            self._release(channel_id)
+            raise
+        self.spooled += 1
+        metrics.RAPIDPRO_SPOOL.labels("spooled").inc()
+        self.wakeup.set()
+
+    def _release(self, channel: str):
+        self.channels[channel] -= 1
+        if not self.channels[channel]:
+            del self.channels[channel]
+
+    async def _commit(self, end: int, force: bool = False):
+        # Batched, so draining a backlog doesn't write the offset per message
+        self.uncommitted = end
+        now = time.monotonic()
+        if (
+            self.pending
+            and not force
+            and now - self.committed_at < self.commit_interval
+        ):
+            return
+        async with self.file_lock:
+            await asyncio.to_thread(self.spool.consume, end, not self.pending)
+        self.uncommitted = None
+        self.committed_at = now
+
+    async def start(self):
+        if self.spool.lock is None:
+            for end, entry in await asyncio.to_thread(self.spool.claim):
+                self.pending.append((end, entry))
+                channel = entry["channel"]
+                self.channels[channel] = self.channels.get(channel, 0) + 1
+        if self.task is None:
+            self.task = asyncio.create_task(self._drain(), name="rapidpro-drain")
+
+    async def stop(self):
+        # Whatever is still spooled is replayed on the next start
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.uncommitted is not None:
+            await self._commit(self.uncommitted, force=True)
+        self.spool.close()
+
+    async def _drain(self):
+        # One message at a time in spool order, which keeps every channel's
+        # messages in the order they arrived
+        while True:
+            if not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            if not self.breaker.allow():
+                await asyncio.sleep(self.breaker.retry_in() or 0.1)
+                continue
+            await self.bucket.acquire()
+            end, entry = self.pending[0]
+            try:
+                await self.sender(entry["text"], entry["sender"], entry["channel"])
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except Exception as e:
+                if is_retryable(e):
+                    self.breaker.record_failure()
+                    # RapidPro being unreachable isn't this message's fault
+                    if not message_failed(e):
+                        continue
+                    self.attempts += 1
+                    if self.attempts < self.max_attempts:
+                        continue
+                else:
+                    self.attempts += 1
+                    self.breaker.record_success()
+                await self._dead_letter(entry, e)
+            else:
+                self.breaker.record_success()
+                self.drained += 1
+                metrics.RAPIDPRO_SPOOL.labels("drained").inc()
+            self.attempts = 0
+            self.pending.popleft()
+            self._release(entry["channel"])
+            await self._commit(end)
+
+    async def _dead_letter(self, entry: dict, error: Exception):
+        self.dropped += 1
+        metrics.RAPIDPRO_SPOOL.labels("dropped").inc()
+        utils.logger.error(
+            f"Giving up on spooled message for {entry['channel']} after "
+            f"{self.attempts} tries: {error!r}"
+        )
+        await asyncio.to_thread(
+            _append_line, self.dead_letter_path, {**entry, "error": repr(error)}
+        )
+
+    def depth(self) -> int:
+        return len(self.pending)
+
+    def stats(self) -> dict:
+        return {
+            "breaker": self.breaker.as_dict(),
+            "spool_depth": len(self.pending),
+            "spooled_channels": len(self.channels),
+            "forwarded": self.forwarded,
+            "spooled": self.spooled,
+            "drained": self.drained,
+            "dropped": self.dropped,
+        }
+
+
+def _append_line(path: str, entry: dict):
+    with open(path, "ab") as f:
+        f.write(orjson.dumps(entry) + b"\n")
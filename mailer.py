@@ -0,0 +1,190 @@
+import asyncio
+import os
+import smtplib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+from models.rapidpro import RapidProEmailMessage
+import utils
+
+load_dotenv()
+
+
+SMTP_SERVER = os.getenv("SMTP_SERVER")
+SMTP_PORT = int(os.getenv("SMTP_PORT") or 587)
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "true").lower() == "true"
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30"))
+# Reused connections idle for longer than this are checked with NOOP first
+SMTP_IDLE_CHECK = float(os.getenv("SMTP_IDLE_CHECK", "60"))
+EMAIL_ADDRESS = os.getenv("EMAIL_ADDRESS")
+TO_EMAIL_ADDRESS = os.getenv("TO_EMAIL_ADDRESS")
+EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
+EMAIL_QUEUE_SIZE = int(os.getenv("EMAIL_QUEUE_SIZE", "1000"))
+# With a digest size above 1, up to that many results are sent as one email,
+# waiting at most EMAIL_DIGEST_INTERVAL seconds for the batch to fill.
+EMAIL_DIGEST_SIZE = int(os.getenv("EMAIL_DIGEST_SIZE", "1"))
+EMAIL_DIGEST_INTERVAL = float(os.getenv("EMAIL_DIGEST_INTERVAL", "60"))
+
+
+class Mailer:
+    def __init__(
+        self,
+        host: Optional[str] = SMTP_SERVER,
+        port: int = SMTP_PORT,
+        sender: Optional[str] = EMAIL_ADDRESS,
+        recipient: Optional[str] = TO_EMAIL_ADDRESS,
+        password: Optional[str] = EMAIL_PASSWORD,
+        starttls: bool = SMTP_STARTTLS,
+        digest_size: int = EMAIL_DIGEST_SIZE,
+        digest_interval: float = EMAIL_DIGEST_INTERVAL,
+        queue_size: int = EMAIL_QUEUE_SIZE,
+    ):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.recipient = recipient
+        self.password = password
+        self.starttls = starttls
+        self.digest_size = max(digest_size, 1)
+        self.digest_interval = digest_interval
+        self.queue_size = queue_size
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        self.stopping = False
+        # One thread owns the SMTP connection so it is never shared
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="smtp")
+        self.smtp: Optional[smtplib.SMTP] = None
+        self.last_used = 0.0
+        self.sent = 0
+        self.failed = 0
+
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def submit(self, message: RapidProEmailMessage) -> bool:
+        if self.queue is None or self.stopping:
+            return False
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def start(self):
+        if self.task is None:
+            self.stopping = False
+            self.queue = asyncio.Queue(maxsize=self.queue_size)
+            self.task = asyncio.create_task(self._run(), name="mailer")
+
+    async def stop(self, timeout: float = 30):
+        if self.task is None:
+            return
+        # The sentinel makes the worker send what it has queued and exit
+        self.stopping = True
+        await self.queue.put(None)
+        try:
+            await asyncio.wait_for(self.task, timeout=timeout)
+        except asyncio.TimeoutError:
+            utils.logger.error(f"Dropped {self.depth()} queued emails on shutdown")
+        self.task = None
+        self.queue = None
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._close)
+
+    async def _run(self):
+        while True:
+            message = await self.queue.get()
+            if message is None:
+                return
+            batch = [message]
+            deadline = time.monotonic() + self.digest_interval
+            while len(batch) < self.digest_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    message = await asyncio.wait_for(self.queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if message is None:
+                    await self._deliver(batch)
+                    return
+                batch.append(message)
+            await self._deliver(batch)
+
+    async def _deliver(self, batch: List[RapidProEmailMessage]):
+        email = self.build_email(batch)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, self._send, email)
+            self.sent += len(batch)
+        except Exception as e:
+            self.failed += len(batch)
+            utils.logger.error(f"Failed to send email: {e}")
+
+    def build_email(self, batch: List[RapidProEmailMessage]) -> MIMEMultipart:
+        msg = MIMEMultipart()
+        msg["From"] = self.sender
+        msg["To"] = self.recipient
+        if len(batch) == 1:
+            msg["Subject"] = "New RapidPro Message"
+            body = str(batch[0].results)
+        else:
+            msg["Subject"] = f"{len(batch)} new RapidPro Messages"
+            body = "\n\n".join(
+                f"{message.flow.name} - {message.contact.name} ({message.contact.urn})\n"
+                f"{message.results}"
+                for message in batch
+            )
+        msg.attach(MIMEText(body, "plain"))
+        return msg
+
+    def _connect(self) -> smtplib.SMTP:
+        smtp = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+        if self.starttls:
+            smtp.starttls()
+        if self.password:
+            smtp.login(self.sender, self.password)
+        return smtp
+
+    def _connection(self) -> smtplib.SMTP:
+        if (
+            self.smtp is not None
+            and time.monotonic() - self.last_used > SMTP_IDLE_CHECK
+        ):
+            try:
+                if self.smtp.noop()[0] != 250:
+                    self._close()
+            except smtplib.SMTPException:
+                self._close()
+        if self.smtp is None:
+            self.smtp = self._connect()
+        return self.smtp
+
+    def _send(self, email: MIMEMultipart):
+        try:
+            self._connection().sendmail(
+                self.sender, [self.recipient], email.as_string()
+            )
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # The server dropped a reused connection; reconnect once and retry
+            self._close()
+            self._connection().sendmail(
+                self.sender, [self.recipient], email.as_string()
+            )
+        self.last_used = time.monotonic()
+
+    def _close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self.smtp.close()
+            self.smtp = None
+
+
+mailer = Mailer()
@@ -1,17 +1,129 @@
+import asyncio
+import glob
+import os
+import random
+import time
+from contextlib import asynccontextmanager
 from typing import Union
 import uvicorn
 
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.exceptions import RequestValidationError
 from dotenv import load_dotenv
 from pydantic import ValidationError
 from routes import webhook, rapidpro, business
+import config
+import delivery
+import http_client
+import mailer
+import message_handler
+import metrics
+import repository
+import sessions
+import sheets
+import shared_state
+import url_safety
 import utils
 
 load_dotenv()
 
-app = FastAPI()
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+# Each worker is a separate process; set SHARED_STATE_BACKEND when running
+# more than one so dedup, caches and rate limits agree between them
+WORKERS = int(os.getenv("WORKERS", "1"))
+# Where workers write their metrics for /metrics to merge; only used with
+# more than one worker
+METRICS_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "prometheus_multiproc")
+RELOAD = os.getenv("RELOAD", "false").lower() == "true"
+# How long the startup warm-up waits on each integration
+INTEGRATION_INIT_TIMEOUT = float(os.getenv("INTEGRATION_INIT_TIMEOUT", "30"))
+
+INTEGRATIONS = {
+    "ravendb": config.get_document_store,
+    "google_sheets": sheets.get_sheet,
+}
+
+
+async def init_integration(app: FastAPI, name: str, init):
+    start = time.perf_counter()
+    try:
+        # The thread can't be interrupted, but the warm-up stops waiting on it
+        await asyncio.wait_for(asyncio.to_thread(init), INTEGRATION_INIT_TIMEOUT)
+        status = {"ok": True}
+    except asyncio.TimeoutError:
+        utils.logger.error(
+            f"Timed out initializing {name} after {INTEGRATION_INIT_TIMEOUT}s"
+        )
+        status = {"ok": False, "error": "timed out"}
+    except Exception as e:
+        # Each integration fails on its own; the rest of the service still boots
+        utils.logger.exception(f"Failed to initialize {name}")
+        status = {"ok": False, "error": str(e)}
+    status["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    app.state.integrations[name] = status
+
+
+async def warm_up(app: FastAPI):
+    await asyncio.gather(
+        *(init_integration(app, name, init) for name, init in INTEGRATIONS.items())
+    )
+    utils.logger.info(f"Integrations warmed up: {app.state.integrations}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start = time.perf_counter()
+    utils.start_access_log()
+    await metrics.start()
+    await http_client.start_client()
+    await webhook.webhook_workers.start()
+    await message_handler.outbound_queue.start()
+    await message_handler.rapidpro_forwarder.start()
+    await sheets.sheet_writer.start()
+    await delivery.delivery_tracker.start()
+    await sessions.session_store.start()
+    await mailer.mailer.start()
+    await url_safety.url_checker.start()
+    # Warmed in the background so a slow RavenDB or Google doesn't hold up
+    # serving; until then the first request that needs one initializes it
+    app.state.integrations = {name: {"ok": None} for name in INTEGRATIONS}
+    warm_up_task = asyncio.create_task(warm_up(app), name="warm-up")
+    app.state.startup_ms = round((time.perf_counter() - start) * 1000, 3)
+    utils.logger.info(f"Startup finished in {app.state.startup_ms}ms")
+    yield
+    warm_up_task.cancel()
+    await asyncio.gather(warm_up_task, return_exceptions=True)
+    await webhook.webhook_workers.stop()
+    await message_handler.outbound_queue.stop()
+    await message_handler.forward_lanes.stop()
+    await message_handler.rapidpro_forwarder.stop()
+    await message_handler.media_registry.stop()
+    await url_safety.url_checker.stop()
+    await sheets.sheet_writer.stop()
+    await delivery.delivery_tracker.stop()
+    await sessions.session_store.stop()
+    await mailer.mailer.stop()
+    await http_client.close_client()
+    repository.shutdown_executor()
+    config.close_store()
+    shared_state.close_backend()
+    await metrics.stop()
+    utils.stop_access_log()
+
+
+app = FastAPI(lifespan=lifespan)
+
+metrics.track_queue("webhook", webhook.webhook_workers.depth)
+metrics.track_queue("outbound", message_handler.outbound_queue.depth)
+metrics.track_queue("email", mailer.mailer.depth)
+metrics.track_queue("sheet", lambda: len(sheets.sheet_writer.pending))
+metrics.track_queue("delivery", lambda: len(delivery.delivery_tracker.pending))
+metrics.track_queue("session", lambda: len(sessions.session_store.dirty))
+metrics.track_queue("forward", message_handler.forward_lanes.depth)
+metrics.track_queue("rapidpro_spool", message_handler.rapidpro_forwarder.depth)
 
 
 async def http422_error_handler(
@@ -28,28 +140,66 @@ app.add_exception_handler(RequestValidationError, http422_error_handler)
 
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    # Print request method and URL
-    print(f"Incoming request: {request.method} {request.url}")
-    utils.logger.info(f"Incoming request: {request.method} {request.url}")
-
-    # Optionally, print headers or body
-    headers = dict(request.headers)
-    print(f"Headers: {headers}")
-    utils.logger.info(f"Headers: {headers}")
+    start = time.perf_counter()
+    record = {
+        "method": request.method,
+        "path": request.url.path,
+        "client": request.client.host if request.client else None,
+        "headers": {
+            name: request.headers[name]
+            for name in utils.ACCESS_LOG_HEADERS
+            if name in request.headers
+        },
+    }
+
+    # Only sampled requests pay for buffering the body
+    if utils.ACCESS_LOG_SAMPLE_RATE and random.random() < utils.ACCESS_LOG_SAMPLE_RATE:
+        body = await request.body()
+        record["body"] = body[: utils.ACCESS_LOG_MAX_BODY_BYTES].decode(
+            "utf-8", errors="replace"
+        )
+        record["body_truncated"] = len(body) > utils.ACCESS_LOG_MAX_BODY_BYTES
 
-    body = await request.body()
-    print(f"Body: {body.decode('utf-8') if body else 'No body'}")
-    utils.logger.info(f"Body: {body.decode('utf-8') if body else 'No body'}")
-
-    # Proceed with the request
     response = await call_next(request)
+    record["status"] = response.status_code
+    record["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    utils.access_logger.info(record)
     return response
 
 
+@app.get("/health")
+async def health():
+    return {
+        "startup_ms": getattr(app.state, "startup_ms", None),
+        "integrations": getattr(app.state, "integrations", {}),
+        "rapidpro": message_handler.rapidpro_forwarder.stats(),
+    }
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    content, media_type = metrics.render()
+    return Response(content, media_type=media_type)
+
+
 app.include_router(webhook.router)
 app.include_router(business.router)
 app.include_router(rapidpro.router)
 
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    if WORKERS > 1:
+        # Set before the workers import prometheus_client; files left by a
+        # previous run would be merged in as if they were live
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        for path in glob.glob(os.path.join(METRICS_DIR, "*.db")):
+            os.remove(path)
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = METRICS_DIR
+    # uvicorn can't reload with more than one worker
+    uvicorn.run(
+        "main:app",
+        host=HOST,
+        port=PORT,
+        workers=WORKERS,
+        reload=RELOAD and WORKERS == 1,
+    )
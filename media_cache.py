@@ -0,0 +1,200 @@
+import asyncio
+import base64
+import hashlib
+import os
+import uuid
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from dotenv import load_dotenv
+
+from http_client import get_client
+import utils
+
+load_dotenv()
+
+
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", "media_cache")
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(1024**3)))
+# WhatsApp caps documents at 100MB
+MEDIA_MAX_FILE_BYTES = int(os.getenv("MEDIA_MAX_FILE_BYTES", str(100 * 1024**2)))
+MEDIA_CHUNK_SIZE = int(os.getenv("MEDIA_CHUNK_SIZE", str(64 * 1024)))
+
+
+class MediaError(Exception):
+    pass
+
+
+class MediaTooLarge(MediaError):
+    pass
+
+
+class MediaIntegrityError(MediaError):
+    pass
+
+
+def _digest_matches(digest: bytes, expected: str) -> bool:
+    # Meta sends the checksum base64 encoded; accept hex as well
+    return expected in (digest.hex(), base64.b64encode(digest).decode())
+
+
+class MediaCache:
+    def __init__(
+        self,
+        resolve_url: Callable[[str], Awaitable[str]],
+        headers: Callable[[], dict],
+        directory: str = MEDIA_CACHE_DIR,
+        max_bytes: int = MEDIA_CACHE_MAX_BYTES,
+        max_file_bytes: int = MEDIA_MAX_FILE_BYTES,
+    ):
+        self.resolve_url = resolve_url
+        self.headers = headers
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        # hex sha256 -> size, least recently used first
+        self.entries: "OrderedDict[str, int]" = OrderedDict()
+        # Meta's checksum (or the media id when there is none) -> hex sha256
+        self.aliases: Dict[str, str] = {}
+        # hex sha256 -> the aliases pointing at it, dropped with the file
+        self.aliased: Dict[str, Set[str]] = {}
+        self.total_bytes = 0
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    def path_for(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith(".part"):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                found.append((stat.st_atime, name, stat.st_size))
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.total_bytes += size
+        self.loaded = True
+
+    def _lookup(self, key: str) -> Optional[str]:
+        digest = self.aliases.get(key, key)
+        if digest in self.entries:
+            self.entries.move_to_end(digest)
+            return self.path_for(digest)
+        return None
+
+    async def fetch(self, media_id: str, sha256: Optional[str] = None) -> str:
+        if not self.loaded:
+            await asyncio.to_thread(self._load)
+
+        key = sha256 or media_id
+        path = self._lookup(key)
+        if path is not None:
+            self.hits += 1
+            return path
+
+        # Concurrent requests for the same media share one download
+        future = self.inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            path = await self._download(media_id, sha256)
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark retrieved so an exception nobody else awaited isn't logged
+            future.exception()
+            raise
+        else:
+            future.set_result(path)
+            return path
+        finally:
+            del self.inflight[key]
+
+    async def _download(self, media_id: str, sha256: Optional[str]) -> str:
+        url = await self.resolve_url(media_id)
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = os.path.join(self.directory, f"{uuid.uuid4().hex}.part")
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            async with get_client().stream(
+                "GET", url, headers=self.headers()
+            ) as response:
+                response.raise_for_status()
+                length = response.headers.get("content-length")
+                if length is not None and int(length) > self.max_file_bytes:
+                    raise MediaTooLarge(f"{media_id} is {length} bytes")
+                f = await asyncio.to_thread(open, tmp_path, "wb")
+                try:
+                    async for chunk in response.aiter_bytes(MEDIA_CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > self.max_file_bytes:
+                            raise MediaTooLarge(
+                                f"{media_id} exceeds {self.max_file_bytes} bytes"
+                            )
+                        hasher.update(chunk)
+                        await asyncio.to_thread(f.write, chunk)
+                finally:
+                    await asyncio.to_thread(f.close)
+
+            digest = hasher.digest()
+            if sha256 and not _digest_matches(digest, sha256):
+                raise MediaIntegrityError(f"Checksum mismatch for {media_id}")
+            hex_digest = digest.hex()
+            path = self.path_for(hex_digest)
+            await asyncio.to_thread(self._place, tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if hex_digest not in self.entries:
+            self.entries[hex_digest] = size
+            self.total_bytes += size
+        self.entries.move_to_end(hex_digest)
+        self.aliases[sha256 or media_id] = hex_digest
+        self.aliased.setdefault(hex_digest, set()).add(sha256 or media_id)
+        # The bookkeeping stays on the loop; only the deletes go to a thread
+        evicted = self._evict(hex_digest)
+        if evicted:
+            await asyncio.to_thread(self._remove, evicted)
+        return path
+
+    def _place(self, tmp_path: str, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+
+    def _evict(self, keep: str) -> List[str]:
+        evicted = []
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            digest, size = next(iter(self.entries.items()))
+            if digest == keep:
+                break
+            del self.entries[digest]
+            self.total_bytes -= size
+            for key in self.aliased.pop(digest, ()):
+                if self.aliases.get(key) == digest:
+                    del self.aliases[key]
+            evicted.append(digest)
+            utils.logger.debug(f"Evicted media {digest} ({size} bytes)")
+        return evicted
+
+    def _remove(self, digests: List[str]):
+        for digest in digests:
+            if digest in self.entries:
+                # Downloaded again since it was evicted
+                continue
+            try:
+                os.remove(self.path_for(digest))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,205 @@
+import asyncio
+import ipaddress
+import mimetypes
+import os
+import socket
+import time
+from typing import Callable, Dict, NamedTuple, Optional, Set, Tuple
+from urllib.parse import urlsplit, urlunsplit
+
+from cachetools import LRUCache
+from dotenv import load_dotenv
+
+from http_client import get_client, graph_url
+import utils
+
+load_dotenv()
+
+
+# Graph keeps uploaded media for 30 days; ids are refreshed in the background
+# once they are within MEDIA_UPLOAD_REFRESH_MARGIN seconds of expiring.
+MEDIA_UPLOAD_TTL = float(os.getenv("MEDIA_UPLOAD_TTL", str(30 * 24 * 3600)))
+MEDIA_UPLOAD_REFRESH_MARGIN = float(
+    os.getenv("MEDIA_UPLOAD_REFRESH_MARGIN", str(24 * 3600))
+)
+# WhatsApp rejects images over 5MB
+MEDIA_UPLOAD_MAX_BYTES = int(os.getenv("MEDIA_UPLOAD_MAX_BYTES", str(5 * 1024**2)))
+MEDIA_REGISTRY_SIZE = int(os.getenv("MEDIA_REGISTRY_SIZE", "10000"))
+# Hosts reply definitions may upload images from. When set, only these are
+# fetched; otherwise any host that resolves to public addresses only
+MEDIA_UPLOAD_ALLOWED_HOSTS = {
+    host.strip().lower()
+    for host in os.getenv("MEDIA_UPLOAD_ALLOWED_HOSTS", "").split(",")
+    if host.strip()
+}
+
+
+class UploadedMedia(NamedTuple):
+    media_id: str
+    expires_at: float
+
+
+class MediaRegistry:
+    def __init__(
+        self,
+        headers: Callable[[], dict],
+        ttl: float = MEDIA_UPLOAD_TTL,
+        refresh_margin: float = MEDIA_UPLOAD_REFRESH_MARGIN,
+        max_bytes: int = MEDIA_UPLOAD_MAX_BYTES,
+        size: int = MEDIA_REGISTRY_SIZE,
+        allowed_hosts: Set[str] = MEDIA_UPLOAD_ALLOWED_HOSTS,
+    ):
+        self.headers = headers
+        self.allowed_hosts = allowed_hosts
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.max_bytes = max_bytes
+        # (business number, url or file path) -> uploaded media
+        self.uploads: LRUCache = LRUCache(maxsize=size)
+        self.inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.refreshing: Set[asyncio.Task] = set()
+        self.uploaded = 0
+        self.failed = 0
+
+    async def media_id_for(
+        self, business_number: str, source: str, local: bool = False
+    ) -> Optional[str]:
+        # None means the upload failed and the caller should fall back to a
+        # link. Sources are URLs unless the caller explicitly allows local
+        # files, so a reply definition can never make us upload one.
+        if not local and not source.startswith(("http://", "https://")):
+            return None
+        key = (business_number, source)
+        entry = self.uploads.get(key)
+        now = time.time()
+        if entry is not None and entry.expires_at > now:
+            if (
+                entry.expires_at - now < self.refresh_margin
+                and key not in self.inflight
+            ):
+                task = asyncio.create_task(self._refresh(key))
+                self.refreshing.add(task)
+                task.add_done_callback(self.refreshing.discard)
+            return entry.media_id
+        try:
+            return await self._upload_once(key)
+        except Exception as e:
+            utils.logger.warning(
+                f"Failed to upload {source} for {business_number}: {e}"
+            )
+            return None
+
+    async def _refresh(self, key: Tuple[str, str]):
+        try:
+            await self._upload_once(key)
+        except Exception as e:
+            # The current id stays valid until it expires; the next send retries
+            utils.logger.warning(f"Failed to refresh {key[1]} for {key[0]}: {e}")
+
+    async def _upload_once(self, key: Tuple[str, str]) -> str:
+        # Concurrent sends of the same image share one upload
+        future = self.inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            media_id = await self._upload(*key)
+        except BaseException as e:
+            self.failed += 1
+            future.set_exception(e)
+            future.exception()
+            raise
+        else:
+            self.uploads[key] = UploadedMedia(media_id, time.time() + self.ttl)
+            self.uploaded += 1
+            future.set_result(media_id)
+            return media_id
+        finally:
+            del self.inflight[key]
+
+    async def _read(self, source: str) -> Tuple[bytes, str]:
+        if not source.startswith(("http://", "https://")):
+            if os.path.getsize(source) > self.max_bytes:
+                raise ValueError(f"{source} is larger than {self.max_bytes} bytes")
+            content = await asyncio.to_thread(_read_file, source)
+            mime_type = mimetypes.guess_type(source)[0]
+            return content, mime_type or "application/octet-stream"
+
+        url, headers, extensions = await self._pin_host(source)
+        chunks = []
+        size = 0
+        # Redirects aren't followed, so the checked host is the one fetched
+        async with get_client().stream(
+            "GET",
+            url,
+            headers=headers,
+            extensions=extensions,
+            follow_redirects=False,
+        ) as response:
+            response.raise_for_status()
+            mime_type = response.headers.get("content-type", "").split(";")[0]
+            if not mime_type.strip().lower().startswith("image/"):
+                raise ValueError(f"{source} is not an image ({mime_type or 'no type'})")
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise ValueError(f"{source} is larger than {self.max_bytes} bytes")
+                chunks.append(chunk)
+        return b"".join(chunks), mime_type.strip().lower()
+
+    async def _pin_host(self, source: str) -> Tuple[str, dict, dict]:
+        # Media urls come from callback bodies, so they must not reach the
+        # metadata service, localhost or anything else on the private network.
+        # The fetch goes to the address checked here, with the original Host
+        # and SNI, so the name can't be re-resolved somewhere else in between.
+        parts = urlsplit(source)
+        host = (parts.hostname or "").lower()
+        if not host:
+            raise ValueError(f"{source} has no host")
+        if self.allowed_hosts:
+            if host not in self.allowed_hosts:
+                raise ValueError(f"{host} is not an allowed media host")
+            return source, {}, {}
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            host, port, type=socket.SOCK_STREAM
+        )
+        addresses = []
+        for *_, sockaddr in infos:
+            address = ipaddress.ip_address(sockaddr[0].split("%", 1)[0])
+            mapped = getattr(address, "ipv4_mapped", None)
+            if not address.is_global or (mapped is not None and not mapped.is_global):
+                raise ValueError(f"{host} resolves to non-public address {address}")
+            addresses.append(address)
+        if not addresses:
+            raise ValueError(f"{host} does not resolve")
+        address = addresses[0]
+        pinned = f"[{address}]" if address.version == 6 else str(address)
+        url = urlunsplit(
+            (parts.scheme, f"{pinned}:{port}", parts.path, parts.query, "")
+        )
+        host_header = host if parts.port is None else f"{host}:{parts.port}"
+        return url, {"Host": host_header}, {"sni_hostname": host}
+
+    async def _upload(self, business_number: str, source: str) -> str:
+        content, mime_type = await self._read(source)
+        filename = os.path.basename(source.split("?", 1)[0]) or "media"
+        response = await get_client().post(
+            graph_url(f"v19.0/{business_number}/media"),
+            headers=self.headers(),
+            data={"messaging_product": "whatsapp", "type": mime_type},
+            files={"file": (filename, content, mime_type)},
+        )
+        response.raise_for_status()
+        return response.json()["id"]
+
+    async def stop(self):
+        for task in list(self.refreshing):
+            task.cancel()
+        await asyncio.gather(*self.refreshing, return_exceptions=True)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
@@ -1,11 +1,23 @@
-import httpx
+import asyncio
 import os
 
 from dotenv import load_dotenv
-from typing import List
-from models.webhook import MetaData, WebhookMessage, Message
+from typing import Dict, List, Optional, Union
+from dedup import deduplicator, message_key, status_key
+from delivery import delivery_tracker
+from forwarder import RapidProForwarder
+from http_client import get_client, graph_url
+from media_cache import MediaCache
+from media_registry import MediaRegistry
+from outbound import OutboundQueue
+from redaction import redactor
+from sessions import session_store
+from url_safety import url_checker
+from workers import KeyedExecutor, Ticket
+from models.webhook import WebhookMessage, Message, Status, Value
 from models.whatsapp import ProductSection, Section
-
+import metrics
+import utils
 
 # from pangea_client import check_url, redact_message, scan_file
 
@@ -16,71 +28,250 @@ VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")
 GRAPH_API_TOKEN = os.getenv("GRAPH_API_TOKEN")
 BUSINESS_PHONE_ID = os.getenv("BUSINESS_PHONE_ID")
 RAPID_PRO_URL = os.getenv("RAPID_PRO_URL")
+# Kept short so a RapidPro outage trips the breaker instead of holding webhooks
+RAPIDPRO_TIMEOUT = float(os.getenv("RAPIDPRO_TIMEOUT", "5"))
+# Forwards to RapidPro run in order per (business, sender) and in parallel
+# across them, with at most FORWARD_MAX_INFLIGHT requests out at once
+FORWARD_MAX_INFLIGHT = int(os.getenv("FORWARD_MAX_INFLIGHT", "64"))
+FORWARD_LANE_IDLE_TIMEOUT = float(os.getenv("FORWARD_LANE_IDLE_TIMEOUT", "60"))
+
+
+def group_by_business(req: WebhookMessage) -> Dict[str, List[Value]]:
+    batches: Dict[str, List[Value]] = {}
+    for entry in req.entry:
+        for change in entry.changes:
+            value = change.value
+            batches.setdefault(value.metadata.phone_number_id, []).append(value)
+    return batches
+
+
+def reserve_forwards(business_number: str, values: List[Value]) -> List[Ticket]:
+    # Taken when the webhook arrives, before anything awaits, so a contact's
+    # messages reach RapidPro in the order Meta delivered them even when the
+    # batches carrying them are processed out of order
+    return [
+        forward_lanes.reserve((business_number, message.from_user))
+        for value in values
+        for message in value.messages or []
+    ]
+
+
+async def handle_whatsapp_message(
+    values: List[Value],
+    rapid_pro_channel: str,
+    tickets: Optional[List[Ticket]] = None,
+):
+    business_number = values[0].metadata.phone_number_id
+    if tickets is None:
+        tickets = reserve_forwards(business_number, values)
+    try:
+        await _handle_whatsapp_message(values, rapid_pro_channel, tickets)
+    finally:
+        # Anything not forwarded must not hold up the contact's lane
+        for ticket in tickets:
+            ticket.skip()
+
+
+async def _handle_whatsapp_message(
+    values: List[Value], rapid_pro_channel: str, tickets: List[Ticket]
+):
+    messages = [message for value in values for message in value.messages or []]
+    statuses = [status for value in values for status in value.statuses or []]
+    for value in values:
+        for error in value.errors or []:
+            metrics.WHATSAPP_ERRORS.labels("webhook", str(error.code)).inc()
+    for status in statuses:
+        for error in status.errors or []:
+            metrics.WHATSAPP_ERRORS.labels("status", str(error.code)).inc()
+
+    # Meta retries deliveries; acknowledge repeats without reprocessing them
+    new = await deduplicator.check(
+        [message_key(message.id) for message in messages]
+        + [status_key(status.id, status.status) for status in statuses]
+    )
+    statuses = [status for status, ok in zip(statuses, new[len(messages) :]) if ok]
+    forwards = []
+    for message, ticket, ok in zip(messages, tickets, new):
+        if ok:
+            forwards.append((message, ticket))
+        else:
+            ticket.skip()
+    messages = [message for message, _ in forwards]
+
+    # Redacted in one batch before anything leaves the service
+    texts = [message for message in messages if message.type == "text" and message.text]
+    redacted = redactor.redact_many([message.text.body for message in texts])
+    for message, body in zip(texts, redacted):
+        message.text.body = body
+
+    business_number = values[0].metadata.phone_number_id
+    if messages:
+        session_store.observe_messages(business_number, messages)
+        results = await asyncio.gather(
+            *(
+                ticket.run(forward_message, message, rapid_pro_channel)
+                for message, ticket in forwards
+            ),
+            warn_unsafe_urls(texts, business_number),
+            cache_media(messages),
+            return_exceptions=True,
+        )
+        for message, result in zip(messages, results):
+            if isinstance(result, Exception):
+                utils.logger.error(f"Failed to forward message {message.id}: {result}")
+        if isinstance(results[-2], Exception):
+            utils.logger.error(f"Failed to check urls: {results[-2]}")
+    if statuses:
+        handle_statuses(statuses, business_number)
+
+
+async def forward_message(message: Message, rapid_pro_channel: str):
+    match message.type:
+        case "text":
+            await send_to_rapid_pro(
+                message.text.body, message.from_user, rapid_pro_channel
+            )
+        case "interactive":
+            if message.interactive and message.interactive.list_reply:
+                await send_to_rapid_pro(
+                    message.interactive.list_reply.id,
+                    message.from_user,
+                    rapid_pro_channel,
+                )
 
 
-async def handle_whatsapp_message(req: WebhookMessage, rapid_pro_channel: str):
-    if not req.entry:
-        return
+async def warn_unsafe_urls(texts: List[Message], business_number: str):
+    # Every url in the batch is checked together; unsafe ones get a warning
+    unsafe = await url_checker.unsafe_urls([message.text.body for message in texts])
+    for message, urls in zip(texts, unsafe):
+        for url in urls:
+            await send_rapid_message(
+                message.from_user,
+                f"This is an automated message. This URL: {url} is malicious. "
+                "Kindly do not click on it and delete the message with it",
+                business_number,
+            )
+
+
+async def cache_media(messages: List[Message]):
+    # Images and documents are fetched once, while Meta's media url is fresh
+    media = [
+        message.image if message.type == "image" else message.document
+        for message in messages
+        if message.type in ("image", "document")
+    ]
+    media = [item for item in media if item is not None]
+    results = await asyncio.gather(
+        *(download_media(item.id, item.sha256) for item in media),
+        return_exceptions=True,
+    )
+    for item, result in zip(media, results):
+        if isinstance(result, Exception):
+            utils.logger.error(f"Failed to download media {item.id}: {result}")
 
-    if not req.entry[0].changes:
-        return
 
-    # pprint(message)
+def handle_statuses(statuses: List[Status], business_number: str):
+    delivery_tracker.add(statuses, business_number)
+    session_store.observe_statuses(business_number, statuses)
 
-    changes = req.entry[0].changes
-    change_field = changes[0].field
 
-    metadata = changes[0].value.metadata
-    contacts = changes[0].value.contacts
-    messages = changes[0].value.messages
-    # statuses = changes[0].value.statuses if changes[0].value.statuses else None
+async def post_to_rapid_pro(text: str, sender: str, channel_id: str):
+    # httpx encodes the params, so "&", "#" and "+" in the text survive
+    url = f"{RAPID_PRO_URL}/{channel_id}/receive"
+    with metrics.timer(metrics.RAPIDPRO_FORWARD_SECONDS, with_outcome=True):
+        response = await get_client().get(
+            url, params={"text": text, "sender": sender}, timeout=RAPIDPRO_TIMEOUT
+        )
+        response.raise_for_status()
 
-    if messages:
-        message = messages[0]
-        match message.type:
-            case "text":
-                await send_to_rapid_pro(
-                    message.text.body, message.from_user, rapid_pro_channel
-                )
-            case "interactive":
-                if message.interactive and message.interactive.list_reply:
-                    await send_to_rapid_pro(
-                        message.interactive.list_reply.id,
-                        message.from_user,
-                        rapid_pro_channel,
-                    )
-        # await handle_messages(messages, metadata)
-    # if statuses:
-    #    print("Handle status")
-    #    handle_statuses(statuses)
+
+# Inbound messages reach RapidPro through the breaker, or the spool while
+# RapidPro is down
+rapidpro_forwarder = RapidProForwarder(post_to_rapid_pro)
+forward_lanes = KeyedExecutor(
+    "forward", FORWARD_MAX_INFLIGHT, FORWARD_LANE_IDLE_TIMEOUT
+)
 
 
 async def send_to_rapid_pro(text: str, sender: str, channel_id: str):
-    url = f"{RAPID_PRO_URL}/{channel_id}/receive?text={text}&sender={sender}"
-    print("Rapid url", url)
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url)
-        print(response)
+    await rapidpro_forwarder.forward(text, sender, channel_id)
 
 
 async def get_media_url(media_id: str):
-    url = f"https://graph.facebook.com/v19.0/{media_id}/"
+    url = graph_url(f"v19.0/{media_id}/")
     headers = {"Authorization": f"Bearer {GRAPH_API_TOKEN}"}
-    media_url = ""
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers)
-        print(response)
-        print(response.json())
-        media_url = response.json()["url"]
+    response = await get_client().get(url, headers=headers)
+    response.raise_for_status()
+    media_url = response.json()["url"]
     return media_url
 
 
-async def download_media(url: str):
-    headers = {"Authorization": f"Bearer {GRAPH_API_TOKEN}"}
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers)
-        return response.content
-    return None
+def graph_headers() -> dict:
+    return {"Authorization": f"Bearer {GRAPH_API_TOKEN}"}
+
+
+media_cache = MediaCache(get_media_url, graph_headers)
+media_registry = MediaRegistry(graph_headers)
+
+
+async def download_media(media_id: str, sha256: Optional[str] = None) -> str:
+    # Streams into the content-addressed cache and returns the file path
+    return await media_cache.fetch(media_id, sha256)
+
+
+async def post_graph_message(
+    business_number, body: Union[bytes, str], message_type: str = "text"
+):
+    url = graph_url(f"v22.0/{business_number}/messages")
+    headers = {
+        "Authorization": f"Bearer {GRAPH_API_TOKEN}",
+        "Content-Type": "application/json",
+    }
+    with metrics.timer(
+        metrics.GRAPH_SEND_SECONDS, with_outcome=True, message_type=message_type
+    ):
+        response = await get_client().post(url, headers=headers, content=body)
+        if response.is_error:
+            count_graph_error(response)
+        response.raise_for_status()
+    return response
+
+
+def count_graph_error(response):
+    try:
+        code = response.json()["error"]["code"]
+    except Exception:
+        code = f"http_{response.status_code}"
+    metrics.WHATSAPP_ERRORS.labels("graph_send", str(code)).inc()
+
+
+# Every send_* helper goes through this queue so sends are rate limited per
+# business number, persisted across restarts and retried on throttling.
+outbound_queue = OutboundQueue(post_graph_message)
+
+
+async def enqueue_message(
+    business_number,
+    to_user,
+    message_data: Union[dict, bytes],
+    message_type: Optional[str] = None,
+) -> Optional[int]:
+    # Meta rejects free-form messages once the customer hasn't written for
+    # 24 hours; only templates can reopen the conversation. Checked against
+    # the local session instead of spending a Graph call to find out.
+    message_type = message_type or metrics.message_type(message_data)
+    if message_type != "template":
+        if await session_store.window_open(business_number, to_user) is False:
+            metrics.WINDOW_CLOSED.labels(business_number).inc()
+            utils.logger.warning(
+                f"Not sending {message_type} to {to_user}: 24 hour window closed"
+            )
+            return None
+    id_ = await outbound_queue.enqueue(
+        business_number, message_data, message_type, recipient=to_user
+    )
+    session_store.observe_outbound(business_number, to_user)
+    return id_
 
 
 async def send_message(business_number, message: Message, response_txt: str):
@@ -90,39 +281,28 @@ async def send_message(business_number, message: Message, response_txt: str):
         "text": {"body": response_txt},
         "context": {"message_id": message.id},
     }
-    url = f"https://graph.facebook.com/v22.0/{business_number}/messages"
-    headers = {"Authorization": f"Bearer {GRAPH_API_TOKEN}"}
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, json=message_data)
-        response.raise_for_status()
+    await enqueue_message(business_number, message.from_user, message_data)
 
 
-async def send_rapid_message(to_user, response_text, business_number):
-    message_data = {
+def build_text_payload(to_user, response_text):
+    return {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
         "to": to_user,
         "type": "text",
         "text": {"body": response_text},
     }
-    url = f"https://graph.facebook.com/v22.0/{business_number}/messages"
-    headers = {"Authorization": f"Bearer {GRAPH_API_TOKEN}"}
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, json=message_data)
-        response.raise_for_status()
 
 
-async def send_interactive_list(
-    to_user,
-    header_text,
-    text,
-    footer_text,
-    button_text,
-    sections: List[Section],
-    business_number,
-):
+async def send_rapid_message(to_user, response_text, business_number):
+    message_data = build_text_payload(to_user, response_text)
+    await enqueue_message(business_number, to_user, message_data)
 
-    message_data = {
+
+def build_interactive_list_payload(
+    to_user, header_text, text, footer_text, button_text, sections: List[Section]
+):
+    return {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
         "to": to_user,
@@ -139,22 +319,27 @@ async def send_interactive_list(
         },
     }
 
-    url = f"https://graph.facebook.com/v22.0/{business_number}/messages"
-    headers = {"Authorization": f"Bearer {GRAPH_API_TOKEN}"}
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, json=message_data)
-        response.raise_for_status()
 
-
-async def send_image_message(
-    to_user, business_number, caption, media_id=None, media_url=None
+async def send_interactive_list(
+    to_user,
+    header_text,
+    text,
+    footer_text,
+    button_text,
+    sections: List[Section],
+    business_number,
 ):
-    image = (
-        {"id": media_id, "caption": caption}
-        if media_id
-        else {"link": media_url, "caption": caption}
+    message_data = build_interactive_list_payload(
+        to_user, header_text, text, footer_text, button_text, sections
     )
-    message_data = {
+    await enqueue_message(business_number, to_user, message_data)
+
+
+def build_image_payload(to_user, caption, media_id=None, media_url=None):
+    image = {"id": media_id} if media_id else {"link": media_url}
+    if caption:
+        image["caption"] = caption
+    return {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
         "to": to_user,
@@ -162,40 +347,51 @@ async def send_image_message(
         "image": image,
     }
 
-    url = f"https://graph.facebook.com/v22.0/{business_number}/messages"
-    headers = {"Authorization": f"Bearer {GRAPH_API_TOKEN}"}
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, json=message_data)
-        response.raise_for_status()
-
 
-async def send_catalog_message(
-    to_user, text, footer_text, catalog_id="1845677735916982", product_id="3ry85up32o"
+async def send_image_message(
+    to_user, business_number, caption, media_id=None, media_url=None
 ):
-    message_data = {
+    if media_id is None and media_url:
+        # Upload once per business and reuse the id instead of making Meta
+        # refetch the link on every send
+        media_id = await media_registry.media_id_for(business_number, media_url)
+    message_data = build_image_payload(to_user, caption, media_id, media_url)
+    await enqueue_message(business_number, to_user, message_data)
+
+
+def build_catalog_payload(to_user, text, footer_text, catalog_id, product_id):
+    interactive = {
+        "type": "product",
+        "body": {"text": text},
+        "action": {"catalog_id": catalog_id, "product_retailer_id": product_id},
+    }
+    if footer_text:
+        interactive["footer"] = {"text": footer_text}
+    return {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
         "to": to_user,
         "type": "interactive",
-        "interactive": {
-            "type": "product",
-            "body": {"text": text},
-            "footer": {"text": footer_text},
-            "action": {"catalog_id": catalog_id, "product_retailer_id": product_id},
-        },
+        "interactive": interactive,
     }
 
-    url = f"https://graph.facebook.com/v22.0/{BUSINESS_PHONE_ID}/messages"
-    headers = {"Authorization": f"Bearer {GRAPH_API_TOKEN}"}
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, json=message_data)
-        response.raise_for_status()
 
-
-async def send_template_message(
-    to_user, header_text, sections: List[ProductSection], business_number
+async def send_catalog_message(
+    to_user,
+    text,
+    footer_text,
+    catalog_id="1845677735916982",
+    product_id="3ry85up32o",
+    business_number=BUSINESS_PHONE_ID,
 ):
-    message_data = {
+    message_data = build_catalog_payload(
+        to_user, text, footer_text, catalog_id, product_id
+    )
+    await enqueue_message(business_number, to_user, message_data)
+
+
+def build_template_payload(to_user, header_text, sections: List[ProductSection]):
+    return {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
         "to": to_user,
@@ -231,15 +427,16 @@ async def send_template_message(
         },
     }
 
-    url = f"https://graph.facebook.com/v22.0/{business_number}/messages"
-    headers = {"Authorization": f"Bearer {GRAPH_API_TOKEN}"}
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, json=message_data)
-        response.raise_for_status()
 
+async def send_template_message(
+    to_user, header_text, sections: List[ProductSection], business_number
+):
+    message_data = build_template_payload(to_user, header_text, sections)
+    await enqueue_message(business_number, to_user, message_data)
 
-async def send_location_request_message(to_user, text, business_number):
-    message_data = {
+
+def build_location_request_payload(to_user, text):
+    return {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
         "type": "interactive",
@@ -251,89 +448,20 @@ async def send_location_request_message(to_user, text, business_number):
         },
     }
 
-    url = f"https://graph.facebook.com/v22.0/{business_number}/messages"
-    headers = {"Authorization": f"Bearer {GRAPH_API_TOKEN}"}
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, json=message_data)
-        response.raise_for_status()
-
 
-async def handle_messages(messages: List[Message], metadata: MetaData):
-    message = messages[0]
-    if message.type == "text":
-        url = f"{RAPID_PRO_URL}/receive?text={message.text.body}&sender={message.from_user}"
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-    elif message.type == "reaction":
-        media_url = await get_media_url(message.image.id)
-        content = await download_media(media_url)
-    elif message.type == "image":
-        pass
-    elif message.type == "interactive":
-        url = f"{RAPID_PRO_URL}/receive?text={message.interactive.list_reply.id}&sender={message.from_user}"
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-    elif message.type == "location":
-        url = f"{RAPID_PRO_URL}/receive?text={message.location.latitude},{message.location.longitude}&sender={message.from_user}"
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-    elif message.type == "order":
-        url = f"{RAPID_PRO_URL}/receive?text=order_ {message.order.catalog_id}&sender={message.from_user}"
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-        # await send_message(
-        #    metadata.phone_number_id,
-        #    message,
-        #    "Your order has been placed. You will recieve a payment link shortly",
-        # )
-    else:
-        pass
-    # match message.type:
-    #     case "text":
-    #         print("text")
-    #         #            count, redacted_text = redact_message(message.text.body)
-    #         #            if count > 0:
-    #         url = f"http://rapid.boroma.site/c/ex/c07fae3b-38ff-4e61-bc74-29b38d13f056/receive?text={message.text.body}&sender={message.from_user}"
-    #         async with httpx.AsyncClient() as client:
-    #             response = await client.get(url)
-    #             print(response)
-    #         # await send_message(
-    #         #    metadata.phone_number_id,
-    #         #    message,
-    #         #    message.text.body,
-    #         # )
-    #     #            for url in urls:
-    #     #                verdict, score = check_url(url)
-    #     #                if verdict == "malicious":
-    #     #                    await send_message(
-    #     #                        metadata.phone_number_id,
-    #     #                        message,
-    #     #                        f"This is an automated message. This URL: {url} is malicious. Kindly do not click on it and delete the message with it",
-    #     #                    )
-
-    #     case "reaction":
-    #         print("reaction")
-    #     case "image":
-    #         media_url = await get_media_url(message.image.id)
-    #         content = await download_media(media_url)
-    #         # if content:
-    #         # poll_url = scan_file(content, f"{message.image.id}.jpeg")
-    #     case "document":
-    #         media_url_body = await get_media_url(message.image.id)
-    #         print(media_url_body)
-    #     case "sticker":
-    #         print("sticker")
-    #     case "unkown":
-    #         print("unkown")
-    #     case "button":
-    #         print("button")
-    #     case "list_reply":
-    #         print("list reply")
-    #     case "button_reply":
-    #         print("Button reply")
-    #     case _:
-    #         print("Other")
-
-
-# def handle_statuses(statuses: List[Status]):
-#     print(statuses)
+async def send_location_request_message(to_user, text, business_number):
+    message_data = build_location_request_payload(to_user, text)
+    await enqueue_message(business_number, to_user, message_data)
+
+
+async def send_compiled_message(to_user, compiled, business_number):
+    if compiled.image is not None:
+        return await send_image_message(
+            to_user,
+            business_number,
+            compiled.image.caption,
+            media_url=compiled.image.media_url,
+        )
+    await enqueue_message(
+        business_number, to_user, compiled.render(to_user), compiled.message_type
+    )
@@ -0,0 +1,186 @@
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Set by main.py when it starts more than one worker; every worker then
+# writes its samples under this directory and /metrics merges them
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+if MULTIPROCESS:
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+QUEUE_DEPTH_INTERVAL = float(os.getenv("QUEUE_DEPTH_INTERVAL", "5"))
+
+WEBHOOK_PARSE_SECONDS = Histogram(
+    "rook_webhook_parse_seconds",
+    "Time spent validating an incoming webhook body",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05),
+)
+WEBHOOK_REQUESTS = Counter(
+    "rook_webhook_requests_total", "Webhook deliveries by outcome", ["outcome"]
+)
+BUSINESS_LOOKUP_SECONDS = Histogram(
+    "rook_business_lookup_seconds",
+    "Business lookup time by cache result",
+    ["field", "result"],
+)
+RAPIDPRO_FORWARD_SECONDS = Histogram(
+    "rook_rapidpro_forward_seconds",
+    "Latency of forwarding an inbound message to RapidPro",
+    ["outcome"],
+)
+GRAPH_SEND_SECONDS = Histogram(
+    "rook_graph_send_seconds",
+    "Latency of Graph API message sends by message type",
+    ["message_type", "outcome"],
+)
+WHATSAPP_ERRORS = Counter(
+    "rook_whatsapp_errors_total",
+    "WhatsApp errors by Graph error code and where they were reported",
+    ["source", "code"],
+)
+DUPLICATES_SUPPRESSED = Counter(
+    "rook_duplicates_suppressed_total", "Webhook messages and statuses seen before"
+)
+PII_REDACTED = Counter(
+    "rook_pii_redacted_total", "Sensitive values redacted from inbound text", ["kind"]
+)
+URL_CHECKS = Counter(
+    "rook_url_checks_total",
+    "URL reputation verdicts by where they came from",
+    ["source", "verdict"],
+)
+DELIVERY_STATUSES = Counter(
+    "rook_delivery_statuses_total",
+    "WhatsApp delivery status callbacks by business",
+    ["business_id", "status"],
+)
+DELIVERY_LATENCY_SECONDS = Histogram(
+    "rook_delivery_latency_seconds",
+    "Time from sent to delivered or read, from Meta's timestamps",
+    ["business_id", "stage"],
+    buckets=(1, 2, 5, 10, 30, 60, 300, 900, 3600, 21600, 86400),
+)
+CONVERSATIONS = Counter(
+    "rook_conversations_total",
+    "WhatsApp conversations opened by origin and whether they are billable",
+    ["business_id", "origin", "billable"],
+)
+CIRCUIT_STATE = Gauge(
+    "rook_circuit_state",
+    "Circuit breaker state: 0 closed, 1 half open, 2 open",
+    ["circuit"],
+    multiprocess_mode="livemax",
+)
+RAPIDPRO_SPOOL = Counter(
+    "rook_rapidpro_spool_total",
+    "Inbound messages spooled while RapidPro was unavailable, and their fate",
+    ["event"],
+)
+SESSION_LOOKUPS = Counter(
+    "rook_session_lookups_total",
+    "Conversation session lookups by whether they were in memory",
+    ["result"],
+)
+WINDOW_CLOSED = Counter(
+    "rook_window_closed_total",
+    "Free-form sends held back because the 24 hour window had closed",
+    ["business_id"],
+)
+TENANT_QUEUE_WAIT_SECONDS = Histogram(
+    "rook_tenant_queue_wait_seconds",
+    "Time a business's work waited in a fair scheduler queue",
+    ["queue", "business_id"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+TENANT_REJECTED = Counter(
+    "rook_tenant_rejected_total",
+    "Work turned away because a business's queue was full",
+    ["queue", "business_id"],
+)
+QUEUE_DEPTH = Gauge(
+    "rook_queue_depth",
+    "Items waiting in a queue",
+    ["queue"],
+    multiprocess_mode="livesum",
+)
+
+_queues: Dict[str, Callable[[], int]] = {}
+_queue_task: Optional[asyncio.Task] = None
+
+
+@contextmanager
+def timer(histogram: Histogram, with_outcome: bool = False, **labels):
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        if with_outcome:
+            labels["outcome"] = outcome
+        observed = histogram.labels(**labels) if labels else histogram
+        observed.observe(time.perf_counter() - start)
+
+
+def track_queue(name: str, depth: Callable[[], int]):
+    # Callback gauges aren't collected across processes, so with several
+    # workers each one publishes its depths on an interval instead
+    if MULTIPROCESS:
+        _queues[name] = depth
+    else:
+        QUEUE_DEPTH.labels(name).set_function(depth)
+
+
+async def _publish_queue_depths():
+    while True:
+        for name, depth in _queues.items():
+            try:
+                QUEUE_DEPTH.labels(name).set(depth())
+            except Exception:
+                pass
+        await asyncio.sleep(QUEUE_DEPTH_INTERVAL)
+
+
+async def start():
+    global _queue_task
+    if MULTIPROCESS and _queue_task is None:
+        _queue_task = asyncio.create_task(_publish_queue_depths(), name="metrics")
+
+
+async def stop():
+    global _queue_task
+    if _queue_task is not None:
+        _queue_task.cancel()
+        await asyncio.gather(_queue_task, return_exceptions=True)
+        _queue_task = None
+    if MULTIPROCESS:
+        # Drops this worker's live gauges from the merged view
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def message_type(payload: dict) -> str:
+    kind = payload.get("type", "text")
+    if kind == "interactive":
+        return f"interactive_{payload['interactive']['type']}"
+    return kind
+
+
+def render():
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
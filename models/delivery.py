@@ -0,0 +1,22 @@
+from pydantic import BaseModel, Field
+from typing import Optional
+
+
+class DeliveryRecord(BaseModel):
+    Id: Optional[str] = Field(None)
+    message_id: str
+    business_id: str
+    recipient_id: str
+    status: str
+    sent_at: Optional[int] = Field(None)
+    delivered_at: Optional[int] = Field(None)
+    read_at: Optional[int] = Field(None)
+    failed_at: Optional[int] = Field(None)
+    error_code: Optional[int] = Field(None)
+    error_title: Optional[str] = Field(None)
+    conversation_id: Optional[str] = Field(None)
+    conversation_origin: Optional[str] = Field(None)
+    conversation_expires_at: Optional[int] = Field(None)
+    pricing_model: Optional[str] = Field(None)
+    pricing_category: Optional[str] = Field(None)
+    billable: Optional[bool] = Field(None)
@@ -1,5 +1,7 @@
-from typing import TypeVar
-from pydantic import BaseModel, Field
+from typing import Annotated, List, Literal, Optional, TypeVar, Union
+from pydantic import BaseModel, ConfigDict, Field, field_validator, model_validator
+
+from models.whatsapp import ProductSection, Section
 
 T = TypeVar("T")
 
@@ -34,3 +36,68 @@ class RapidProEmailMessage(BaseModel):
     contact: RapidContact
     flow: RapidFlow
     results: T
+
+
+class InteractiveReply(BaseModel):
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
+    type: Literal["interactive"]
+    header: Optional[str] = None
+    body: str
+    footer: Optional[str] = None
+    button: str
+    sections: List[Section]
+
+
+class TemplateReply(BaseModel):
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
+    type: Literal["template"]
+    header: Optional[str] = None
+    sections: List[ProductSection]
+
+
+class ImageReply(BaseModel):
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
+    type: Literal["image"]
+    caption: Optional[str] = None
+    media_id: Optional[str] = None
+    media_url: Optional[str] = None
+
+    @model_validator(mode="after")
+    def check_media(self):
+        if not self.media_id and not self.media_url:
+            raise ValueError("an image reply needs a media_id or a media_url")
+        return self
+
+
+class CatalogReply(BaseModel):
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
+    type: Literal["catalog"]
+    body: str
+    footer: Optional[str] = None
+    catalog: str
+    product: str
+
+    @field_validator("footer")
+    @classmethod
+    def blank_footer(cls, footer: Optional[str]) -> Optional[str]:
+        # Graph rejects an empty footer; leaving it out is fine
+        return footer if footer and footer.strip() else None
+
+
+class LocationReply(BaseModel):
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
+    type: Literal["location"]
+    body: str
+
+
+# Structured replies RapidPro flows send as YAML in the callback text
+REPLY_TYPES = {"interactive", "template", "image", "catalog", "location"}
+RapidProReply = Annotated[
+    Union[InteractiveReply, TemplateReply, ImageReply, CatalogReply, LocationReply],
+    Field(discriminator="type"),
+]
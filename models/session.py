@@ -0,0 +1,14 @@
+from pydantic import BaseModel, Field
+from typing import Any, Dict, Optional
+
+
+class ConversationSession(BaseModel):
+    Id: Optional[str] = Field(None)
+    business_id: str
+    wa_id: str
+    last_inbound_at: Optional[int] = Field(None)
+    last_outbound_at: Optional[int] = Field(None)
+    window_expires_at: Optional[int] = Field(None)
+    conversation_id: Optional[str] = Field(None)
+    conversation_origin: Optional[str] = Field(None)
+    flow_context: Dict[str, Any] = Field(default_factory=dict)
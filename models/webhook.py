@@ -12,6 +12,14 @@ class Image(BaseModel):
     id: str
 
 
+class Document(BaseModel):
+    mime_type: str
+    sha256: str
+    id: str
+    filename: Optional[str] = Field(None)
+    caption: Optional[str] = Field(None)
+
+
 class ListReply(BaseModel):
     id: str
     title: str
@@ -57,6 +65,7 @@ class Message(BaseModel):
     context: Optional[Context] = Field(None, description="Context")
     text: Optional[Text] = Field(None, description="Message text")
     image: Optional[Image] = Field(None, description="Message image")
+    document: Optional[Document] = Field(None, description="Message document")
     interactive: Optional[Interactive] = Field(None, description="Interactive object")
     location: Optional[Location] = Field(None, description="Location object")
     order: Optional[Order] = Field(None, description="Order object")
@@ -72,18 +81,27 @@ class Contact(BaseModel):
 
 
 class ErrorData(BaseModel):
-    messaging_product: str
-    details: str
+    messaging_product: Optional[str] = Field(None)
+    details: Optional[str] = Field(None)
 
 
 class WhatsappError(BaseModel):
     code: int
-    details: str
-    fbtrace_id: str
-    message: str
-    error_data: ErrorData
-    error_subcode: int
-    type: str
+    title: Optional[str] = Field(None)
+    message: Optional[str] = Field(None)
+    details: Optional[str] = Field(None)
+    fbtrace_id: Optional[str] = Field(None)
+    error_data: Optional[ErrorData] = Field(None)
+    error_subcode: Optional[int] = Field(None)
+    type: Optional[str] = Field(None)
+
+
+class StatusError(BaseModel):
+    code: int
+    title: Optional[str] = Field(None)
+    message: Optional[str] = Field(None)
+    error_data: Optional[ErrorData] = Field(None)
+    href: Optional[str] = Field(None)
 
 
 class MetaData(BaseModel):
@@ -116,7 +134,7 @@ class Status(BaseModel):
     recipient_id: str
     conversation: Optional[Conversation] = Field(None, description="Conversation")
     pricing: Optional[Pricing] = Field(None, description="Pricing")
-    errors: Optional[WhatsappError] = Field(None, description="Errors")
+    errors: Optional[List[StatusError]] = Field(None, description="List of errors")
 
 
 class Value(BaseModel):
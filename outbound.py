@@ -0,0 +1,430 @@
+import asyncio
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+import httpx
+import orjson
+from dotenv import load_dotenv
+
+from scheduler import FairScheduler
+from shared_state import SharedRateLimiter, get_backend
+import metrics
+import utils
+
+load_dotenv()
+
+
+OUTBOUND_DB_PATH = os.getenv("OUTBOUND_DB_PATH", "outbound.sqlite3")
+OUTBOUND_RATE_PER_SECOND = float(os.getenv("OUTBOUND_RATE_PER_SECOND", "20"))
+OUTBOUND_BURST = int(os.getenv("OUTBOUND_BURST", "20"))
+OUTBOUND_CONCURRENCY = int(os.getenv("OUTBOUND_CONCURRENCY", "16"))
+OUTBOUND_MAX_ATTEMPTS = int(os.getenv("OUTBOUND_MAX_ATTEMPTS", "8"))
+OUTBOUND_BACKOFF_BASE = float(os.getenv("OUTBOUND_BACKOFF_BASE", "1"))
+OUTBOUND_BACKOFF_MAX = float(os.getenv("OUTBOUND_BACKOFF_MAX", "300"))
+OUTBOUND_POLL_INTERVAL = float(os.getenv("OUTBOUND_POLL_INTERVAL", "1"))
+OUTBOUND_DRAIN_TIMEOUT = float(os.getenv("OUTBOUND_DRAIN_TIMEOUT", "10"))
+# Claimed rows are hidden from other workers this long; a worker that dies
+# mid-send leaves them to be picked up again after the lease runs out
+OUTBOUND_CLAIM_LEASE = float(os.getenv("OUTBOUND_CLAIM_LEASE", "120"))
+# Claimed sends wait in a fair queue per business; these cap how many one
+# business can have waiting and sending at once
+OUTBOUND_TENANT_QUEUE_SIZE = int(os.getenv("OUTBOUND_TENANT_QUEUE_SIZE", "16"))
+OUTBOUND_TENANT_INFLIGHT = int(
+    os.getenv("OUTBOUND_TENANT_INFLIGHT", str(max(OUTBOUND_CONCURRENCY // 2, 1)))
+)
+
+# Graph API error codes that mean "slow down / try again later"
+RETRYABLE_GRAPH_CODES = {1, 2, 4, 17, 341, 80007, 130429, 131000, 131048, 131056}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+class OutboundStore:
+    def __init__(self, path: str = OUTBOUND_DB_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbound (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                business_number TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                message_type TEXT NOT NULL DEFAULT 'text',
+                recipient TEXT NOT NULL DEFAULT '',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                last_error TEXT,
+                created_at REAL NOT NULL
+            )
+            """)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(outbound)")]
+        if "message_type" not in columns:
+            self.conn.execute(
+                "ALTER TABLE outbound ADD COLUMN message_type TEXT NOT NULL DEFAULT 'text'"
+            )
+        if "recipient" not in columns:
+            # Rows queued before this share one lane per business
+            self.conn.execute(
+                "ALTER TABLE outbound ADD COLUMN recipient TEXT NOT NULL DEFAULT ''"
+            )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS outbound_due ON outbound (status, next_attempt)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS outbound_recipient "
+            "ON outbound (status, business_number, recipient, id)"
+        )
+        self.conn.commit()
+
+    def add(
+        self,
+        business_number: str,
+        payload: Union[bytes, str],
+        message_type: str,
+        recipient: str = "",
+    ) -> int:
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO outbound (business_number, payload, message_type, "
+                "recipient, next_attempt, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (business_number, payload, message_type, recipient, now, now),
+            )
+            self.conn.commit()
+            return cursor.lastrowid
+
+    def claim(
+        self,
+        now: float,
+        limit: int,
+        per_business: int,
+        room: Optional[Dict[str, int]] = None,
+        lease: float = OUTBOUND_CLAIM_LEASE,
+    ) -> List[Tuple[int, str, str, str, int]]:
+        # Due rows are pushed out by the lease in the same statement that
+        # selects them, so workers sharing the file never send a row twice.
+        # Taking at most per_business rows from each business, or its entry
+        # in room when it has one, keeps one business's backlog from filling
+        # every claim. Only the oldest pending row of each recipient is
+        # claimable, so a contact's messages go out one at a time in the
+        # order they were queued, retries included.
+        room = room or {}
+        cap = "?"
+        if room:
+            cap = f"CASE business_number {'WHEN ? THEN ? ' * len(room)}ELSE ? END"
+        with self.lock:
+            rows = self.conn.execute(
+                "UPDATE outbound SET next_attempt = ? WHERE id IN ("
+                "SELECT id FROM ("
+                "SELECT id, business_number, next_attempt, ROW_NUMBER() OVER ("
+                "PARTITION BY business_number ORDER BY next_attempt, id) AS rank "
+                "FROM outbound AS o WHERE status = 'pending' AND next_attempt <= ? "
+                "AND id = (SELECT MIN(id) FROM outbound WHERE status = 'pending' "
+                "AND business_number = o.business_number AND recipient = o.recipient)"
+                f") WHERE rank <= {cap} ORDER BY next_attempt, id LIMIT ?) "
+                "RETURNING id, business_number, payload, message_type, attempts",
+                (
+                    now + lease,
+                    now,
+                    *(value for item in room.items() for value in item),
+                    per_business,
+                    limit,
+                ),
+            ).fetchall()
+            self.conn.commit()
+        return rows
+
+    def release(self, ids: List[int]):
+        with self.lock:
+            self.conn.executemany(
+                "UPDATE outbound SET next_attempt = ? WHERE id = ?",
+                [(time.time(), id_) for id_ in ids],
+            )
+            self.conn.commit()
+
+    def next_due(self) -> Optional[float]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT MIN(next_attempt) FROM outbound WHERE status = 'pending'"
+            ).fetchone()
+        return row[0]
+
+    def delete(self, id_: int):
+        with self.lock:
+            self.conn.execute("DELETE FROM outbound WHERE id = ?", (id_,))
+            self.conn.commit()
+
+    def reschedule(self, id_: int, attempts: int, next_attempt: float, error: str):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE outbound SET attempts = ?, next_attempt = ?, last_error = ? "
+                "WHERE id = ?",
+                (attempts, next_attempt, error, id_),
+            )
+            self.conn.commit()
+
+    def fail(self, id_: int, attempts: int, error: str):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE outbound SET status = 'failed', attempts = ?, last_error = ? "
+                "WHERE id = ?",
+                (attempts, error, id_),
+            )
+            self.conn.commit()
+
+    def pending_count(self) -> int:
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM outbound WHERE status = 'pending'"
+            ).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        response = error.response
+        if response.status_code == 429 or response.status_code >= 500:
+            return True
+        try:
+            code = response.json()["error"]["code"]
+        except Exception:
+            return False
+        return code in RETRYABLE_GRAPH_CODES
+    return False
+
+
+def backoff_delay(attempts: int) -> float:
+    # Exponential backoff with full jitter
+    ceiling = min(OUTBOUND_BACKOFF_MAX, OUTBOUND_BACKOFF_BASE * 2 ** (attempts - 1))
+    return random.uniform(0, ceiling)
+
+
+class OutboundQueue:
+    def __init__(
+        self,
+        sender: Callable[[str, Union[bytes, str], str], Awaitable],
+        path: str = OUTBOUND_DB_PATH,
+        rate: float = OUTBOUND_RATE_PER_SECOND,
+        burst: int = OUTBOUND_BURST,
+        concurrency: int = OUTBOUND_CONCURRENCY,
+        max_attempts: int = OUTBOUND_MAX_ATTEMPTS,
+    ):
+        self.sender = sender
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.store: Optional[OutboundStore] = None
+        self.buckets: Dict[str, Union[TokenBucket, SharedRateLimiter]] = {}
+        # Claimed ids waiting in or being sent by the scheduler
+        self.inflight: Set[int] = set()
+        self.scheduler = FairScheduler(
+            "outbound",
+            self._deliver,
+            concurrency=concurrency,
+            queue_size=concurrency * 4,
+            tenant_queue_size=OUTBOUND_TENANT_QUEUE_SIZE,
+            tenant_inflight=OUTBOUND_TENANT_INFLIGHT,
+        )
+        self.wakeup: Optional[asyncio.Event] = None
+        self.dispatcher: Optional[asyncio.Task] = None
+        # Pending rows as last counted by the dispatcher, kept current with
+        # this worker's own changes in between so depth() never hits SQLite
+        self.pending = 0
+        self.counted_at = 0.0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def get_store(self) -> OutboundStore:
+        if self.store is None:
+            self.store = OutboundStore(self.path)
+        return self.store
+
+    def bucket(self, business_number: str) -> Union[TokenBucket, SharedRateLimiter]:
+        bucket = self.buckets.get(business_number)
+        if bucket is None:
+            # With workers sharing state the limit holds across all of them
+            backend = get_backend()
+            bucket = self.buckets[business_number] = (
+                SharedRateLimiter(backend, f"outbound:{business_number}", self.rate)
+                if backend is not None
+                else TokenBucket(self.rate, self.burst)
+            )
+        return bucket
+
+    async def enqueue(
+        self,
+        business_number: str,
+        message_data: Union[dict, bytes, str],
+        message_type: Optional[str] = None,
+        recipient: str = "",
+    ) -> int:
+        # Payloads may arrive already serialized, e.g. from the callback compiler
+        if isinstance(message_data, dict):
+            message_type = message_type or metrics.message_type(message_data)
+            message_data = orjson.dumps(message_data)
+        id_ = await asyncio.to_thread(
+            self.get_store().add,
+            business_number,
+            message_data,
+            message_type or "text",
+            recipient.lstrip("+"),
+        )
+        self.pending += 1
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return id_
+
+    async def start(self):
+        if self.dispatcher is not None:
+            return
+        self.get_store()
+        await self.scheduler.start()
+        self.wakeup = asyncio.Event()
+        self.dispatcher = asyncio.create_task(
+            self._dispatch(), name="outbound-dispatcher"
+        )
+
+    async def stop(self, timeout: float = OUTBOUND_DRAIN_TIMEOUT):
+        if self.dispatcher is None:
+            return
+        self.dispatcher.cancel()
+        await asyncio.gather(self.dispatcher, return_exceptions=True)
+        self.dispatcher = None
+        self.scheduler.drain_timeout = timeout
+        await self.scheduler.stop()
+        if self.inflight:
+            # Unfinished sends stay pending in the store for the next start
+            await asyncio.to_thread(self.store.release, list(self.inflight))
+            self.inflight.clear()
+        self.store.close()
+        self.store = None
+
+    def depth(self) -> int:
+        return self.pending
+
+    async def _dispatch(self):
+        scheduler = self.scheduler
+        while True:
+            self.wakeup.clear()
+            if time.monotonic() - self.counted_at >= metrics.QUEUE_DEPTH_INTERVAL:
+                # Other workers add and send rows in the same file too
+                self.pending = await asyncio.to_thread(self.store.pending_count)
+                self.counted_at = time.monotonic()
+            room = scheduler.queue_size - scheduler.depth()
+            rows = []
+            if room > 0:
+                # Each business is claimed only as much as its fair queue has
+                # room for, so claimed rows are never turned away
+                free = {
+                    tenant: scheduler.tenant_queue_size - scheduler.tenant_depth(tenant)
+                    for tenant in scheduler.tenants
+                    if scheduler.tenant_depth(tenant)
+                }
+                rows = await asyncio.to_thread(
+                    self.store.claim,
+                    time.time(),
+                    room,
+                    scheduler.tenant_queue_size,
+                    free,
+                )
+            rejected = []
+            for row in rows:
+                if scheduler.submit(row[1], row):
+                    self.inflight.add(row[0])
+                else:
+                    rejected.append(row[0])
+            if rejected:
+                await asyncio.to_thread(self.store.release, rejected)
+            if len(rows) > len(rejected):
+                continue
+            timeout = OUTBOUND_POLL_INTERVAL
+            if room > 0:
+                next_due = await asyncio.to_thread(self.store.next_due)
+                if next_due is not None:
+                    timeout = min(timeout, max(next_due - time.time(), 0))
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, row: Tuple[int, str, Union[bytes, str], str, int]):
+        id_, business_number, payload, message_type, attempts = row
+        try:
+            await self.bucket(business_number).acquire()
+            attempts += 1
+            try:
+                await self.sender(business_number, payload, message_type)
+            except Exception as e:
+                await self._handle_failure(id_, attempts, e)
+            else:
+                self.sent += 1
+                await asyncio.to_thread(self.store.delete, id_)
+                self.pending = max(self.pending - 1, 0)
+        finally:
+            self.inflight.discard(id_)
+            # Claim again once the scheduler has drained to half, rather than
+            # running a claim query per finished send
+            if self.scheduler.depth() <= self.scheduler.queue_size // 2:
+                self.wakeup.set()
+
+    async def _handle_failure(self, id_: int, attempts: int, error: Exception):
+        message = repr(error)
+        if isinstance(error, httpx.HTTPStatusError):
+            message = f"{error.response.status_code} {error.response.text}"
+        if is_retryable(error) and attempts < self.max_attempts:
+            self.retried += 1
+            delay = backoff_delay(attempts)
+            utils.logger.warning(
+                f"Outbound message {id_} failed (attempt {attempts}), retrying in {delay:.1f}s: {message}"
+            )
+            await asyncio.to_thread(
+                self.store.reschedule, id_, attempts, time.time() + delay, message
+            )
+        else:
+            self.failed += 1
+            utils.logger.error(f"Outbound message {id_} failed permanently: {message}")
+            await asyncio.to_thread(self.store.fail, id_, attempts, message)
+            self.pending = max(self.pending - 1, 0)
@@ -0,0 +1,101 @@
+import os
+import re
+from typing import Dict, Iterable, List
+
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+
+# Flows collect NRCs, emails and phone numbers on purpose (see SHEET_COLUMNS),
+# so only card numbers are redacted unless more kinds are enabled here.
+REDACT_KINDS = {
+    kind.strip()
+    for kind in os.getenv("REDACT_KINDS", "card").split(",")
+    if kind.strip()
+}
+# Zambian NRC by default, e.g. 123456/78/1. Must start with a digit.
+NATIONAL_ID_PATTERN = os.getenv("NATIONAL_ID_PATTERN", r"\d{6}/\d{2}/\d")
+
+_DETECTORS = {
+    "email": r"(?<![\w.%+-])[\w.%+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*\.[A-Za-z]{2,}",
+    "national_id": rf"(?<![\w/]){NATIONAL_ID_PATTERN}(?![\w/])",
+    # 13-19 digits; shorter runs and Luhn failures are checked as phone numbers
+    "card": r"(?<![\w+])\d(?:[ -]?\d){12,18}(?!\w)",
+    "phone": r"(?<![\w+])\+?\d(?:[ -]?\d){8,14}(?!\w)",
+}
+_ALTERNATION = "|".join(
+    f"(?P<{kind}>{pattern})" for kind, pattern in _DETECTORS.items()
+)
+# Python's re tries every branch at every position. Numeric detectors are
+# gated on a digit or plus lookahead, and the email branch is only compiled
+# into the pattern used for texts containing "@", so most text is skipped at
+# close to the cost of a plain character scan.
+_PATTERN = re.compile(_ALTERNATION)
+_NUMERIC_PATTERN = re.compile(
+    "(?=[\\d+])(?:"
+    + "|".join(
+        f"(?P<{kind}>{pattern})"
+        for kind, pattern in _DETECTORS.items()
+        if kind != "email"
+    )
+    + ")"
+)
+_NON_DIGITS = re.compile(r"\D")
+
+
+def luhn_valid(digits: str) -> bool:
+    total = 0
+    for i, digit in enumerate(reversed(digits)):
+        n = ord(digit) - 48
+        if i % 2:
+            n *= 2
+            if n > 9:
+                n -= 9
+        total += n
+    return total % 10 == 0
+
+
+class Redactor:
+    def __init__(self, kinds: Iterable[str] = REDACT_KINDS):
+        self.kinds = set(kinds)
+        unknown = self.kinds - set(_DETECTORS)
+        if unknown:
+            raise ValueError(f"Unknown redaction kinds: {', '.join(sorted(unknown))}")
+
+    def _classify(self, match: re.Match) -> str:
+        kind = match.lastgroup
+        if kind == "card":
+            digits = _NON_DIGITS.sub("", match.group())
+            if luhn_valid(digits):
+                return kind
+            return "phone" if len(digits) <= 15 else ""
+        return kind
+
+    def redact_counts(self, text: str, counts: Dict[str, int]) -> str:
+        def replace(match: re.Match) -> str:
+            kind = self._classify(match)
+            if kind not in self.kinds:
+                return match.group()
+            counts[kind] = counts.get(kind, 0) + 1
+            return f"[{kind.upper()}]"
+
+        pattern = _PATTERN if "@" in text else _NUMERIC_PATTERN
+        return pattern.sub(replace, text)
+
+    def redact(self, text: str) -> str:
+        return self.redact_many([text])[0]
+
+    def redact_many(self, texts: List[str]) -> List[str]:
+        if not self.kinds:
+            return texts
+        counts: Dict[str, int] = {}
+        redacted = [self.redact_counts(text, counts) for text in texts]
+        for kind, count in counts.items():
+            metrics.PII_REDACTED.labels(kind).inc(count)
+        return redacted
+
+
+redactor = Redactor()
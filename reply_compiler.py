@@ -0,0 +1,114 @@
+import hashlib
+import os
+from typing import NamedTuple, Optional
+
+import orjson
+import yaml
+from cachetools import LRUCache
+from dotenv import load_dotenv
+from pydantic import TypeAdapter
+
+from message_handler import (
+    build_catalog_payload,
+    build_image_payload,
+    build_interactive_list_payload,
+    build_location_request_payload,
+    build_template_payload,
+)
+from models.rapidpro import (
+    CatalogReply,
+    REPLY_TYPES,
+    ImageReply,
+    InteractiveReply,
+    LocationReply,
+    RapidProReply,
+    TemplateReply,
+)
+import metrics
+
+load_dotenv()
+
+
+REPLY_CACHE_SIZE = int(os.getenv("REPLY_CACHE_SIZE", "512"))
+
+# Compiled payloads are serialized once with this stand-in as the recipient,
+# then split around it so each send only has to splice in the real number.
+_TO_PLACEHOLDER = "\x00to\x00"
+_ENCODED_PLACEHOLDER = orjson.dumps(_TO_PLACEHOLDER)
+_MISSING = object()
+
+reply_adapter = TypeAdapter(RapidProReply)
+
+
+class CompiledReply(NamedTuple):
+    message_type: str
+    prefix: bytes
+    suffix: bytes
+    # Linked images are sent through the media registry instead of the
+    # precompiled payload so the upload is reused per business
+    image: Optional[ImageReply] = None
+
+    def render(self, to_user: str) -> bytes:
+        return self.prefix + orjson.dumps(to_user) + self.suffix
+
+
+def is_structured(text: str) -> bool:
+    # Structured replies are YAML mappings with a type key; anything else is
+    # plain text and skips the YAML parser entirely.
+    return "type:" in text
+
+
+def build_payload(reply, to_user: str) -> dict:
+    match reply:
+        case InteractiveReply():
+            return build_interactive_list_payload(
+                to_user,
+                reply.header or "",
+                reply.body,
+                reply.footer or "",
+                reply.button,
+                reply.sections,
+            )
+        case TemplateReply():
+            return build_template_payload(to_user, reply.header or "", reply.sections)
+        case ImageReply():
+            return build_image_payload(
+                to_user, reply.caption, reply.media_id, reply.media_url
+            )
+        case CatalogReply():
+            return build_catalog_payload(
+                to_user, reply.body, reply.footer, reply.catalog, reply.product
+            )
+        case LocationReply():
+            return build_location_request_payload(to_user, reply.body)
+
+
+def _compile(text: str) -> Optional[CompiledReply]:
+    try:
+        data = yaml.safe_load(text)
+    except yaml.YAMLError:
+        return None
+    # Text that only looks like YAML, e.g. "Please type: YES to confirm",
+    # is a plain reply; a mapping naming a reply type must be valid
+    if not isinstance(data, dict) or data.get("type") not in REPLY_TYPES:
+        return None
+    reply = reply_adapter.validate_python(data)
+    payload = build_payload(reply, _TO_PLACEHOLDER)
+    prefix, suffix = orjson.dumps(payload).split(_ENCODED_PLACEHOLDER, 1)
+    image = reply if isinstance(reply, ImageReply) and not reply.media_id else None
+    return CompiledReply(metrics.message_type(payload), prefix, suffix, image)
+
+
+_cache = LRUCache(maxsize=REPLY_CACHE_SIZE)
+
+
+def compile_reply(text: str) -> Optional[CompiledReply]:
+    # None means the text should be sent as a plain text message. Invalid
+    # structured definitions raise pydantic.ValidationError and are not cached.
+    if not is_structured(text):
+        return None
+    key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+    compiled = _cache.get(key, _MISSING)
+    if compiled is _MISSING:
+        compiled = _cache[key] = _compile(text)
+    return compiled
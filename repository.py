@@ -0,0 +1,99 @@
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from dotenv import load_dotenv
+
+from business_cache import business_cache
+from config import get_store
+from models.business import Business
+import metrics
+
+load_dotenv()
+
+
+# The ravendb client is synchronous, so every call runs on this bounded pool
+# instead of the event loop.
+DB_THREADS = int(os.getenv("DB_THREADS", "8"))
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=DB_THREADS, thread_name_prefix="ravendb"
+        )
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+async def run_in_db_thread(fn: Callable, *args, **kwargs) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(fn, *args, **kwargs)
+    )
+
+
+def _query_business(field: str, value: str) -> Optional[Business]:
+    found, business, generation = business_cache.get_shared(field, value)
+    if found:
+        return business
+    with get_store() as session:
+        business = (
+            session.query(object_type=Business).where_equals(field, value).first()
+        )
+    business_cache.put(field, value, business, generation)
+    return business
+
+
+async def _get_business(field: str, value: str) -> Optional[Business]:
+    start = time.perf_counter()
+    found, business = business_cache.get(field, value)
+    if found:
+        result = "hit" if business is not None else "negative_hit"
+    else:
+        business = await run_in_db_thread(_query_business, field, value)
+        result = "miss"
+    metrics.BUSINESS_LOOKUP_SECONDS.labels(field, result).observe(
+        time.perf_counter() - start
+    )
+    return business
+
+
+async def get_business_by_phone_id(phone_number_id: str) -> Optional[Business]:
+    return await _get_business("business_id", phone_number_id)
+
+
+async def get_business_by_phone_number(phone_number: str) -> Optional[Business]:
+    return await _get_business("phone_number", phone_number)
+
+
+def _store_business(business: Business):
+    with get_store() as session:
+        session.store(business, business.Id)
+        session.save_changes()
+    business_cache.invalidate()
+
+
+async def save_business(business: Business):
+    await run_in_db_thread(_store_business, business)
+
+
+def _load_document(document_id: str):
+    with get_store() as session:
+        return session.load(document_id)
+
+
+async def load_document(document_id: str):
+    return await run_in_db_thread(_load_document, document_id)
@@ -1,14 +1,30 @@
 from fastapi import APIRouter
-from config import get_store
+from delivery import delivery_tracker
+from message_handler import outbound_queue
 from models.business import Business
+from repository import save_business
+from routes.webhook import webhook_workers
 
 router = APIRouter(prefix="/businesses", tags=["Businesses"])
 
 
 @router.post("/")
-def register_business(business: Business):
-    with get_store() as session:
-        business.Id = f"businesses/{business.name.lower().replace(' ', '_')}"
-        session.store(business, business.Id)
-        session.save_changes()
+async def register_business(business: Business):
+    business.Id = f"businesses/{business.name.lower().replace(' ', '_')}"
+    await save_business(business)
     return {"message": "Business registered", "business_id": business.Id}
+
+
+@router.get("/{business_id}/delivery")
+async def delivery_stats(business_id: str):
+    # business_id is the WhatsApp phone number id statuses are reported under
+    return delivery_tracker.business_stats(business_id)
+
+
+@router.get("/{business_id}/scheduling")
+async def scheduling_stats(business_id: str):
+    # Queue depth, in-flight work and wait times in each fair queue
+    return {
+        "webhook": webhook_workers.tenant_stats(business_id),
+        "outbound": outbound_queue.scheduler.tenant_stats(business_id),
+    }
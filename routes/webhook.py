@@ -1,48 +1,92 @@
-from typing import Union
-from fastapi import APIRouter, Query, Response
+import os
+from typing import List, Tuple, Union
+from fastapi import APIRouter, Query, Request, Response
 
-from config import get_store
-from message_handler import handle_whatsapp_message
-from models.business import Business
-from models.webhook import WebhookMessage
+from message_handler import (
+    group_by_business,
+    handle_whatsapp_message,
+    reserve_forwards,
+)
+from models.webhook import Value, WebhookMessage
+from repository import get_business_by_phone_id, load_document
+from scheduler import FairScheduler
+from workers import Ticket
+import metrics
+import utils
+
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "10"))
+# Per business, so one business's campaign can't fill the queue or every
+# worker; how often each is served depends on its subscription plan
+WEBHOOK_TENANT_QUEUE_SIZE = int(os.getenv("WEBHOOK_TENANT_QUEUE_SIZE", "200"))
+WEBHOOK_TENANT_INFLIGHT = int(
+    os.getenv("WEBHOOK_TENANT_INFLIGHT", str(max(WEBHOOK_WORKERS // 2, 1)))
+)
 
 
 router = APIRouter(prefix="/whatsapp", tags=["Webhooks"])
 
 
 @router.get("/webhook")
-def process_register_webhook(
+async def process_register_webhook(
     mode: Union[str, None] = Query(default=None, alias="hub.mode"),
     token: Union[str, None] = Query(default=None, alias="hub.verify_token"),
     challenge: Union[str, None] = Query(default=None, alias="hub.challenge"),
 ):
-    with get_store() as session:
-        settings = session.load("webhooks/kabolabs")
-        if mode == "subscribe" and token == settings.token:
-            return Response(challenge, status_code=200)
+    settings = await load_document("webhooks/kabolabs")
+    if mode == "subscribe" and token == settings.token:
+        return Response(challenge, status_code=200)
     return Response(status_code=403)
 
 
+async def handle_business_batch(batch: Tuple[str, List[Value], List[Ticket]]):
+    phone_number_id, values, tickets = batch
+    try:
+        user = await get_business_by_phone_id(phone_number_id)
+        if user is None:
+            utils.logger.warning(f"No business registered for {phone_number_id}")
+            return
+        await handle_whatsapp_message(values, user.rapid_pro_channel, tickets)
+    finally:
+        # Messages that weren't forwarded must not hold up their lanes
+        for ticket in tickets:
+            ticket.skip()
+
+
+webhook_workers = FairScheduler(
+    "webhook",
+    handle_business_batch,
+    concurrency=WEBHOOK_WORKERS,
+    queue_size=WEBHOOK_QUEUE_SIZE,
+    tenant_queue_size=WEBHOOK_TENANT_QUEUE_SIZE,
+    tenant_inflight=WEBHOOK_TENANT_INFLIGHT,
+    drain_timeout=WEBHOOK_DRAIN_TIMEOUT,
+)
+
+
 @router.post("/webhook")
-async def process_messages(message: WebhookMessage):
-    if not message.entry:
-        return
-
-    if not message.entry[0].changes:
-        return
-
-    changes = message.entry[0].changes
-    change_field = changes[0].field
-
-    metadata = changes[0].value.metadata
-    contacts = changes[0].value.contacts
-    messages = changes[0].value.messages
-    with get_store() as session:
-        user = (
-            session.query(object_type=Business)
-            .where_equals("business_id", changes[0].value.metadata.phone_number_id)
-            .first()
-        )
-        print(user)
-        await handle_whatsapp_message(message, user.rapid_pro_channel)
+async def process_messages(request: Request):
+    body = await request.body()
+    with metrics.timer(metrics.WEBHOOK_PARSE_SECONDS):
+        message = WebhookMessage.model_validate_json(body)
+
+    if not any(entry.changes for entry in message.entry):
+        metrics.WEBHOOK_REQUESTS.labels("empty").inc()
+        return Response(status_code=200)
+
+    accepted = []
+    for phone_number_id, values in group_by_business(message).items():
+        tickets = reserve_forwards(phone_number_id, values)
+        ok = webhook_workers.submit(phone_number_id, (phone_number_id, values, tickets))
+        if not ok:
+            for ticket in tickets:
+                ticket.skip()
+        accepted.append(ok)
+    if not all(accepted):
+        # Let Meta retry later rather than silently dropping the delivery;
+        # the parts already queued are deduplicated on the retry
+        metrics.WEBHOOK_REQUESTS.labels("rejected").inc()
+        return Response(status_code=503)
+    metrics.WEBHOOK_REQUESTS.labels("accepted").inc()
     return Response(status_code=200)
@@ -0,0 +1,235 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from business_cache import business_cache
+import metrics
+import utils
+
+load_dotenv()
+
+
+# Share of processing each plan gets relative to the others when tenants
+# compete; a tenant alone gets everything regardless of plan
+TENANT_PLAN_WEIGHTS = {
+    plan.strip(): float(weight)
+    for plan, weight in (
+        pair.split(":")
+        for pair in os.getenv(
+            "TENANT_PLAN_WEIGHTS", "free:1,standard:2,premium:4"
+        ).split(",")
+        if pair.strip()
+    )
+}
+TENANT_DEFAULT_WEIGHT = float(os.getenv("TENANT_DEFAULT_WEIGHT", "1"))
+
+
+def tenant_weight(business_id: str) -> float:
+    # From the cached business only, so scheduling never waits on RavenDB;
+    # a tenant not cached yet gets the default until its first lookup
+    business = business_cache.peek("business_id", business_id)
+    if business is None:
+        return TENANT_DEFAULT_WEIGHT
+    return TENANT_PLAN_WEIGHTS.get(business.subscription_plan, TENANT_DEFAULT_WEIGHT)
+
+
+class TenantQueue:
+    def __init__(self, tenant: str):
+        self.tenant = tenant
+        # (start tag, finish tag, enqueued at, item)
+        self.items: Deque[Tuple[float, float, float, Any]] = deque()
+        self.last_finish = 0.0
+        self.inflight = 0
+        self.scheduled = False
+        self.processed = 0
+        self.rejected = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "depth": len(self.items),
+            "inflight": self.inflight,
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "mean_wait_seconds": (
+                self.wait_sum / self.processed if self.processed else 0.0
+            ),
+            "max_wait_seconds": self.wait_max,
+        }
+
+
+class FairScheduler:
+    # Weighted fair queuing across tenants: one FIFO per tenant, and workers
+    # always take the queued item with the smallest virtual finish time, which
+    # advances by 1/weight per item. A tenant with weight 4 is served four
+    # times as often as one with weight 1 while both have work queued. Each
+    # tenant is also capped on queued items and on items being processed, so
+    # one busy tenant can't occupy every worker.
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[Any], Awaitable[None]],
+        concurrency: int = 8,
+        queue_size: int = 1000,
+        tenant_queue_size: int = 200,
+        tenant_inflight: Optional[int] = None,
+        weight: Callable[[str], float] = tenant_weight,
+        drain_timeout: float = 10.0,
+    ):
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.tenant_queue_size = tenant_queue_size
+        self.tenant_inflight = tenant_inflight or max(concurrency // 2, 1)
+        self.weight = weight
+        self.drain_timeout = drain_timeout
+        self.tenants: Dict[str, TenantQueue] = {}
+        # (finish tag of the tenant's head item, tiebreak, tenant) for each
+        # tenant that has work and room to run it
+        self.ready: List[Tuple[float, int, TenantQueue]] = []
+        self.counter = itertools.count()
+        self.virtual_time = 0.0
+        self.queued = 0
+        self.active = 0
+        self.wakeup: Optional[asyncio.Event] = None
+        self.idle: Optional[asyncio.Event] = None
+        self.tasks: List[asyncio.Task] = []
+        self.stopping = False
+        self.rejected = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self.tasks)
+
+    def depth(self) -> int:
+        return self.queued
+
+    def tenant_depth(self, tenant: str) -> int:
+        queue = self.tenants.get(tenant)
+        return len(queue.items) if queue is not None else 0
+
+    def tenant_stats(self, tenant: str) -> dict:
+        queue = self.tenants.get(tenant) or TenantQueue(tenant)
+        return {**queue.as_dict(), "weight": self.weight(tenant)}
+
+    async def start(self):
+        if self.running:
+            return
+        self.stopping = False
+        self.wakeup = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.tasks = [
+            asyncio.create_task(self._worker(), name=f"{self.name}-worker-{i}")
+            for i in range(self.concurrency)
+        ]
+        utils.logger.info(
+            f"Started {self.concurrency} {self.name} workers "
+            f"(queue size {self.queue_size}, {self.tenant_queue_size} per tenant)"
+        )
+
+    def submit(self, tenant: str, item: Any) -> bool:
+        # Nothing would ever run items taken once stop() has begun
+        if self.wakeup is None or self.stopping:
+            return False
+        queue = self.tenants.get(tenant)
+        if queue is None:
+            queue = self.tenants[tenant] = TenantQueue(tenant)
+        if self.queued >= self.queue_size or len(queue.items) >= self.tenant_queue_size:
+            self.rejected += 1
+            queue.rejected += 1
+            metrics.TENANT_REJECTED.labels(self.name, tenant).inc()
+            utils.logger.warning(f"{self.name} queue full for {tenant}, rejecting item")
+            return False
+        # A tenant that was idle starts from the current virtual time rather
+        # than cashing in the time it wasn't using
+        start = max(self.virtual_time, queue.last_finish)
+        queue.last_finish = start + 1 / max(self.weight(tenant), 0.001)
+        queue.items.append((start, queue.last_finish, time.monotonic(), item))
+        self.queued += 1
+        self.idle.clear()
+        self._schedule(queue)
+        return True
+
+    def _schedule(self, queue: TenantQueue):
+        if queue.scheduled or not queue.items:
+            return
+        if queue.inflight >= self.tenant_inflight:
+            return
+        queue.scheduled = True
+        heapq.heappush(self.ready, (queue.items[0][1], next(self.counter), queue))
+        self.wakeup.set()
+
+    def _take(self) -> Optional[Tuple[TenantQueue, float, Any]]:
+        if not self.ready:
+            return None
+        _, _, queue = heapq.heappop(self.ready)
+        queue.scheduled = False
+        start, _, enqueued, item = queue.items.popleft()
+        self.queued -= 1
+        self.virtual_time = max(self.virtual_time, start)
+        queue.inflight += 1
+        self.active += 1
+        self._schedule(queue)
+        return queue, enqueued, item
+
+    async def join(self):
+        await self.idle.wait()
+
+    async def stop(self):
+        if not self.running:
+            return
+        self.stopping = True
+        try:
+            await asyncio.wait_for(self.join(), timeout=self.drain_timeout)
+        except asyncio.TimeoutError:
+            utils.logger.warning(
+                f"{self.name} queue not drained after {self.drain_timeout}s, "
+                f"dropping {self.queued} items"
+            )
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        # What never ran is dropped; the outbound queue releases its rows
+        for queue in self.tenants.values():
+            queue.items.clear()
+            queue.scheduled = False
+        self.ready = []
+        self.queued = 0
+
+    async def _worker(self):
+        while True:
+            taken = self._take()
+            if taken is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            queue, enqueued, item = taken
+            wait = time.monotonic() - enqueued
+            queue.wait_sum += wait
+            queue.wait_max = max(queue.wait_max, wait)
+            metrics.TENANT_QUEUE_WAIT_SECONDS.labels(self.name, queue.tenant).observe(
+                wait
+            )
+            try:
+                await self.handler(item)
+            except Exception:
+                self.failed += 1
+                utils.logger.exception(f"{self.name} worker failed to process item")
+            finally:
+                queue.processed += 1
+                queue.inflight -= 1
+                self.active -= 1
+                self._schedule(queue)
+                if not self.queued and not self.active:
+                    self.idle.set()
@@ -0,0 +1,258 @@
+import asyncio
+import os
+import time
+from typing import Dict, List, Optional, Set
+
+from cachetools import LRUCache
+from dotenv import load_dotenv
+
+from config import get_document_store, get_store
+from models.session import ConversationSession
+from models.webhook import Message, Status
+from repository import run_in_db_thread
+from write_behind import WriteBehind
+import metrics
+import utils
+
+load_dotenv()
+
+
+# Sessions kept in memory; older ones are reloaded from RavenDB on next use
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "50000"))
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "5"))
+SESSION_FLUSH_SIZE = int(os.getenv("SESSION_FLUSH_SIZE", "500"))
+SESSION_MAX_BACKOFF = float(os.getenv("SESSION_MAX_BACKOFF", "300"))
+# Free-form messages are allowed this long after the customer last wrote
+SESSION_WINDOW_SECONDS = int(os.getenv("SESSION_WINDOW_SECONDS", str(24 * 3600)))
+
+# Conversation origins whose expiration is a customer service window;
+# marketing and utility conversations don't allow free-form messages
+WINDOW_ORIGINS = {"service", "user_initiated", "referral_conversion"}
+TIMESTAMP_FIELDS = ("last_inbound_at", "last_outbound_at", "window_expires_at")
+
+
+def session_id(business_id: str, wa_id: str) -> str:
+    return f"sessions/{business_id}/{wa_id.lstrip('+')}"
+
+
+def merge_stored(session: ConversationSession, stored: ConversationSession):
+    # Keeps the later of each timestamp; flow context set here wins
+    for field in TIMESTAMP_FIELDS:
+        ours, theirs = getattr(session, field), getattr(stored, field)
+        if theirs is not None and (ours is None or theirs > ours):
+            setattr(session, field, theirs)
+    if session.conversation_id is None:
+        session.conversation_id = stored.conversation_id
+        session.conversation_origin = stored.conversation_origin
+    session.flow_context = {**stored.flow_context, **session.flow_context}
+
+
+class SessionStore(WriteBehind):
+    # One session per (business, wa_id). Reads are served from an LRU hot
+    # tier and changes are written behind in bulk, so a message costs no
+    # RavenDB round trip once its contact's session is warm.
+    def __init__(
+        self,
+        maxsize: int = SESSION_CACHE_SIZE,
+        flush_interval: float = SESSION_FLUSH_INTERVAL,
+        flush_size: int = SESSION_FLUSH_SIZE,
+    ):
+        super().__init__(
+            "session-store", flush_interval, flush_size, SESSION_MAX_BACKOFF
+        )
+        self.hot = LRUCache(maxsize=maxsize)
+        # Changed since the last flush; holds sessions the LRU has evicted
+        # until they are written
+        self.dirty: Dict[str, ConversationSession] = {}
+        self.loading: Dict[str, asyncio.Future] = {}
+        # Latest inbound timestamp per session that is still loading; applied
+        # by the load, so anything that waits on it sees the message
+        self.inbound: Dict[str, int] = {}
+        self.observing: Set[asyncio.Task] = set()
+
+    def _cached(self, key: str) -> Optional[ConversationSession]:
+        session = self.hot.get(key)
+        if session is None:
+            session = self.dirty.get(key)
+            if session is not None:
+                self.hot[key] = session
+        return session
+
+    async def get(self, business_id: str, wa_id: str) -> ConversationSession:
+        key = session_id(business_id, wa_id)
+        session = self._cached(key)
+        if session is not None:
+            metrics.SESSION_LOOKUPS.labels("hit").inc()
+            return session
+        return await self._load_once(key, business_id, wa_id.lstrip("+"))
+
+    async def _load_once(
+        self, key: str, business_id: str, wa_id: str
+    ) -> ConversationSession:
+        # Concurrent messages from a cold contact share one load
+        future = self.loading.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self.loading[key] = future
+        try:
+            stored = await run_in_db_thread(_load_session, key)
+        except BaseException as e:
+            metrics.SESSION_LOOKUPS.labels("error").inc()
+            future.set_exception(e)
+            future.exception()
+            raise
+        else:
+            metrics.SESSION_LOOKUPS.labels("miss").inc()
+            # Anything written to the hot tier while loading is newer
+            session = self.hot.get(key)
+            if session is None:
+                session = stored or ConversationSession(
+                    Id=key, business_id=business_id, wa_id=wa_id
+                )
+                self.hot[key] = session
+            timestamp = self.inbound.pop(key, None)
+            if timestamp is not None:
+                self._observe_inbound(session, timestamp)
+            future.set_result(session)
+            return session
+        finally:
+            del self.loading[key]
+
+    def _mark_dirty(self, session: ConversationSession):
+        self.dirty[session.Id] = session
+        if len(self.dirty) >= self.flush_size:
+            self.full.set()
+
+    def observe_messages(self, business_id: str, messages: List[Message]):
+        # Inbound messages open or extend the customer service window. Warm
+        # sessions are updated here; cold ones load in the background so a
+        # message never waits on RavenDB before it is forwarded.
+        for message in messages:
+            key = session_id(business_id, message.from_user)
+            timestamp = int(message.timestamp)
+            session = self._cached(key)
+            if session is not None:
+                self._observe_inbound(session, timestamp)
+                continue
+            self.inbound[key] = max(self.inbound.get(key, 0), timestamp)
+            if key not in self.loading:
+                task = asyncio.create_task(
+                    self._load_in_background(business_id, message.from_user)
+                )
+                self.observing.add(task)
+                task.add_done_callback(self.observing.discard)
+
+    async def _load_in_background(self, business_id: str, wa_id: str):
+        try:
+            await self.get(business_id, wa_id)
+        except Exception as e:
+            # The message is applied by the next load that succeeds
+            utils.logger.warning(f"Failed to load session for {wa_id}: {e}")
+
+    def _observe_inbound(self, session: ConversationSession, timestamp: int):
+        if session.last_inbound_at is None or timestamp > session.last_inbound_at:
+            session.last_inbound_at = timestamp
+        expires = timestamp + SESSION_WINDOW_SECONDS
+        if session.window_expires_at is None or expires > session.window_expires_at:
+            session.window_expires_at = expires
+        self._mark_dirty(session)
+
+    def observe_statuses(self, business_id: str, statuses: List[Status]):
+        # Only sessions already in memory are updated: an inbound message has
+        # usually opened the window already, and statuses are too frequent to
+        # justify a load each
+        for status in statuses:
+            conversation = status.conversation
+            if conversation is None or not conversation.expiration_timestamp:
+                continue
+            session = self.hot.get(session_id(business_id, status.recipient_id))
+            if session is None:
+                continue
+            session.conversation_id = conversation.id
+            session.conversation_origin = conversation.origin.type
+            expires = int(conversation.expiration_timestamp)
+            if conversation.origin.type in WINDOW_ORIGINS and (
+                session.window_expires_at is None or expires > session.window_expires_at
+            ):
+                session.window_expires_at = expires
+            self._mark_dirty(session)
+
+    def observe_outbound(self, business_id: str, wa_id: str):
+        # Sends check the window first, which has already loaded the session
+        session = self.hot.get(session_id(business_id, wa_id))
+        if session is not None:
+            session.last_outbound_at = int(time.time())
+            self._mark_dirty(session)
+
+    async def update_flow(self, business_id: str, wa_id: str, **context):
+        try:
+            session = await self.get(business_id, wa_id)
+        except Exception as e:
+            utils.logger.warning(f"Failed to load session for {wa_id}: {e}")
+            return
+        session.flow_context.update(context)
+        self._mark_dirty(session)
+
+    async def window_open(self, business_id: str, wa_id: str) -> Optional[bool]:
+        # None when we don't know, so callers only hold back a send when the
+        # window is known to be closed
+        try:
+            session = await self.get(business_id, wa_id)
+        except Exception as e:
+            utils.logger.warning(f"Failed to load session for {wa_id}: {e}")
+            return None
+        if session.window_expires_at is None:
+            return None
+        if session.window_expires_at > time.time():
+            return True
+        # Another worker may have seen a newer message; check the stored copy
+        # before turning the send away
+        try:
+            stored = await run_in_db_thread(_load_session, session.Id)
+        except Exception:
+            return False
+        if stored is not None:
+            merge_stored(session, stored)
+        return session.window_expires_at > time.time()
+
+    async def _write(self) -> int:
+        if not self.dirty:
+            return 0
+        batch = self.dirty
+        self.dirty = {}
+        try:
+            # Copies, so the loop can keep changing sessions while the db
+            # thread serializes them
+            await run_in_db_thread(
+                _store_sessions,
+                [session.model_copy(deep=True) for session in batch.values()],
+            )
+        except Exception:
+            # Sessions are shared objects, so re-marking them keeps any change
+            # made meanwhile
+            for key, session in batch.items():
+                self.dirty.setdefault(key, session)
+            raise
+        return len(batch)
+
+    async def stop(self):
+        await self._stop_task()
+        await asyncio.gather(*self.observing, return_exceptions=True)
+        await self.flush()
+
+
+def _load_session(key: str) -> Optional[ConversationSession]:
+    with get_store() as session:
+        return session.load(key, ConversationSession)
+
+
+def _store_sessions(sessions: List[ConversationSession]):
+    # Bulk insert streams every document in one request and overwrites
+    # whatever is stored, which is what a write-behind of whole sessions needs
+    with get_document_store().bulk_insert() as bulk:
+        for session in sessions:
+            bulk.store(session)
+
+
+session_store = SessionStore()
@@ -0,0 +1,233 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import orjson
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+# State that has to agree across workers: dedup windows, cache tiers behind
+# the per-process caches, and rate limits. "memory" keeps everything per
+# process, "sqlite" shares it between workers on one host and "redis" shares
+# it between hosts.
+SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "memory")
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", "shared_state.sqlite3")
+SHARED_STATE_URL = os.getenv("SHARED_STATE_URL", "redis://localhost:6379/0")
+SHARED_STATE_PREFIX = os.getenv("SHARED_STATE_PREFIX", "rook:")
+
+
+class SqliteBackend:
+    def __init__(self, path: str = SHARED_STATE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, check_same_thread=False, timeout=10, isolation_level=None
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv "
+            "(key TEXT PRIMARY KEY, value BLOB, expires REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS counters "
+            "(key TEXT PRIMARY KEY, count INTEGER NOT NULL, resets REAL)"
+        )
+        self.last_purge = 0.0
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        now = time.time()
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT key, value FROM kv WHERE key IN ({','.join('?' * len(keys))}) "
+                "AND expires > ?",
+                (*keys, now),
+            ).fetchall()
+        found = dict(rows)
+        return [found.get(key) for key in keys]
+
+    def set(self, key: str, value: bytes, ttl: float):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl),
+            )
+
+    def add_many(self, keys: List[str], ttl: float) -> List[bool]:
+        now = time.time()
+        added = []
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for key in keys:
+                    # Inserts new keys and revives expired ones; rowcount is 0
+                    # only when the key is still inside the window.
+                    cursor = self.conn.execute(
+                        "INSERT INTO kv (key, value, expires) VALUES (?, X'31', ?) "
+                        "ON CONFLICT(key) DO UPDATE SET expires = excluded.expires "
+                        "WHERE kv.expires < ?",
+                        (key, now + ttl, now),
+                    )
+                    added.append(cursor.rowcount > 0)
+                if now - self.last_purge > 60:
+                    self.conn.execute("DELETE FROM kv WHERE expires < ?", (now,))
+                    self.last_purge = now
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return added
+
+    def incr(self, key: str) -> int:
+        # Kept in kv, never expiring, so get_many can read it like Redis does
+        with self.lock:
+            return self.conn.execute(
+                "INSERT INTO kv (key, value, expires) VALUES (?, 1, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1 "
+                "RETURNING value",
+                (key, float("inf")),
+            ).fetchone()[0]
+
+    def incr_window(self, key: str, window: float) -> Tuple[int, float]:
+        # Fixed window counter: the count and seconds until it resets
+        now = time.time()
+        with self.lock:
+            count, resets = self.conn.execute(
+                "INSERT INTO counters (key, count, resets) VALUES (?, 1, ?) "
+                "ON CONFLICT(key) DO UPDATE SET "
+                "count = CASE WHEN resets <= ? THEN 1 ELSE count + 1 END, "
+                "resets = CASE WHEN resets <= ? THEN ? ELSE resets END "
+                "RETURNING count, resets",
+                (key, now + window, now, now, now + window),
+            ).fetchone()
+        return count, max(resets - now, 0.0)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class RedisBackend:
+    def __init__(self, url: str = SHARED_STATE_URL, prefix: str = SHARED_STATE_PREFIX):
+        # Only needed when this backend is selected
+        import redis
+
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url)
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        return self.client.mget([self._key(key) for key in keys])
+
+    def set(self, key: str, value: bytes, ttl: float):
+        self.client.set(self._key(key), value, px=max(int(ttl * 1000), 1))
+
+    def add_many(self, keys: List[str], ttl: float) -> List[bool]:
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.set(self._key(key), b"1", nx=True, px=max(int(ttl * 1000), 1))
+        return [bool(result) for result in pipe.execute()]
+
+    def incr(self, key: str) -> int:
+        return self.client.incr(self._key(key))
+
+    def incr_window(self, key: str, window: float) -> Tuple[int, float]:
+        key = self._key(key)
+        window_ms = max(int(window * 1000), 1)
+        # MULTI/EXEC, so no other client's commands run between these
+        pipe = self.client.pipeline(transaction=True)
+        pipe.set(key, 0, nx=True, px=window_ms)
+        pipe.incr(key)
+        pipe.pttl(key)
+        _, count, ttl = pipe.execute()
+        if ttl == -1:
+            # The key expired between SET and INCR and came back without a
+            # TTL; left alone it would count up forever and block every send
+            self.client.pexpire(key, window_ms)
+            ttl = window_ms
+        return count, max(ttl, 0) / 1000
+
+    def close(self):
+        self.client.close()
+
+
+BACKENDS = {"sqlite": SqliteBackend, "redis": RedisBackend}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    # None when state is per process
+    global _backend
+    if _backend is None and SHARED_STATE_BACKEND in BACKENDS:
+        with _backend_lock:
+            if _backend is None:
+                _backend = BACKENDS[SHARED_STATE_BACKEND]()
+    return _backend
+
+
+def close_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is not None:
+            _backend.close()
+            _backend = None
+
+
+class SharedCache:
+    # A cache tier shared between workers. Entries carry the namespace
+    # generation they were written under, so invalidate() drops every entry
+    # with one counter bump instead of a key scan.
+    def __init__(self, backend, namespace: str):
+        self.backend = backend
+        self.namespace = namespace
+        self.generation_key = f"{namespace}:generation"
+
+    def get(self, key: str) -> Tuple[bool, Optional[bytes], int]:
+        # Also returns the current generation; pass it back to put() so a
+        # value read before an invalidate can't be stored as current
+        generation, entry = self.backend.get_many(
+            [self.generation_key, f"{self.namespace}:{key}"]
+        )
+        generation = int(generation or 0)
+        if entry is None:
+            return False, None, generation
+        written, value = orjson.loads(entry)
+        if written != generation:
+            return False, None, generation
+        return True, value.encode() if value is not None else None, generation
+
+    def put(self, key: str, value: Optional[bytes], ttl: float, generation: int):
+        entry = orjson.dumps(
+            [generation, value.decode() if value is not None else None]
+        )
+        self.backend.set(f"{self.namespace}:{key}", entry, ttl)
+
+    def invalidate(self) -> int:
+        return int(self.backend.incr(self.generation_key))
+
+
+class SharedRateLimiter:
+    # Fixed one second windows counted in the shared backend, so the rate
+    # holds across every worker rather than per process
+    def __init__(self, backend, name: str, rate: float):
+        self.backend = backend
+        self.name = name
+        self.rate = max(int(rate), 1)
+
+    async def acquire(self):
+        while True:
+            count, resets_in = await asyncio.to_thread(
+                self.backend.incr_window, f"rate:{self.name}", 1.0
+            )
+            if count <= self.rate:
+                return
+            await asyncio.sleep(resets_in or 0.01)
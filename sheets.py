@@ -0,0 +1,140 @@
+import asyncio
+import itertools
+import os
+import threading
+from collections import deque
+from typing import Deque, List
+
+import gspread
+from dotenv import load_dotenv
+from google.oauth2.service_account import Credentials
+
+from models.rapidpro import RapidProEmailMessage
+from spool import SlotSpool, SpoolEntry
+from write_behind import WriteBehind
+
+load_dotenv()
+
+
+SERVICE_ACCOUNT_FILE = os.getenv("SERVICE_ACCOUNT_FILE", "therook-1a7136b65746.json")
+SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+
+# Open Google Sheet by name or ID
+SPREADSHEET_ID = os.getenv(
+    "SPREADSHEET_ID", "1y2Nw6DifAeT719XO0pqgsiqdlkPPELdSS3JlQu_muH0"
+)
+# gspread waits forever on a stalled request otherwise
+SHEETS_TIMEOUT = float(os.getenv("SHEETS_TIMEOUT", "30"))
+
+_sheet = None
+_sheet_lock = threading.Lock()
+
+
+def get_sheet():
+    global _sheet
+    if _sheet is None:
+        with _sheet_lock:
+            if _sheet is None:
+                creds = Credentials.from_service_account_file(
+                    SERVICE_ACCOUNT_FILE, scopes=SCOPES
+                )
+                client = gspread.authorize(creds)
+                client.set_timeout(SHEETS_TIMEOUT)
+                _sheet = client.open_by_key(SPREADSHEET_ID).sheet1
+    return _sheet
+
+
+SHEET_FLUSH_INTERVAL = float(os.getenv("SHEET_FLUSH_INTERVAL", "5"))
+SHEET_FLUSH_SIZE = int(os.getenv("SHEET_FLUSH_SIZE", "100"))
+SHEET_MAX_BACKOFF = float(os.getenv("SHEET_MAX_BACKOFF", "300"))
+SHEET_SPILL_PATH = os.getenv("SHEET_SPILL_PATH", "sheet_spill.jsonl")
+# Each worker process owns one spill file; this caps how many can run at once
+SHEET_SPILL_SLOTS = int(os.getenv("SHEET_SPILL_SLOTS", "64"))
+# Comma separated RapidPro result keys in sheet column order. "@urn", "@name"
+# and "@flow" pull from the contact and flow instead of the results.
+SHEET_COLUMNS = [
+    column.strip()
+    for column in os.getenv(
+        "SHEET_COLUMNS",
+        "customer_full_name,address,customer_nrc,@urn,email,buiness_name,"
+        "business_type,crop_type,documentation,market_for_crops,"
+        "financing_requirements,farm_hectorage,mechanization_requirement,"
+        "mechanization_type,water_resources",
+    ).split(",")
+    if column.strip()
+]
+
+
+def build_row(message: RapidProEmailMessage, columns: List[str]) -> List[str]:
+    specials = {
+        "@urn": message.contact.urn,
+        "@name": message.contact.name,
+        "@flow": message.flow.name,
+    }
+    row = []
+    for column in columns:
+        if column in specials:
+            row.append(specials[column])
+            continue
+        result = message.results.get(column) or {}
+        row.append(result.get("value", "") if isinstance(result, dict) else result)
+    return row
+
+
+class SheetWriter(WriteBehind):
+    def __init__(
+        self,
+        spill_path: str = SHEET_SPILL_PATH,
+        flush_interval: float = SHEET_FLUSH_INTERVAL,
+        flush_size: int = SHEET_FLUSH_SIZE,
+        get_sheet=get_sheet,
+    ):
+        super().__init__("sheet-writer", flush_interval, flush_size, SHEET_MAX_BACKOFF)
+        self.spill = SlotSpool(spill_path, SHEET_SPILL_SLOTS)
+        # Guards the spill file and pending, which add() writes to while a
+        # flush is still waiting on Sheets
+        self.file_lock = asyncio.Lock()
+        self.get_sheet = get_sheet
+        # Spilled rows in file order, each with the file offset just past it
+        self.pending: Deque[SpoolEntry] = deque()
+
+    async def add(self, row: List[str]):
+        # Spilled to disk before it is acknowledged so a restart cannot lose it
+        async with self.file_lock:
+            ends = await asyncio.to_thread(self.spill.append, [row])
+            self.pending.append((ends[0], row))
+        if len(self.pending) >= self.flush_size:
+            self.full.set()
+
+    async def _write(self) -> int:
+        # Capped, so a backlog from an outage goes out in requests Sheets
+        # accepts rather than one that fails on every retry
+        batch = list(itertools.islice(self.pending, self.flush_size))
+        if not batch:
+            return 0
+        rows = [row for _, row in batch]
+        await asyncio.to_thread(
+            lambda: self.get_sheet().append_rows(rows, value_input_option="RAW")
+        )
+        async with self.file_lock:
+            for _ in batch:
+                self.pending.popleft()
+            await asyncio.to_thread(self.spill.consume, batch[-1][0], not self.pending)
+        if len(self.pending) >= self.flush_size:
+            self.full.set()
+        return len(batch)
+
+    async def start(self):
+        if self.spill.lock is None:
+            self.pending.extend(await asyncio.to_thread(self.spill.claim))
+        await super().start()
+
+    async def stop(self):
+        await super().stop()
+        # Whatever doesn't make it out stays spilled for the next start
+        while self.pending and await self.flush():
+            pass
+        self.spill.close()
+
+
+sheet_writer = SheetWriter()
@@ -0,0 +1,126 @@
+import fcntl
+import os
+from typing import Any, List, Tuple
+
+import orjson
+
+import utils
+
+# (file offset just past the entry, entry)
+SpoolEntry = Tuple[int, Any]
+
+
+class SlotSpool:
+    # An append-only JSON lines file owned by one worker process. Workers
+    # share the directory, so each one locks a numbered slot for its lifetime
+    # and never touches another worker's file; slots nobody holds (left by
+    # workers that are gone) are adopted. Entries already handled are skipped
+    # by an offset kept next to the file instead of rewriting it.
+    # Every method blocks; callers run them off the event loop.
+    def __init__(self, base_path: str, slots: int):
+        self.base_path = base_path
+        self.slots = slots
+        self.path = base_path
+        self.lock = None
+        self.file = None
+
+    def slot_path(self, slot: int) -> str:
+        return self.base_path if slot == 0 else f"{self.base_path}.{slot}"
+
+    def offset_path(self, path: str) -> str:
+        return f"{path}.offset"
+
+    def _lock_slot(self, slot: int):
+        lock = open(f"{self.slot_path(slot)}.lock", "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return None
+        return lock
+
+    def read(self, path: str) -> List[SpoolEntry]:
+        # Entries past the offset of the last one handled
+        if not os.path.exists(path):
+            return []
+        offset = 0
+        if os.path.exists(self.offset_path(path)):
+            with open(self.offset_path(path)) as f:
+                offset = int(f.read().strip() or 0)
+        entries = []
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                offset += len(line)
+                if not line.strip():
+                    continue
+                try:
+                    entries.append((offset, orjson.loads(line)))
+                except orjson.JSONDecodeError:
+                    # A write cut short by a crash
+                    utils.logger.warning(f"Skipping unreadable line in {path}")
+        return entries
+
+    def remove(self, path: str):
+        for name in (path, self.offset_path(path)):
+            if os.path.exists(name):
+                os.remove(name)
+
+    def claim(self) -> List[SpoolEntry]:
+        # Returns what is still spooled in this slot and the adopted ones
+        entries: List[SpoolEntry] = []
+        for slot in range(self.slots):
+            if self.lock is not None and not os.path.exists(self.slot_path(slot)):
+                continue
+            lock = self._lock_slot(slot)
+            if lock is None:
+                continue
+            path = self.slot_path(slot)
+            if self.lock is None:
+                self.lock = lock
+                self.path = path
+                entries.extend(self.read(path))
+                self.file = open(path, "ab")
+                continue
+            orphaned = [entry for _, entry in self.read(path)]
+            if orphaned:
+                entries.extend(zip(self.append(orphaned), orphaned))
+            self.remove(path)
+            lock.close()
+        if self.lock is None:
+            raise RuntimeError(f"All {self.slots} slots of {self.base_path} are in use")
+        return entries
+
+    def append(self, entries: List[Any]) -> List[int]:
+        # Returns the offset just past each entry
+        end = self.file.seek(0, os.SEEK_END)
+        ends = []
+        for entry in entries:
+            line = orjson.dumps(entry) + b"\n"
+            self.file.write(line)
+            end += len(line)
+            ends.append(end)
+        self.file.flush()
+        return ends
+
+    def consume(self, end: int, caught_up: bool):
+        # Everything up to end has been handled
+        if caught_up:
+            # Start the file over rather than let it grow forever
+            self.file.truncate(0)
+            self.file.seek(0)
+            if os.path.exists(self.offset_path(self.path)):
+                os.remove(self.offset_path(self.path))
+            return
+        tmp_path = f"{self.offset_path(self.path)}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(end))
+        os.replace(tmp_path, self.offset_path(self.path))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
@@ -0,0 +1,73 @@
+import asyncio
+
+import repository
+from business_cache import BusinessCache
+from models.business import Business
+
+BUSINESS = Business(
+    name="Rook",
+    owner_id="owner",
+    business_id="1234",
+    phone_number="260970000000",
+    rapid_pro_channel="channel",
+    subscription_plan="premium",
+)
+
+
+class FakeQuery:
+    def __init__(self, store, field, value):
+        self.store = store
+        self.field = field
+        self.value = value
+
+    def where_equals(self, field, value):
+        return FakeQuery(self.store, field, value)
+
+    def first(self):
+        self.store.queries += 1
+        if getattr(BUSINESS, self.field, None) == self.value:
+            return BUSINESS
+        return None
+
+
+class FakeStore:
+    # Stands in for a RavenDB session, counting queries
+    def __init__(self):
+        self.queries = 0
+
+    def __call__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def query(self, object_type):
+        return FakeQuery(self, None, None)
+
+
+def test_repeated_lookups_query_once_without_shared_backend(monkeypatch):
+    store = FakeStore()
+    cache = BusinessCache()
+    monkeypatch.setattr(repository, "get_store", store)
+    monkeypatch.setattr(repository, "business_cache", cache)
+    monkeypatch.setattr("business_cache.get_backend", lambda: None)
+
+    async def lookups():
+        found = [await repository.get_business_by_phone_id("1234") for _ in range(3)]
+        missing = [await repository.get_business_by_phone_id("999") for _ in range(3)]
+        # Warmed under every lookup field by the first query
+        by_number = await repository.get_business_by_phone_number("260970000000")
+        return found, missing, by_number
+
+    found, missing, by_number = asyncio.run(lookups())
+    repository.shutdown_executor()
+    assert found == [BUSINESS] * 3
+    assert missing == [None] * 3
+    assert by_number == BUSINESS
+    assert store.queries == 2
+    stats = cache.stats()
+    assert stats["hits"] == 3
+    assert stats["negative_hits"] == 2
@@ -0,0 +1,115 @@
+import asyncio
+
+import httpx
+import orjson
+
+from circuit_breaker import CircuitBreaker
+from forwarder import RapidProForwarder
+
+
+class FakeRapidPro:
+    def __init__(self):
+        self.down = False
+        self.received = []
+        self.tries = []
+
+    async def send(self, text, sender, channel_id):
+        self.tries.append(text)
+        if self.down:
+            raise httpx.ConnectError("refused")
+        if text == "poison":
+            request = httpx.Request("POST", "http://rapidpro/receive")
+            response = httpx.Response(500, request=request)
+            raise httpx.HTTPStatusError("500", request=request, response=response)
+        self.received.append((channel_id, text))
+
+
+def make_forwarder(rapidpro, path, max_attempts=5):
+    return RapidProForwarder(
+        rapidpro.send,
+        spool_path=str(path),
+        drain_rate=1000,
+        breaker=CircuitBreaker("test", 1, 0.02, 0.02),
+        max_attempts=max_attempts,
+    )
+
+
+async def drained(forwarder, timeout=2.0):
+    for _ in range(int(timeout / 0.01)):
+        if not forwarder.depth():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"{forwarder.depth()} messages still spooled")
+
+
+def test_outage_spools_and_replays_in_order(tmp_path):
+    rapidpro = FakeRapidPro()
+
+    async def run():
+        forwarder = make_forwarder(rapidpro, tmp_path / "spool.jsonl")
+        await forwarder.start()
+        rapidpro.down = True
+        for text in ("one", "two"):
+            await forwarder.forward(text, "user", "c1")
+        assert forwarder.depth() == 2
+        rapidpro.down = False
+        # Queued behind the backlog even though RapidPro is back
+        await forwarder.forward("three", "user", "c1")
+        await drained(forwarder)
+        await forwarder.forward("four", "user", "c1")
+        await forwarder.stop()
+        return forwarder.stats()
+
+    stats = asyncio.run(run())
+    assert rapidpro.received == [("c1", t) for t in ("one", "two", "three", "four")]
+    assert stats["spooled"] == 3
+    assert stats["drained"] == 3
+    assert stats["forwarded"] == 1
+    assert (tmp_path / "spool.jsonl").stat().st_size == 0
+
+
+def test_spool_survives_restart(tmp_path):
+    rapidpro = FakeRapidPro()
+    rapidpro.down = True
+
+    async def run():
+        forwarder = make_forwarder(rapidpro, tmp_path / "spool.jsonl")
+        await forwarder.start()
+        for text in ("one", "two", "three"):
+            await forwarder.forward(text, "user", "c1")
+        await forwarder.stop()
+
+        rapidpro.down = False
+        forwarder = make_forwarder(rapidpro, tmp_path / "spool.jsonl")
+        await forwarder.start()
+        assert forwarder.depth() == 3
+        await drained(forwarder)
+        await forwarder.stop()
+
+    asyncio.run(run())
+    assert rapidpro.received == [("c1", t) for t in ("one", "two", "three")]
+
+
+def test_rejected_message_is_dead_lettered(tmp_path):
+    rapidpro = FakeRapidPro()
+    rapidpro.down = True
+
+    async def run():
+        forwarder = make_forwarder(rapidpro, tmp_path / "spool.jsonl", max_attempts=3)
+        await forwarder.start()
+        await forwarder.forward("poison", "user", "c1")
+        await forwarder.forward("next", "user", "c1")
+        rapidpro.down = False
+        await drained(forwarder)
+        await forwarder.stop()
+        return forwarder.stats()
+
+    stats = asyncio.run(run())
+    assert rapidpro.received == [("c1", "next")]
+    assert rapidpro.tries.count("poison") == 3 + 1
+    assert stats["dropped"] == 1
+    dead = [
+        orjson.loads(line)
+        for line in (tmp_path / "spool.jsonl.dead").read_bytes().splitlines()
+    ]
+    assert [entry["text"] for entry in dead] == ["poison"]
@@ -0,0 +1,47 @@
+import asyncio
+
+import httpx
+import pytest
+
+import http_client
+from media_registry import MediaRegistry
+
+
+def test_private_addresses_are_refused():
+    registry = MediaRegistry(dict, allowed_hosts=set())
+    for source in (
+        "http://localhost/a.png",
+        "http://169.254.169.254/latest/meta-data",
+        "http://[::ffff:127.0.0.1]/a.png",
+    ):
+        with pytest.raises(ValueError):
+            asyncio.run(registry._pin_host(source))
+
+
+def test_fetch_goes_to_the_checked_address(monkeypatch):
+    seen = []
+
+    def handler(request):
+        seen.append(request)
+        return httpx.Response(
+            200, content=b"png", headers={"content-type": "image/png"}
+        )
+
+    async def resolve(host, port, type=0):
+        # A rebinding name would answer differently on the next lookup
+        return [(2, 1, 6, "", ("93.184.216.34", port))]
+
+    async def fetch():
+        monkeypatch.setattr(asyncio.get_running_loop(), "getaddrinfo", resolve)
+        registry = MediaRegistry(dict, allowed_hosts=set())
+        return await registry._read("https://images.example.com/a.png?v=1")
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(http_client, "_client", client)
+    assert asyncio.run(fetch()) == (b"png", "image/png")
+    request = seen[0]
+    assert request.url.host == "93.184.216.34"
+    assert request.url.path == "/a.png"
+    assert request.url.query == b"v=1"
+    assert request.headers["host"] == "images.example.com"
+    assert request.extensions["sni_hostname"] == "images.example.com"
@@ -0,0 +1,58 @@
+import time
+
+from outbound import OutboundStore
+
+
+def claimed_ids(store, limit=10, per_business=10, room=None):
+    rows = store.claim(time.time() + 1, limit, per_business, room=room, lease=60)
+    return sorted(row[0] for row in rows)
+
+
+def claimed_businesses(store, per_business, room):
+    rows = store.claim(time.time() + 1, 10, per_business, room=room, lease=60)
+    return sorted(row[1] for row in rows)
+
+
+def test_claims_one_message_per_recipient_in_order(tmp_path):
+    store = OutboundStore(str(tmp_path / "outbound.sqlite3"))
+    first = store.add("biz", "1", "text", recipient="alice")
+    second = store.add("biz", "2", "text", recipient="alice")
+    other = store.add("biz", "3", "text", recipient="bob")
+
+    assert claimed_ids(store) == [first, other]
+    # alice's second message waits until her first is done
+    assert claimed_ids(store) == []
+    store.delete(first)
+    assert claimed_ids(store) == [second]
+    store.close()
+
+
+def test_retry_holds_back_later_messages(tmp_path):
+    store = OutboundStore(str(tmp_path / "outbound.sqlite3"))
+    first = store.add("biz", "1", "text", recipient="alice")
+    second = store.add("biz", "2", "text", recipient="alice")
+
+    assert claimed_ids(store) == [first]
+    store.reschedule(first, 1, time.time() + 60, "timeout")
+    assert claimed_ids(store) == []
+    store.reschedule(first, 1, time.time(), "timeout")
+    assert claimed_ids(store) == [first]
+    store.delete(first)
+    assert claimed_ids(store) == [second]
+    store.close()
+
+
+def test_claim_caps_each_business(tmp_path):
+    store = OutboundStore(str(tmp_path / "outbound.sqlite3"))
+    busy = [store.add("busy", "x", "text", recipient=str(i)) for i in range(5)]
+    quiet = store.add("quiet", "x", "text", recipient="0")
+
+    assert claimed_ids(store, per_business=2) == [busy[0], busy[1], quiet]
+    store.release(busy[:2] + [quiet])
+    # room overrides the cap for the businesses it lists
+    assert claimed_businesses(store, per_business=2, room={"busy": 1}) == [
+        "busy",
+        "quiet",
+    ]
+    assert claimed_businesses(store, per_business=2, room={"busy": 0}) == []
+    store.close()
@@ -0,0 +1,87 @@
+import asyncio
+
+from scheduler import FairScheduler
+
+WEIGHTS = {"premium": 4, "free": 1}
+
+
+def test_weighted_tenants_share_workers_by_weight():
+    served = []
+
+    async def handle(item):
+        served.append(item)
+
+    async def run():
+        scheduler = FairScheduler(
+            "test", handle, concurrency=1, weight=WEIGHTS.get, drain_timeout=1
+        )
+        await scheduler.start()
+        for i in range(20):
+            assert scheduler.submit("premium", "premium")
+            assert scheduler.submit("free", "free")
+        await scheduler.join()
+        await scheduler.stop()
+
+    asyncio.run(run())
+    assert len(served) == 40
+    assert served[:10].count("premium") == 8
+
+
+def test_tenant_inflight_cap_leaves_workers_for_others():
+    running = {"busy": 0, "quiet": 0}
+    peak = {"busy": 0, "quiet": 0}
+
+    async def run():
+        release = asyncio.Event()
+
+        async def handle(tenant):
+            running[tenant] += 1
+            peak[tenant] = max(peak[tenant], running[tenant])
+            await release.wait()
+            running[tenant] -= 1
+
+        scheduler = FairScheduler(
+            "test", handle, concurrency=4, tenant_inflight=2, weight=lambda _: 1
+        )
+        await scheduler.start()
+        for _ in range(10):
+            scheduler.submit("busy", "busy")
+        await asyncio.sleep(0.01)
+        assert running == {"busy": 2, "quiet": 0}
+        # Two workers are still free for another tenant
+        scheduler.submit("quiet", "quiet")
+        scheduler.submit("quiet", "quiet")
+        await asyncio.sleep(0.01)
+        assert running == {"busy": 2, "quiet": 2}
+        release.set()
+        await scheduler.join()
+        await scheduler.stop()
+
+    asyncio.run(run())
+    assert peak == {"busy": 2, "quiet": 2}
+
+
+def test_queue_caps_and_stop_reject_items():
+    async def handle(item):
+        await asyncio.sleep(0)
+
+    async def run():
+        scheduler = FairScheduler(
+            "test",
+            handle,
+            concurrency=1,
+            queue_size=5,
+            tenant_queue_size=3,
+            weight=lambda _: 1,
+        )
+        assert not scheduler.submit("a", 0)
+        await scheduler.start()
+        accepted = [scheduler.submit("a", i) for i in range(4)]
+        accepted += [scheduler.submit("b", i) for i in range(3)]
+        await scheduler.stop()
+        return accepted, scheduler.submit("a", 5), scheduler.rejected
+
+    accepted, after_stop, rejected = asyncio.run(run())
+    assert accepted == [True, True, True, False, True, True, False]
+    assert not after_stop
+    assert rejected == 2
@@ -0,0 +1,82 @@
+import asyncio
+import os
+
+from sheets import SheetWriter
+
+
+class FakeSheet:
+    def __init__(self):
+        self.rows = []
+        self.requests = []
+        self.failing = False
+
+    def append_rows(self, rows, value_input_option):
+        self.requests.append(len(rows))
+        if self.failing:
+            raise RuntimeError("quota exceeded")
+        self.rows.extend(rows)
+
+
+def writer(path, sheet) -> SheetWriter:
+    return SheetWriter(
+        str(path), flush_interval=60, flush_size=10, get_sheet=lambda: sheet
+    )
+
+
+def test_backlog_is_sent_in_capped_batches_and_survives_restarts(tmp_path):
+    path = tmp_path / "spill.jsonl"
+    sheet = FakeSheet()
+    sheet.failing = True
+
+    async def outage():
+        rows = writer(path, sheet)
+        await rows.start()
+        await asyncio.gather(*(rows.add([str(i)]) for i in range(35)))
+        await rows.stop()
+
+    asyncio.run(outage())
+    assert sheet.rows == []
+    assert max(sheet.requests) == 10
+
+    sheet.failing = False
+    sheet.requests = []
+
+    async def recovery():
+        rows = writer(path, sheet)
+        await rows.start()
+        assert await rows.flush() == 10
+        # Flushed rows are skipped by offset, so a restart doesn't resend them
+        await rows.stop()
+
+    asyncio.run(recovery())
+    assert sheet.requests == [10, 10, 10, 5]
+    assert sheet.rows == [[str(i)] for i in range(35)]
+    assert os.path.getsize(path) == 0
+    assert not os.path.exists(f"{path}.offset")
+
+
+def test_offset_skips_flushed_rows_after_a_crash(tmp_path):
+    path = tmp_path / "spill.jsonl"
+    sheet = FakeSheet()
+
+    async def partial():
+        # Claimed without the flush task, so only the flush below runs
+        rows = writer(path, sheet)
+        rows.pending.extend(rows.spill.claim())
+        for i in range(15):
+            await rows.add([str(i)])
+        await rows.flush()
+        # Gone without stopping, as if the process died
+        rows.spill.close()
+
+    asyncio.run(partial())
+
+    async def restart():
+        rows = writer(path, sheet)
+        await rows.start()
+        pending = [row for _, row in rows.pending]
+        await rows.stop()
+        return pending
+
+    assert asyncio.run(restart()) == [[str(i)] for i in range(10, 15)]
+    assert sheet.rows == [[str(i)] for i in range(15)]
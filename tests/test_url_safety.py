@@ -0,0 +1,106 @@
+import asyncio
+
+from benchmarks.fakes import FakeUrlChecker
+from url_safety import MALICIOUS, DomainTrie, UrlChecker
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def checker(remote, **kwargs) -> UrlChecker:
+    kwargs.setdefault("blocklist", DomainTrie())
+    kwargs.setdefault("batch_window", 0.01)
+    return UrlChecker(remote, **kwargs)
+
+
+def test_cached_verdicts_skip_the_remote():
+    remote = FakeUrlChecker()
+    urls = checker(remote)
+
+    async def check():
+        first = await urls.check_many(["http://phish.example/"])
+        second = await urls.check_many(["http://phish.example/"])
+        return first, second
+
+    first, second = run(check())
+    assert first == second == {"http://phish.example/": MALICIOUS}
+    assert remote.calls == 1
+
+
+def test_domain_trie_blocks_subdomains_only():
+    trie = DomainTrie(["bad.example.com", "Evil.org."])
+    assert trie.matches("bad.example.com")
+    assert trie.matches("x.bad.example.com")
+    assert trie.matches("evil.org")
+    assert not trie.matches("example.com")
+    assert not trie.matches("notbad.example.com")
+    assert trie.size == 2
+
+
+def test_domain_trie_reads_file(tmp_path):
+    path = tmp_path / "blocklist.txt"
+    path.write_text("# comment\nbad.example.com  # inline\n\nevil.org\n")
+    trie = DomainTrie.from_file(str(path))
+    assert trie.size == 2
+    assert trie.matches("www.evil.org")
+    assert DomainTrie.from_file(str(tmp_path / "missing.txt")).size == 0
+
+
+def test_blocklisted_urls_never_reach_the_remote(tmp_path):
+    path = tmp_path / "blocklist.txt"
+    path.write_text("bad.example.com\n")
+    remote = FakeUrlChecker()
+    urls = checker(remote, blocklist=None, blocklist_path=str(path))
+
+    async def check():
+        await urls.start()
+        return await urls.unsafe_urls(["see https://www.bad.example.com/x now"])
+
+    assert run(check()) == [["https://www.bad.example.com/x"]]
+    assert remote.calls == 0
+
+
+def test_concurrent_checks_of_a_url_share_one_lookup():
+    remote = FakeUrlChecker(latency=0.01)
+    urls = checker(remote)
+
+    async def check():
+        return await asyncio.gather(
+            *(urls.check_many(["http://malware.example/"]) for _ in range(5))
+        )
+
+    results = run(check())
+    assert all(result == {"http://malware.example/": MALICIOUS} for result in results)
+    assert remote.calls == 1
+    assert remote.checked == 1
+
+
+def test_batch_flushes_when_full():
+    remote = FakeUrlChecker()
+    # The window is long enough that only a full batch can flush in time
+    urls = checker(remote, batch_window=60, batch_size=3)
+
+    async def check():
+        return await asyncio.wait_for(
+            urls.check_many([f"http://site{i}.example/" for i in range(3)]), 1
+        )
+
+    assert len(run(check())) == 3
+    assert remote.calls == 1
+    assert remote.checked == 3
+
+
+def test_batch_flushes_after_window():
+    remote = FakeUrlChecker()
+    urls = checker(remote, batch_size=50)
+
+    async def check():
+        return await asyncio.gather(
+            urls.check_many(["http://one.example/"]),
+            urls.check_many(["http://two.example/"]),
+        )
+
+    run(check())
+    assert remote.calls == 1
+    assert remote.checked == 2
@@ -0,0 +1,107 @@
+import asyncio
+
+from ravendb.exceptions.raven_exceptions import ConcurrencyException
+
+import delivery
+from delivery import DeliveryTracker
+from models.webhook import Status
+from write_behind import WriteBehind
+
+
+class Buffer(WriteBehind):
+    def __init__(self, fail: bool = False, **kwargs):
+        super().__init__("buffer", **kwargs)
+        self.pending = []
+        self.written = []
+        self.fail = fail
+
+    def add(self, item):
+        self.pending.append(item)
+        if len(self.pending) >= self.flush_size:
+            self.full.set()
+
+    async def _write(self) -> int:
+        if self.fail:
+            raise RuntimeError("store down")
+        batch, self.pending = self.pending, []
+        self.written.extend(batch)
+        return len(batch)
+
+
+def test_flushes_when_full_and_on_stop():
+    buffer = Buffer(flush_interval=60, flush_size=3, max_backoff=60)
+
+    async def run():
+        await buffer.start()
+        for item in range(3):
+            buffer.add(item)
+        await asyncio.sleep(0.05)
+        written = list(buffer.written)
+        buffer.add(3)
+        await buffer.stop()
+        return written
+
+    assert asyncio.run(run()) == [0, 1, 2]
+    assert buffer.written == [0, 1, 2, 3]
+    assert buffer.flushed == 4
+
+
+def test_failures_back_off_up_to_the_cap():
+    buffer = Buffer(fail=True, flush_interval=1, flush_size=1, max_backoff=3)
+
+    async def run():
+        return [await buffer.flush() for _ in range(4)]
+
+    assert asyncio.run(run()) == [0, 0, 0, 0]
+    assert buffer.backoff == 3
+
+
+def test_stop_right_after_a_wake_up_returns():
+    buffer = Buffer(flush_interval=0.001, flush_size=1, max_backoff=60)
+
+    async def run():
+        await buffer.start()
+        for item in range(50):
+            buffer.add(item)
+            await asyncio.sleep(0)
+            if item % 10 == 9:
+                await asyncio.wait_for(buffer.stop(), 1)
+                await buffer.start()
+        await asyncio.wait_for(buffer.stop(), 1)
+
+    asyncio.run(run())
+    assert buffer.written == list(range(50))
+
+
+def status(message_id: str) -> Status:
+    return Status.model_validate(
+        {
+            "id": message_id,
+            "status": "delivered",
+            "timestamp": "1700000000",
+            "recipient_id": "260970000000",
+        }
+    )
+
+
+def test_only_conflicting_delivery_records_are_retried(monkeypatch):
+    saved = []
+
+    def save(records):
+        if any(record.message_id == "wamid.busy" for record in records):
+            raise ConcurrencyException("changed by another worker")
+        saved.extend(record.message_id for record in records)
+
+    monkeypatch.setattr(delivery, "_save_records", save)
+    tracker = DeliveryTracker(flush_interval=60, flush_size=500)
+    tracker.add([status("wamid.1"), status("wamid.busy"), status("wamid.2")], "b")
+
+    async def flush():
+        written = await tracker.flush()
+        await asyncio.sleep(0)
+        return written
+
+    assert asyncio.run(flush()) == 2
+    assert saved == ["wamid.1", "wamid.2"]
+    assert list(tracker.pending) == [delivery.record_id("wamid.busy")]
+    assert tracker.backoff == 0
@@ -0,0 +1,249 @@
+import asyncio
+import os
+import re
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+from cachetools import TTLCache
+from dotenv import load_dotenv
+
+from http_client import get_client
+import metrics
+import utils
+
+load_dotenv()
+
+
+URL_CACHE_SIZE = int(os.getenv("URL_CACHE_SIZE", "10000"))
+URL_CACHE_TTL = float(os.getenv("URL_CACHE_TTL", "3600"))
+# Misses are collected for up to URL_BATCH_WINDOW seconds, or until
+# URL_BATCH_SIZE are pending, before one remote call checks them together.
+URL_BATCH_WINDOW = float(os.getenv("URL_BATCH_WINDOW", "0.05"))
+URL_BATCH_SIZE = int(os.getenv("URL_BATCH_SIZE", "50"))
+# One domain per line; subdomains of a listed domain are blocked too
+URL_BLOCKLIST_PATH = os.getenv("URL_BLOCKLIST_PATH", "url_blocklist.txt")
+# "pangea" or "none"; with none only the blocklist is consulted
+URL_CHECKER = os.getenv("URL_CHECKER", "none")
+PANGEA_DOMAIN = os.getenv("PANGEA_DOMAIN")
+PANGEA_URL_INTEL_TOKEN = os.getenv("PANGEA_URL_INTEL_TOKEN")
+PANGEA_URL_PROVIDER = os.getenv("PANGEA_URL_PROVIDER", "crowdstrike")
+
+SAFE = "benign"
+MALICIOUS = "malicious"
+UNKNOWN = "unknown"
+UNSAFE_VERDICTS = {MALICIOUS, "suspicious"}
+
+_URL_PATTERN = re.compile(r"(?:https?://|www\.)[^\s<>\"']+", re.IGNORECASE)
+_TRAILING = ".,;:!?)]}'\""
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+RemoteChecker = Callable[[List[str]], Awaitable[Dict[str, str]]]
+
+
+def extract_urls(text: str) -> List[str]:
+    return [match.group().rstrip(_TRAILING) for match in _URL_PATTERN.finditer(text)]
+
+
+def normalize_url(url: str) -> Optional[str]:
+    if "://" not in url:
+        url = f"http://{url}"
+    try:
+        parts = urlsplit(url)
+        host = parts.hostname
+        port = parts.port
+    except ValueError:
+        return None
+    if not host:
+        return None
+    try:
+        host = host.rstrip(".").encode("idna").decode("ascii")
+    except UnicodeError:
+        return None
+    scheme = parts.scheme.lower()
+    netloc = host if port in (None, _DEFAULT_PORTS.get(scheme)) else f"{host}:{port}"
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+
+def url_host(url: str) -> str:
+    return urlsplit(url).hostname or ""
+
+
+class DomainTrie:
+    # Labels are stored right to left, so "bad.example.com" blocks
+    # "x.bad.example.com" but not "example.com"
+    _END = ""
+
+    def __init__(self, domains: Iterable[str] = ()):
+        self.root: Dict[str, dict] = {}
+        self.size = 0
+        for domain in domains:
+            self.add(domain)
+
+    def add(self, domain: str):
+        node = self.root
+        for label in reversed(domain.strip().lower().rstrip(".").split(".")):
+            node = node.setdefault(label, {})
+        if self._END not in node:
+            node[self._END] = {}
+            self.size += 1
+
+    def matches(self, host: str) -> bool:
+        node = self.root
+        for label in reversed(host.split(".")):
+            node = node.get(label)
+            if node is None:
+                return False
+            if self._END in node:
+                return True
+        return False
+
+    @classmethod
+    def from_file(cls, path: str) -> "DomainTrie":
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            return cls(
+                line.split("#", 1)[0].strip()
+                for line in f
+                if line.split("#", 1)[0].strip()
+            )
+
+
+async def pangea_checker(urls: List[str]) -> Dict[str, str]:
+    response = await get_client().post(
+        f"https://url-intel.{PANGEA_DOMAIN}/v2/url/reputation",
+        headers={"Authorization": f"Bearer {PANGEA_URL_INTEL_TOKEN}"},
+        json={"urls": urls, "provider": PANGEA_URL_PROVIDER},
+    )
+    response.raise_for_status()
+    data = response.json()["result"]["data"]
+    return {url: data.get(url, {}).get("verdict", UNKNOWN) for url in urls}
+
+
+CHECKERS: Dict[str, Optional[RemoteChecker]] = {
+    "pangea": pangea_checker,
+    "none": None,
+}
+
+
+class UrlChecker:
+    def __init__(
+        self,
+        remote: Optional[RemoteChecker] = CHECKERS.get(URL_CHECKER),
+        blocklist: Optional[DomainTrie] = None,
+        blocklist_path: str = URL_BLOCKLIST_PATH,
+        cache_size: int = URL_CACHE_SIZE,
+        cache_ttl: float = URL_CACHE_TTL,
+        batch_window: float = URL_BATCH_WINDOW,
+        batch_size: int = URL_BATCH_SIZE,
+    ):
+        self.remote = remote
+        self.blocklist = blocklist
+        self.blocklist_path = blocklist_path
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        # url -> future shared by every caller waiting on that url
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.batch: List[str] = []
+        self.flusher: Optional[asyncio.TimerHandle] = None
+        self.tasks = set()
+
+    async def start(self):
+        # Read off the event loop; until then only the remote check applies
+        if self.blocklist is None:
+            self.blocklist = await asyncio.to_thread(
+                DomainTrie.from_file, self.blocklist_path
+            )
+
+    def _blocked(self, url: str) -> bool:
+        return self.blocklist is not None and self.blocklist.matches(url_host(url))
+
+    async def check_many(self, urls: Iterable[str]) -> Dict[str, str]:
+        verdicts: Dict[str, str] = {}
+        waiting: Dict[str, asyncio.Future] = {}
+        for url in urls:
+            if url in verdicts or url in waiting:
+                continue
+            verdict = self.cache.get(url)
+            if verdict is not None:
+                metrics.URL_CHECKS.labels("cache", verdict).inc()
+                verdicts[url] = verdict
+            elif self._blocked(url):
+                metrics.URL_CHECKS.labels("blocklist", MALICIOUS).inc()
+                verdicts[url] = MALICIOUS
+            elif self.remote is None:
+                verdicts[url] = UNKNOWN
+            else:
+                waiting[url] = self._enqueue(url)
+        if waiting:
+            results = await asyncio.gather(
+                *(asyncio.shield(f) for f in waiting.values())
+            )
+            verdicts.update(zip(waiting, results))
+        return verdicts
+
+    def _enqueue(self, url: str) -> asyncio.Future:
+        future = self.pending.get(url)
+        if future is not None:
+            return future
+        loop = asyncio.get_running_loop()
+        future = self.pending[url] = loop.create_future()
+        self.batch.append(url)
+        if len(self.batch) >= self.batch_size:
+            self._flush()
+        elif self.flusher is None:
+            self.flusher = loop.call_later(self.batch_window, self._flush)
+        return future
+
+    def _flush(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        batch, self.batch = self.batch, []
+        if batch:
+            task = asyncio.create_task(self._check_remote(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _check_remote(self, batch: List[str]):
+        results: Dict[str, str] = {}
+        try:
+            results = await self.remote(batch)
+        except Exception as e:
+            # Fail open: the message is still delivered, just not vetted
+            utils.logger.warning(
+                f"URL reputation check for {len(batch)} urls failed: {e}"
+            )
+        finally:
+            for url in batch:
+                verdict = results.get(url, UNKNOWN)
+                if verdict != UNKNOWN:
+                    self.cache[url] = verdict
+                metrics.URL_CHECKS.labels("remote", verdict).inc()
+                future = self.pending.pop(url)
+                if not future.done():
+                    future.set_result(verdict)
+
+    async def unsafe_urls(self, texts: List[str]) -> List[List[str]]:
+        # For each text, the URLs in it as sent that were judged unsafe
+        found = []
+        for text in texts:
+            urls = {}
+            for url in extract_urls(text):
+                normalized = normalize_url(url)
+                if normalized is not None:
+                    urls.setdefault(normalized, url)
+            found.append(urls)
+        verdicts = await self.check_many(url for urls in found for url in urls)
+        return [
+            [raw for url, raw in urls.items() if verdicts[url] in UNSAFE_VERDICTS]
+            for urls in found
+        ]
+
+    async def stop(self):
+        self._flush()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+url_checker = UrlChecker()
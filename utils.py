@@ -1,5 +1,22 @@
+import os
 import sys
+import json
+import queue
 import logging
+import logging.config
+import logging.handlers
+from datetime import datetime, timezone
+
+ACCESS_LOG_FILE = os.getenv("ACCESS_LOG_FILE", "")
+ACCESS_LOG_SAMPLE_RATE = float(os.getenv("ACCESS_LOG_SAMPLE_RATE", "0"))
+ACCESS_LOG_MAX_BODY_BYTES = int(os.getenv("ACCESS_LOG_MAX_BODY_BYTES", "2048"))
+ACCESS_LOG_HEADERS = [
+    header.strip().lower()
+    for header in os.getenv(
+        "ACCESS_LOG_HEADERS", "user-agent,content-type,content-length"
+    ).split(",")
+    if header.strip()
+]
 
 logging_config = {
     "version": 1,
@@ -29,3 +46,55 @@ logging_config = {
 logging.config.dictConfig(logging_config)
 
 logger = logging.getLogger(__name__)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+        }
+        if isinstance(record.msg, dict):
+            data.update(record.msg)
+        else:
+            data["message"] = record.getMessage()
+        return json.dumps(data, default=str)
+
+
+def _access_handlers():
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if ACCESS_LOG_FILE:
+        handlers.append(logging.FileHandler(ACCESS_LOG_FILE))
+    for handler in handlers:
+        handler.setFormatter(JsonFormatter())
+    return handlers
+
+
+class _InProcessQueueHandler(logging.handlers.QueueHandler):
+    # The queue never leaves the process, so skip the eager formatting that
+    # QueueHandler.prepare does and leave it to the listener thread.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+# Access log records are handed to a queue on the request path and written
+# out by a background listener thread.
+_access_queue = queue.SimpleQueue()
+access_logger = logging.getLogger("access")
+access_logger.setLevel(logging.INFO)
+access_logger.propagate = False
+access_logger.addHandler(_InProcessQueueHandler(_access_queue))
+_access_listener = logging.handlers.QueueListener(
+    _access_queue, *_access_handlers(), respect_handler_level=True
+)
+
+
+def start_access_log():
+    if _access_listener._thread is None:
+        _access_listener.start()
+
+
+def stop_access_log():
+    if _access_listener._thread is not None:
+        _access_listener.stop()
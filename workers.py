@@ -0,0 +1,119 @@
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Hashable, Optional
+
+
+class Ticket:
+    # A place in a lane, taken before the call that will fill it is known.
+    # The lane waits at a ticket until it is run or skipped.
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.call: Optional[tuple] = None
+        self.filled = asyncio.Event()
+
+    def run(self, handler: Callable[..., Awaitable], *args) -> asyncio.Future:
+        if not self.filled.is_set():
+            self.call = (handler, args)
+            self.filled.set()
+        return self.future
+
+    def skip(self):
+        if not self.filled.is_set():
+            self.filled.set()
+            if not self.future.done():
+                self.future.set_result(None)
+
+
+class Lane:
+    def __init__(self):
+        self.items: Deque[Ticket] = deque()
+        self.ready = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+
+class KeyedExecutor:
+    # Runs calls one at a time per key, in the order their tickets were
+    # taken, while different keys run in parallel up to max_inflight calls
+    # in total. A key's lane goes away after idle_timeout seconds with
+    # nothing to run.
+    def __init__(self, name: str, max_inflight: int = 64, idle_timeout: float = 60):
+        self.name = name
+        self.max_inflight = max_inflight
+        self.idle_timeout = idle_timeout
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.lanes: Dict[Hashable, Lane] = {}
+        self.inflight = 0
+        self.evicted = 0
+        self.failed = 0
+
+    def reserve(self, key: Hashable) -> Ticket:
+        # Taken synchronously, so tickets taken in a loop keep their order
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_inflight)
+        ticket = Ticket(asyncio.get_running_loop().create_future())
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = self.lanes[key] = Lane()
+            lane.task = asyncio.create_task(
+                self._run_lane(key, lane), name=f"{self.name}-lane"
+            )
+        lane.items.append(ticket)
+        lane.ready.set()
+        return ticket
+
+    def submit(
+        self, key: Hashable, handler: Callable[..., Awaitable], *args
+    ) -> asyncio.Future:
+        return self.reserve(key).run(handler, *args)
+
+    async def _run_lane(self, key: Hashable, lane: Lane):
+        while True:
+            if not lane.items:
+                lane.ready.clear()
+                try:
+                    await asyncio.wait_for(lane.ready.wait(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    # Nothing can be queued between the check and the delete
+                    if not lane.items:
+                        del self.lanes[key]
+                        self.evicted += 1
+                        return
+                continue
+            ticket = lane.items[0]
+            await ticket.filled.wait()
+            lane.items.popleft()
+            if ticket.call is None:
+                continue
+            handler, args = ticket.call
+            future = ticket.future
+            async with self.semaphore:
+                self.inflight += 1
+                try:
+                    result = await handler(*args)
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+                except Exception as e:
+                    self.failed += 1
+                    if not future.done():
+                        future.set_exception(e)
+                        # Callers that stopped waiting shouldn't log a warning
+                        future.exception()
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                finally:
+                    self.inflight -= 1
+
+    def depth(self) -> int:
+        return sum(len(lane.items) for lane in self.lanes.values())
+
+    async def stop(self):
+        # Cancels whatever hasn't run; callers waiting on it see the cancel
+        lanes = list(self.lanes.values())
+        self.lanes = {}
+        for lane in lanes:
+            lane.task.cancel()
+            for ticket in lane.items:
+                ticket.future.cancel()
+        await asyncio.gather(*(lane.task for lane in lanes), return_exceptions=True)
@@ -0,0 +1,77 @@
+import asyncio
+from typing import Optional
+
+import utils
+
+
+class WriteBehind:
+    # Changes are buffered in memory and written out in bulk by a background
+    # task, every flush_interval seconds or as soon as flush_size are waiting.
+    # While the store keeps failing, flushes back off up to max_backoff.
+    # Subclasses implement _write(), which returns how many changes it wrote
+    # and puts back whatever it couldn't before raising.
+    def __init__(
+        self, name: str, flush_interval: float, flush_size: int, max_backoff: float
+    ):
+        self.name = name
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.max_backoff = max_backoff
+        self.lock = asyncio.Lock()
+        self.full = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.stopping = False
+        self.backoff = 0.0
+        self.flushed = 0
+
+    async def _write(self) -> int:
+        raise NotImplementedError
+
+    async def flush(self) -> int:
+        async with self.lock:
+            try:
+                written = await self._write()
+            except Exception as e:
+                self.backoff = min(
+                    self.max_backoff, max(self.flush_interval, self.backoff * 2)
+                )
+                utils.logger.warning(
+                    f"Failed to flush {self.name}, retrying in {self.backoff}s: {e}"
+                )
+                return 0
+            self.backoff = 0.0
+            self.flushed += written
+            return written
+
+    async def start(self):
+        if self.task is None:
+            self.stopping = False
+            self.task = asyncio.create_task(self._run(), name=self.name)
+
+    async def _stop_task(self):
+        if self.task is not None:
+            # The flag ends the loop even when a wake-up races the cancel
+            self.stopping = True
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def stop(self):
+        await self._stop_task()
+        await self.flush()
+
+    async def _run(self):
+        while not self.stopping:
+            if self.backoff:
+                # The store is failing; don't let size triggers hammer it
+                await asyncio.sleep(self.backoff)
+            else:
+                try:
+                    await asyncio.wait_for(
+                        self.full.wait(), timeout=self.flush_interval
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            self.full.clear()
+            if not self.stopping:
+                await self.flush()